@@ -4,19 +4,19 @@ import os
 
 from PyQt4.QtGui import QIcon
 
-from qgis.core import NULL, QgsFeatureRequest
-
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.GeoAlgorithmExecutionException import \
     GeoAlgorithmExecutionException
 
 from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterBoolean
 from processing.core.outputs import OutputVector
+from processing.core.outputs import OutputTable
 
 from processing.tools import dataobjects
-from processing.tools import vector
 
 from QGeomorf.tools import *
+from QGeomorf.core import indexedTopology, topologyParameters
 
 
 pluginPath = os.path.dirname(__file__)
@@ -24,8 +24,12 @@ pluginPath = os.path.dirname(__file__)
 
 class ArcUpstreamDownstream(GeoAlgorithm):
     NETWORK_LAYER = 'NETWORK_LAYER'
+    UPARC_TEXT = 'UPARC_TEXT'
+    ELLIPSOIDAL = 'ELLIPSOIDAL'
 
     UPDOWN_LAYER = 'UPDOWN_LAYER'
+    UPSTREAM_ARCS = 'UPSTREAM_ARCS'
+    RUN_STATISTICS = 'RUN_STATISTICS'
 
     def getIcon(self):
         return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
@@ -36,13 +40,25 @@ class ArcUpstreamDownstream(GeoAlgorithm):
 
         self.addParameter(ParameterVector(self.NETWORK_LAYER,
             self.tr('Stream network'), [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterBoolean(self.UPARC_TEXT,
+            self.tr('Write upstream arc ids as text field'), False))
+        self.addParameter(ParameterBoolean(self.ELLIPSOIDAL,
+            self.tr('Measure lengths on the ellipsoid for geographic CRS'),
+            True))
 
         self.addOutput(OutputVector(self.UPDOWN_LAYER,
             self.tr('Upstream and downstream arcs detected')))
+        self.addOutput(OutputTable(self.UPSTREAM_ARCS,
+            self.tr('Upstream arcs')))
+        self.addOutput(OutputTable(self.RUN_STATISTICS,
+            self.tr('Run statistics')))
 
     def processAlgorithm(self, progress):
         network = dataobjects.getObjectFromUri(
             self.getParameterValue(self.NETWORK_LAYER))
+        # Lengths of geographic layers are geodesic, in meters
+        ellipsoid = layerEllipsoid(network) \
+            if self.getParameterValue(self.ELLIPSOIDAL) else None
 
         # Ensure that nodes already indexed
         idxDownNodeId = findField(network, 'DownNodeId')
@@ -57,8 +73,12 @@ class ArcUpstreamDownstream(GeoAlgorithm):
 
         (idxDownArcId, fieldList) = findOrCreateField(network,
             network.pendingFields(), 'DownArcId', QVariant.Int, 10, 0)
-        (idxUpArcId, fieldList) = findOrCreateField(network, fieldList,
-            'UpArcId', QVariant.String, 250, 0)
+        # Comma separated list of upstream arcs is kept for display only,
+        # upstream arcs table holds the complete relation
+        idxUpArcId = -1
+        if self.getParameterValue(self.UPARC_TEXT):
+            (idxUpArcId, fieldList) = findOrCreateField(network, fieldList,
+                'UpArcId', QVariant.String, 250, 0)
         (idxLength, fieldList) = findOrCreateField(network, fieldList,
             'Length', QVariant.Double, 20, 6)
         (idxLenDown, fieldList) = findOrCreateField(network, fieldList,
@@ -70,78 +90,48 @@ class ArcUpstreamDownstream(GeoAlgorithm):
             fieldList.toList(), networkProvider.geometryType(),
             networkProvider.crs())
 
-        # Generate helper dictionaries
-        myNetwork, arcsPerNodeId = makeHelperDictionaries(network)
-
-        # Write output file
-        for f in network.getFeatures():
-            writer.addFeature(f)
+        # Read node indexes and calculate parameters in memory
+        # Algorithms at pages 55-56 and 61-63
+        # "Automated AGQ4Vector Watershed.pdf"
+        stats = RunStatistics(progress, 4)
+        stats.stage(self.tr('Reading network...'))
+        fids, downNodeId, upNodeId, length = readNodeIds(network, True,
+            False, ellipsoid)
+        stats.count('features', len(fids))
+
+        stats.stage(self.tr('Finding upstream and downstream arcs, '
+                            'calculating lengths...'))
+        # Topology cached by the tool which wrote the node ids is reused,
+        # only lengths are calculated again
+        cacheFile, cacheKey = nodeIdCache(network.source(), downNodeId,
+                                          upNodeId)
+        topology, cached = indexedTopology(downNodeId, upNodeId, cacheFile,
+                                           cacheKey)
+        if cached:
+            progress.setInfo(self.tr('Network topology loaded from cache'))
+        params = topologyParameters(topology, length)
+
+        # Write output file with all attributes set, arcs not connected to
+        # the outlet get only their length
+        stats.stage(self.tr('Writing output...'))
+        connected = params.upNodeId != -1
+        columns = {
+            idxDownArcId: downArcIds(params, fids),
+            idxLength: list(length),
+            idxLenDown: maskedValues(params.lengthDown, connected),
+            idxLenUp: maskedValues(params.lengthUp, connected)}
+        if idxUpArcId != -1:
+            columns[idxUpArcId] = upArcIds(params, fids)
+        lookups = writeNetwork(network, writer, fids, fieldList.count(),
+                               columns)
         del writer
+        cacheOutputTopology(self.getOutputValue(self.UPDOWN_LAYER), topology)
+        stats.count('features', len(fids))
+        stats.count('fidLookups', lookups)
+        stats.count('attrWrites', len(fids))
+
+        stats.stage(self.tr('Writing upstream arcs table...'))
+        writeUpstreamArcs(self.getOutputFromName(self.UPSTREAM_ARCS),
+                          params, fids)
 
-        vl = QgsVectorLayer(self.getOutputValue(self.UPDOWN_LAYER), 'tmp', 'ogr')
-        provider = vl.dataProvider()
-        for f in vl.getFeatures():
-            fid = f.id()
-
-            # Determine upstream node id
-            upNodeId = f['UpNodeId']
-
-            attrs = {idxDownArcId:fid}
-            changes = dict()
-            ids = []
-
-            # Iterate over all arcs connected to the upstream node with
-            # given id, skipping current arc
-            for i in arcsPerNodeId[upNodeId]:
-                if i != fid:
-                    # Modify DownArcId
-                    changes[i] = attrs
-                    # Collect ids of the arcs located upstream
-                    ids.append(str(i))
-
-            provider.changeAttributeValues(changes)
-            provider.changeAttributeValues({fid:{idxUpArcId:','.join(ids)}})
-
-            # Also calculate length of the current arc
-            provider.changeAttributeValues({fid:{idxLength:f.geometry().length()}})
-
-        # Calculate length upstream for arcs
-        # Algorithm at pages 61-62 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Calculating length upstream...'))
-        req = QgsFeatureRequest()
-        # Iterate over upsteram node ids starting from the last ones
-        # which represents source arcs
-        for nodeId in sorted(myNetwork.keys(), reverse=True):
-            f = vl.getFeatures(req.setFilterFid(myNetwork[nodeId])).next()
-            arcLen = f['Length'] if f['Length'] else 0.0
-            upstreamArcs = f['UpArcId']
-            if not upstreamArcs:
-                provider.changeAttributeValues({f.id():{idxLenUp: arcLen}})
-            else:
-                length = []
-                for i in upstreamArcs.split(','):
-                    f = vl.getFeatures(req.setFilterFid(int(i))).next()
-                    if f['LengthUp']:
-                        length.append(f['LengthUp'])
-                    upLen = max(length) if len(length) > 0  else 0.0
-                provider.changeAttributeValues({myNetwork[nodeId]:{idxLenUp:arcLen + upLen}})
-
-        # Calculate length downstream for arcs
-        # Algorithm at pages 62-63 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Calculating length downstream...'))
-        first = True
-        # Iterate over upsteram node ids starting from the first one
-        # which represents downstream node of the outlet arc
-        for nodeId in sorted(myNetwork.keys()):
-            f = vl.getFeatures(req.setFilterFid(myNetwork[nodeId])).next()
-            # for outlet arc downstream length set to zero
-            if first:
-                provider.changeAttributeValues({myNetwork[nodeId]:{idxLenDown:0.0}})
-                first = False
-                continue
-
-            arcLen = f['Length'] if f['Length'] else 0.0
-            downArcId = f['DownArcId']
-            f = vl.getFeatures(req.setFilterFid(downArcId)).next()
-            lenDown = f['LengthDown'] if f['LengthDown'] else 0.0
-            provider.changeAttributeValues({myNetwork[nodeId]:{idxLenDown: arcLen + lenDown}})
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
@@ -4,19 +4,19 @@ import os
 
 from PyQt4.QtGui import QIcon
 
-from qgis.core import NULL, QgsFeatureRequest
-
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.GeoAlgorithmExecutionException import \
     GeoAlgorithmExecutionException
 
 from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterTableField
 from processing.core.outputs import OutputTable
 
 from processing.tools import dataobjects
-from processing.tools import vector
 
 from QGeomorf.tools import *
+from QGeomorf.graph import orderFrequency, bifurcationRatios, hortonRatios
+from QGeomorf.core import storedParameters
 
 
 pluginPath = os.path.dirname(__file__)
@@ -24,9 +24,12 @@ pluginPath = os.path.dirname(__file__)
 
 class BifurcationRatios(GeoAlgorithm):
     NETWORK_LAYER = 'NETWORK_LAYER'
+    AREA_FIELD = 'AREA_FIELD'
 
     ORDER_FREQUENCY = 'ORDER_FREQUENCY'
     BIFURCATION_PARAMS = 'BIFURCATION_PARAMS'
+    HORTON_RATIOS = 'HORTON_RATIOS'
+    RUN_STATISTICS = 'RUN_STATISTICS'
 
     def getIcon(self):
         return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
@@ -37,15 +40,23 @@ class BifurcationRatios(GeoAlgorithm):
 
         self.addParameter(ParameterVector(self.NETWORK_LAYER,
             self.tr('Stream network'), [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterTableField(self.AREA_FIELD,
+            self.tr('Basin area upstream of the arc'), self.NETWORK_LAYER,
+            ParameterTableField.DATA_TYPE_NUMBER, True))
 
         self.addOutput(OutputTable(
             self.ORDER_FREQUENCY, self.tr('Order frequency')))
         self.addOutput(OutputTable(
             self.BIFURCATION_PARAMS, self.tr('Bifurcation parameters')))
+        self.addOutput(OutputTable(
+            self.HORTON_RATIOS, self.tr('Horton ratios')))
+        self.addOutput(OutputTable(
+            self.RUN_STATISTICS, self.tr('Run statistics')))
 
     def processAlgorithm(self, progress):
         network = dataobjects.getObjectFromUri(
             self.getParameterValue(self.NETWORK_LAYER))
+        areaField = self.getParameterValue(self.AREA_FIELD)
 
         # Ensure that Strahler orders assigned
         idxStrahler= findField(network, 'StrahOrder')
@@ -54,39 +65,26 @@ class BifurcationRatios(GeoAlgorithm):
                 self.tr('Seems Strahler orders is not assigned. '
                         'Please run corresponding tool and try again.'))
 
-        # Generate helper dictionaries
-        myNetwork, arcsPerNodeId = makeHelperDictionaries(network)
+        stats = RunStatistics(progress, 3)
+
+        # Read network once, upstream arcs are found from node indexes
+        stats.stage(self.tr('Reading network...'))
+        fids, downNodeId, upNodeId, length, strahler, area = \
+            readOrders(network, areaField)
+        stats.count('features', len(fids))
+        params = storedParameters(downNodeId, upNodeId, length, strahler)
 
         # Calculate order frequency
-        progress.setInfo(self.tr('Calculating order frequency...'))
-
-        maxOrder = int(network.maximumValue(idxStrahler))
-        ordersFrequency = dict()
-        bifRatios = dict()
-
-        # Initialize dictionaries
-        for i in xrange(1, maxOrder + 1):
-            ordersFrequency[i] = dict(N=0.0, Ndu=0.0, Na=0.0)
-            bifRatios[i] = dict(Rbu=0.0, Rbdu=0.0, Ru=0.0)
-
-        req = QgsFeatureRequest()
-        for i in xrange(1, maxOrder + 1):
-            req.setFilterExpression('"StrahOrder" = %s' % i)
-            for f in network.getFeatures(req):
-                order = int(f['StrahOrder'])
-                upstreamArcs = f['UpArcId'].split(',') if f['UpArcId'] else []
-                if len(upstreamArcs) == 0:
-                    ordersFrequency[i]['N'] += 1.0
-                elif len(upstreamArcs) > 1:
-                    ordersFrequency[order]['N'] += 1.0
-                    for j in upstreamArcs:
-                        f = network.getFeatures(QgsFeatureRequest().setFilterFid(int(j))).next()
-                        upOrder = int(f['StrahOrder'])
-                        diff = upOrder - order
-                        if diff == 1:
-                            ordersFrequency[upOrder]['Ndu'] += 1.0
-                        if diff > 1:
-                            ordersFrequency[upOrder]['Na'] += 1.0
+        stats.stage(self.tr('Calculating order frequency...'))
+        ordersFrequency = orderFrequency(params.upArcOffsets, params.upArcs,
+                                         params.strahler)
+
+        # Calculate bifurcation parameters and Horton ratios
+        stats.stage(self.tr('Calculating bifurcation parameters...'))
+        bifRatios = bifurcationRatios(ordersFrequency)
+        horton = hortonRatios(params.upArcOffsets, params.upArcs,
+                              params.downArc, params.strahler,
+                              params.length, area)
 
         writerOrders = self.getOutputFromName(
             self.ORDER_FREQUENCY).getTableWriter(['order', 'N', 'NDU', 'NA'])
@@ -94,20 +92,13 @@ class BifurcationRatios(GeoAlgorithm):
         writerBifrat = self.getOutputFromName(
             self.BIFURCATION_PARAMS).getTableWriter(['order', 'RBD', 'RB', 'RU'])
 
-        # Calculate bifurcation parameters
-        progress.setInfo(self.tr('Calculating bifurcation parameters...'))
-        for k, v in ordersFrequency.iteritems():
-            if k != maxOrder:
-                bifRatios[k]['Rbu'] = ordersFrequency[k]['N'] / ordersFrequency[k + 1]['N']
-                bifRatios[k]['Rbdu'] = ordersFrequency[k]['Ndu'] / ordersFrequency[k + 1]['N']
-            else:
-                bifRatios[k]['Rbu'] = 0.0
-                bifRatios[k]['Rbdu'] = 0.0
-
-            bifRatios[k]['Ru'] = bifRatios[k]['Rbu'] - bifRatios[k]['Rbdu']
-
-            writerOrders.addRecord([k, v['N'], v['Ndu'], v['Na']])
-            writerBifrat.addRecord([k, bifRatios[k]['Rbdu'], bifRatios[k]['Rbu'], bifRatios[k]['Ru']])
+        for k in sorted(ordersFrequency.keys()):
+            writerOrders.addRecord([k] + ordersFrequency[k])
+            writerBifrat.addRecord([k] + bifRatios[k])
 
         del writerOrders
         del writerBifrat
+
+        writeHortonRatios(self.getOutputFromName(self.HORTON_RATIOS), horton)
+
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os
+import math
+
+from PyQt4.QtGui import QIcon
+
+from processing.core.GeoAlgorithm import GeoAlgorithm
+from processing.core.GeoAlgorithmExecutionException import \
+    GeoAlgorithmExecutionException
+
+from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterSelection
+from processing.core.outputs import OutputVector
+from processing.core.outputs import OutputTable
+
+from processing.tools import dataobjects
+
+from QGeomorf.tools import *
+from QGeomorf.core import flowIndex
+
+
+pluginPath = os.path.dirname(__file__)
+
+
+class ExtractSubnetwork(GeoAlgorithm):
+    NETWORK_LAYER = 'NETWORK_LAYER'
+    DIRECTION = 'DIRECTION'
+
+    SUBNETWORK = 'SUBNETWORK'
+    RUN_STATISTICS = 'RUN_STATISTICS'
+
+    UPSTREAM = 0
+    DOWNSTREAM = 1
+    BOTH = 2
+
+    DIRECTIONS = ['Upstream',
+                  'Downstream',
+                  'Upstream and downstream']
+
+    def getIcon(self):
+        return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
+
+    def defineCharacteristics(self):
+        self.name = 'Extract upstream/downstream subnetwork'
+        self.group = 'Geomorf'
+
+        self.addParameter(ParameterVector(self.NETWORK_LAYER,
+            self.tr('Stream network (start arcs should be selected)'),
+            [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterSelection(self.DIRECTION,
+            self.tr('Direction'), self.DIRECTIONS, 0))
+
+        self.addOutput(OutputVector(self.SUBNETWORK,
+            self.tr('Subnetwork')))
+        self.addOutput(OutputTable(self.RUN_STATISTICS,
+            self.tr('Run statistics')))
+
+    def processAlgorithm(self, progress):
+        network = dataobjects.getObjectFromUri(
+            self.getParameterValue(self.NETWORK_LAYER))
+        direction = self.getParameterValue(self.DIRECTION)
+
+        # Ensure that nodes already indexed and start arcs selected
+        idxDownNodeId = findField(network, 'DownNodeId')
+        idxUpNodeId = findField(network, 'UpNodeId')
+        if idxDownNodeId == -1 or idxUpNodeId == -1:
+            raise GeoAlgorithmExecutionException(
+                self.tr('Seems nodes are not indexed. Please run node '
+                        'indexing tool first and try again.'))
+        if network.selectedFeatureCount() == 0:
+            raise GeoAlgorithmExecutionException(
+                self.tr('Seems start arcs are not selected. Select arcs '
+                        'in the stream network layer and try again.'))
+
+        networkProvider = network.dataProvider()
+        (idxFlowDist, fieldList) = findOrCreateField(network,
+            network.pendingFields(), 'FlowDist', QVariant.Double, 20, 6)
+
+        writer = self.getOutputFromName(self.SUBNETWORK).getVectorWriter(
+            fieldList.toList(), networkProvider.geometryType(),
+            networkProvider.crs())
+
+        stats = RunStatistics(progress, 3)
+        stats.stage(self.tr('Reading network...'))
+        # Lengths of geographic layers are geodesic, in meters
+        fids, downNodeId, upNodeId, length = readNodeIds(network, True,
+            True, layerEllipsoid(network))
+        stats.count('features', len(fids))
+        position = dict((fid, i) for i, fid in enumerate(fids))
+        starts = [position[f.id()] for f in network.selectedFeatures()]
+
+        # Index is built once, every upstream set is then a slice of arcs
+        # in preorder and every path downstream is followed arc by arc
+        stats.stage(self.tr('Building flow index...'))
+        index = flowIndex(downNodeId, upNodeId, length)
+        unindexed = sum(1 for s in starts if upNodeId[s] == -1)
+        if unindexed > 0:
+            progress.setInfo(self.tr('{} selected arcs are not connected '
+                'to an outlet').format(unindexed))
+        if len(starts) == 2:
+            distance = index.flowDistance(starts[0], starts[1])
+            if math.isnan(distance):
+                progress.setInfo(self.tr('Selected arcs are in different '
+                    'basins'))
+            else:
+                progress.setInfo(self.tr('Flow distance between selected '
+                    'arcs: {}').format(distance))
+
+        # Flow distance from the nearest start arc, NaN outside the
+        # subnetwork
+        flowDist = index.subnetwork(starts, direction != self.DOWNSTREAM,
+                                    direction != self.UPSTREAM).tolist()
+
+        stats.stage(self.tr('Writing output...'))
+        fieldCount = fieldList.count()
+        for f in network.getFeatures():
+            i = position[f.id()]
+            if math.isnan(flowDist[i]):
+                continue
+            attrs = f.attributes()
+            attrs.extend([NULL] * (fieldCount - len(attrs)))
+            attrs[idxFlowDist] = flowDist[i]
+            f.setAttributes(attrs)
+            writer.addFeature(f)
+            stats.count('features', 1)
+            stats.count('attrWrites', 1)
+        del writer
+
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
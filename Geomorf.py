@@ -4,20 +4,26 @@ import os
 
 from PyQt4.QtGui import QIcon
 
-from qgis.core import NULL, QgsFeatureRequest
 
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.GeoAlgorithmExecutionException import \
     GeoAlgorithmExecutionException
 
 from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterSelection
 from processing.core.parameters import ParameterTableField
+from processing.core.parameters import ParameterBoolean
+from processing.core.outputs import OutputVector
 from processing.core.outputs import OutputTable
 
 from processing.tools import dataobjects
-from processing.tools import vector
 
 from QGeomorf.tools import *
+from QGeomorf.graph import orderFrequency, bifurcationRatios, hortonRatios
+from QGeomorf.validation import NetworkError
+from QGeomorf.core import (analyseNetworkBasins, updateNetwork,
+    networkTopology)
 
 
 pluginPath = os.path.dirname(__file__)
@@ -25,235 +31,200 @@ pluginPath = os.path.dirname(__file__)
 
 class Geomorf(GeoAlgorithm):
     NETWORK_LAYER = 'NETWORK_LAYER'
-
+    SNAP_TOLERANCE = 'SNAP_TOLERANCE'
+    UPARC_TEXT = 'UPARC_TEXT'
+    ELLIPSOIDAL = 'ELLIPSOIDAL'
+    OUTLETS = 'OUTLETS'
+    OUTLET_FIELD = 'OUTLET_FIELD'
+    INCREMENTAL = 'INCREMENTAL'
+
+    NETWORK = 'NETWORK'
+    UPSTREAM_ARCS = 'UPSTREAM_ARCS'
     ORDER_FREQUENCY = 'ORDER_FREQUENCY'
     BIFURCATION_PARAMS = 'BIFURCATION_PARAMS'
+    HORTON_RATIOS = 'HORTON_RATIOS'
+    RUN_STATISTICS = 'RUN_STATISTICS'
 
     def getIcon(self):
         return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
 
     def defineCharacteristics(self):
-        self.name = 'Geomorfic parameters calculation'
+        self.name = 'Full geomorphic analysis'
         self.group = 'Geomorf'
 
         self.addParameter(ParameterVector(self.NETWORK_LAYER,
-            self.tr('Stream network'), [ParameterVector.VECTOR_TYPE_LINE]))
-
+            self.tr('Stream network (outlet arc should be selected)'),
+            [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterNumber(self.SNAP_TOLERANCE,
+            self.tr('Snap tolerance for arc endpoints'), 0.0, None, 0.0))
+        self.addParameter(ParameterSelection(self.OUTLETS,
+            self.tr('Outlets'), OUTLET_MODES, 0))
+        self.addParameter(ParameterTableField(self.OUTLET_FIELD,
+            self.tr('Outlet flag field'), self.NETWORK_LAYER,
+            ParameterTableField.DATA_TYPE_ANY, True))
+        self.addParameter(ParameterBoolean(self.UPARC_TEXT,
+            self.tr('Write upstream arc ids as text field'), False))
+        self.addParameter(ParameterBoolean(self.ELLIPSOIDAL,
+            self.tr('Measure lengths on the ellipsoid for geographic CRS'),
+            True))
+        self.addParameter(ParameterBoolean(self.INCREMENTAL,
+            self.tr('Update results of the previous run'), False))
+
+        self.addOutput(OutputVector(self.NETWORK,
+            self.tr('Network with geomorphic parameters')))
+        self.addOutput(OutputTable(
+            self.UPSTREAM_ARCS, self.tr('Upstream arcs')))
         self.addOutput(OutputTable(
             self.ORDER_FREQUENCY, self.tr('Order frequency')))
         self.addOutput(OutputTable(
             self.BIFURCATION_PARAMS, self.tr('Bifurcation parameters')))
+        self.addOutput(OutputTable(
+            self.HORTON_RATIOS, self.tr('Horton ratios')))
+        self.addOutput(OutputTable(
+            self.RUN_STATISTICS, self.tr('Run statistics')))
 
     def processAlgorithm(self, progress):
         network = dataobjects.getObjectFromUri(
             self.getParameterValue(self.NETWORK_LAYER))
-        # Ensure that outlet arc is selected
-        if network.selectedFeatureCount() != 1:
-            raise GeoAlgorithmExecutionException(
-                self.tr('Seems oulet arc is not selected. Select outlet'
-                        'arc in the stream network layer and try again.'))
-
-        # First add new fields to the network layer
-        networkProvider = network.dataProvider()
-        networkProvider.addAttributes(
-            [QgsField('StrahOrder', QVariant.Int, '', 10),    # Strahler order
-             QgsField('DownNodeId', QVariant.Int, '', 10),    # downstream node id
-             QgsField('UpNodeId', QVariant.Int, '', 10),      # upstream node id
-             QgsField('DownArcId', QVariant.Int, '', 10),     # downstream arc id
-             QgsField('UpArcId', QVariant.String, '', 250),   # comma separated list of upstream arc ids
-             QgsField('Length', QVariant.Double, '', 20, 6),  # length of the arc
-             QgsField('LengthDown', QVariant.Double, '', 20, 6), # length downstream
-             QgsField('LengthUp', QVariant.Double, '', 20, 6)])  # length upstream
-        network.updateFields()
-
-        # Determine indexes of the fields
-        idxStrahler = network.fieldNameIndex('StrahOrder')
-        idxDownNodeId = network.fieldNameIndex('DownNodeId')
-        idxUpNodeId = network.fieldNameIndex('UpNodeId')
-        idxDownArcId = network.fieldNameIndex('DownArcId')
-        idxUpArcId = network.fieldNameIndex('UpArcId')
-        idxLength = network.fieldNameIndex('Length')
-        idxLenDown = network.fieldNameIndex('LengthDown')
-        idxLenUp = network.fieldNameIndex('LengthUp')
-
-        # Generate arc adjacency dictionary
-        # Algorithm at pages 79-80 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Generating arc adjacency dictionary...'))
-        self.arcsPerNode = arcsAadjacencyDictionary(network)
-
-        # Node indexing
-        # Algorithm at pages 80-81 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Indexing nodes...'))
-        self.dwUpNodesId = dict()
-
-        # Outlet arc and its upstream node
-        outletArc = network.selectedFeatures()[0]
-        upNode = outletArc.geometry().asPolyline()[-1]
-
-        # Dictionary for storing node indexes per arc.
-        # For outlet arc we assign -1 for downstream and 0 for upstream nodes
-        self.dwUpNodesId[outletArc.id()] = [-1, 0]
-        # Current node id
-        self.nodeId = 0
-
-        # Start recursive node indexing procedure
-        self.nodeIndexing(outletArc, upNode)
-
-        # Write node indices to the network layer attributes
-        progress.setInfo(self.tr('Assigning indices...'))
-        for i in self.dwUpNodesId.keys():
-            nodeIds = self.dwUpNodesId[i]
-            attrs = {idxDownNodeId:nodeIds[0], idxUpNodeId:nodeIds[1]}
-            networkProvider.changeAttributeValues({i: attrs})
-
-        # Mapping between upstream node id from attribute table and  QGIS
-        # feature id. Will be used to sort features from the network table
-        myNetwork = dict()
-
-        # Find upstream and downstream arc ids for each arc in the stream
-        # network layer. First we generate helper arcPerNodeId dictionary
-        # with node ids as keys and lists of arc ids connected to this node
-        # as values
-        # Algorithm at pages 55-56 "Automated AGQ4Vector Watershed.pdf"
-        arcsPerNodeId = dict()
-        for f in network.getFeatures():
-            if f['UpNodeId'] not in arcsPerNodeId:
-                arcsPerNodeId[f['UpNodeId']] = [f.id()]
-            else:
-                arcsPerNodeId[f['UpNodeId']].append(f.id())
-
-            if f['DownNodeId'] not in arcsPerNodeId:
-                arcsPerNodeId[f['DownNodeId']] = [f.id()]
-            else:
-                arcsPerNodeId[f['DownNodeId']].append(f.id())
-
-            # Also populate mapping between upstream node id and feature id
-            myNetwork[f['UpNodeId']] = f.id()
-
-        # Populating upstream and downstream arc ids
-        # Iterate over all arcs in the stream network layer
-        for f in network.getFeatures():
-            fid = f.id()
-            # Determine upstream node id
-            upNodeId = f['UpNodeId']
-
-            attrs = {idxDownArcId:fid}
-            changes = dict()
-            ids = []
-
-            # Iterate over all arcs connected to the upstream node with
-            # given id, skipping current arc
-            for i in arcsPerNodeId[upNodeId]:
-                if i != fid:
-                    # Modify DownArcId
-                    changes[i] = attrs
-                    # Collect ids of the arcs located upstream
-                    ids.append(str(i))
-
-            networkProvider.changeAttributeValues(changes)
-            networkProvider.changeAttributeValues({fid:{idxUpArcId:','.join(ids)}})
-
-            # Also calculate length of the current arc
-            networkProvider.changeAttributeValues({fid:{idxLength:f.geometry().length()}})
-
-        # Calculate length upstream for arcs
-        # Algorithm at pages 61-62 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Calculating length upstream...'))
-        req = QgsFeatureRequest()
-        # Iterate over upsteram node ids starting from the last ones
-        # which represents source arcs
-        for nodeId in sorted(myNetwork.keys(), reverse=True):
-            f = network.getFeatures(req.setFilterFid(myNetwork[nodeId])).next()
-            arcLen = f['Length']
-            upstreamArcs = f['UpArcId']
-            if not upstreamArcs:
-                networkProvider.changeAttributeValues({f.id():{idxLenUp: arcLen}})
+        # Lengths of geographic layers are geodesic, in meters
+        ellipsoid = layerEllipsoid(network) \
+            if self.getParameterValue(self.ELLIPSOIDAL) else None
+        tolerance = self.getParameterValue(self.SNAP_TOLERANCE)
+        outletMode = self.getParameterValue(self.OUTLETS)
+        outletField = self.getParameterValue(self.OUTLET_FIELD)
+
+        # Results of the previous run and outlet flags are read together
+        # with the geometries, so the network is read only once
+        incremental = self.getParameterValue(self.INCREMENTAL) and \
+            hasResults(network)
+        if self.getParameterValue(self.INCREMENTAL) and not incremental:
+            progress.setInfo(self.tr('Results of the previous run not '
+                'found, calculating all parameters'))
+        if not incremental:
+            # Ensure that outlet arcs can be found before reading
+            checkOutlets(network, outletMode, outletField)
+        columns = list(RESULT_COLUMNS) if incremental else []
+        if outletMode == OUTLET_FLAGGED and outletField:
+            columns.append(outletColumn(outletField))
+
+        # All parameters are computed in memory
+        stats = RunStatistics(progress, 6)
+        stats.stage(self.tr('Reading network...'))
+        fids, startX, startY, endX, endY, length, parts, values = \
+            readEndpoints(network, ellipsoid, True, columns)
+        stats.count('features', len(fids))
+
+        # Node indexing, upstream and downstream arcs, lengths and
+        # Strahler orders
+        # Algorithms at pages 55-56, 61-66 and 79-81
+        # "Automated AGQ4Vector Watershed.pdf"
+        stats.stage(self.tr('Calculating network parameters...'))
+        params = None
+        if incremental:
+            # Results stored in the layer by the previous run are checked
+            # against the network and recalculated only where they
+            # disagree with it, outlets are not needed for that
+            (downNodeId, upNodeId, basin, strahler, lengthUp,
+                lengthDown) = storedResults(fids,
+                                            values[:len(RESULT_COLUMNS)])
+            params, updated, merges = updateNetwork(startX, startY, endX,
+                endY, length, downNodeId, upNodeId, basin, strahler,
+                lengthUp, lengthDown, tolerance)
+            if params is None:
+                progress.setInfo(self.tr('Network topology changed, '
+                    'calculating all parameters'))
             else:
-                length = []
-                for i in upstreamArcs.split(','):
-                    f = network.getFeatures(req.setFilterFid(int(i))).next()
-                    if f['LengthUp']:
-                        length.append(f['LengthUp'])
-                    upLen = max(length) if len(length) > 0  else 0.0
-                networkProvider.changeAttributeValues({myNetwork[nodeId]:{idxLenUp:arcLen + upLen}})
-
-        # Calculate length downstream for arcs
-        # Algorithm at pages 62-63 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Calculating length downstream...'))
-        first = True
-        # Iterate over upsteram node ids starting from the first one
-        # which represents downstream node of the outlet arc
-        for nodeId in sorted(myNetwork.keys()):
-            f = network.getFeatures(req.setFilterFid(myNetwork[nodeId])).next()
-            # for outlet arc downstream length set to zero
-            if first:
-                networkProvider.changeAttributeValues({myNetwork[nodeId]:{idxLenDown:0.0}})
-                first = False
-                continue
-
-            arcLen = f['Length']
-            downArcId = f['DownArcId']
-            f = network.getFeatures(req.setFilterFid(downArcId)).next()
-            lenDown = f['LengthDown'] if f['LengthDown'] else 0.0
-            networkProvider.changeAttributeValues({myNetwork[nodeId]:{idxLenDown: arcLen + lenDown}})
-
-        # calculate Strahler orders
-        # Algorithm at pages 65-66 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Calculating Strahler orders...'))
-        # Iterate over upsteram node ids starting from the last ones
-        # which represents source arcs
-        for nodeId in sorted(myNetwork.keys(), reverse=True):
-            f = network.getFeatures(req.setFilterFid(myNetwork[nodeId])).next()
-            fid = f.id()
-            upstreamArcs = f['UpArcId']
-            if upstreamArcs == NULL:
-                networkProvider.changeAttributeValues({fid:{idxStrahler: 1}})
-            else:
-                orders = []
-                for i in upstreamArcs.split(','):
-                    f = network.getFeatures(req.setFilterFid(int(i))).next()
-                    if f['StrahOrder']:
-                        orders.append(f['StrahOrder'])
-                orders.sort(reverse=True)
-                if len(orders) == 1:
-                    order = orders[0]
-                elif len(orders) >= 2:
-                    diff = orders[0] - orders[1]
-                    if diff == 0:
-                        order = orders[0] + 1
-                    else:
-                        order = max([orders[0], orders[1]])
-                networkProvider.changeAttributeValues({fid:{idxStrahler: order}})
+                progress.setInfo(self.tr('{} arcs updated').format(updated))
+
+        if params is None:
+            if incremental:
+                checkOutlets(network, outletMode, outletField)
+            flags = values[-1].tolist() \
+                if outletMode == OUTLET_FLAGGED and outletField else None
+            outlets = outletArcs(network, outletMode, outletField, fids,
+                                 flags)
+
+            # Topology of unchanged network is loaded from the cache
+            cacheFile, cacheKey = topologyCache(network, startX, startY,
+                endX, endY, outlets, tolerance)
+            # Defects making the results wrong are found before indexing
+            try:
+                params, basin, ambiguous, merges, cached = \
+                    analyseNetworkBasins(startX, startY, endX, endY, length,
+                        outlets, tolerance, workerProcesses(), cacheFile,
+                        cacheKey, True, parts)
+            except NetworkError as e:
+                raise GeoAlgorithmExecutionException(
+                    self.tr('{}. Run Validate network to locate the '
+                            'defects.').format(e))
+            if cached:
+                progress.setInfo(self.tr('Network topology loaded from '
+                    'cache'))
+            if ambiguous > 0:
+                progress.setInfo(self.tr('{} parts of the network with '
+                    'more than one outlet skipped').format(ambiguous))
+
+        if tolerance > 0:
+            progress.setInfo(self.tr('{} endpoint locations snapped to '
+                'neighbouring nodes').format(merges))
+
+        # Write network with all computed attributes in one pass, arcs not
+        # connected to the outlet get NULL
+        stats.stage(self.tr('Writing output...'))
+        connected = params.upNodeId != -1
+        networkProvider = network.dataProvider()
+        fieldList = network.pendingFields()
+        fieldValues = [
+            ('StrahOrder', QVariant.Int, 10, 0,
+                maskedValues(params.strahler, connected)),
+            ('DownNodeId', QVariant.Int, 10, 0,
+                maskedValues(params.downNodeId, connected)),
+            ('UpNodeId', QVariant.Int, 10, 0,
+                maskedValues(params.upNodeId, connected)),
+            ('DownArcId', QVariant.Int, 10, 0, downArcIds(params, fids)),
+            ('BasinId', QVariant.Int, 10, 0,
+                [fids[b] if b != -1 else None for b in basin.tolist()]),
+            ('Length', QVariant.Double, 20, 6, params.length.tolist()),
+            ('LengthDown', QVariant.Double, 20, 6,
+                maskedValues(params.lengthDown, connected)),
+            ('LengthUp', QVariant.Double, 20, 6,
+                maskedValues(params.lengthUp, connected))]
+        if self.getParameterValue(self.UPARC_TEXT):
+            fieldValues.append(('UpArcId', QVariant.String, 250, 0,
+                                upArcIds(params, fids)))
+
+        columns = dict()
+        for name, fieldType, fieldLen, fieldPrec, values in fieldValues:
+            (idx, fieldList) = findOrCreateField(network, fieldList, name,
+                fieldType, fieldLen, fieldPrec)
+            columns[idx] = values
+
+        writer = self.getOutputFromName(self.NETWORK).getVectorWriter(
+            fieldList.toList(), networkProvider.geometryType(),
+            networkProvider.crs())
+        lookups = writeNetwork(network, writer, fids, fieldList.count(),
+                               columns)
+        del writer
+        cacheOutputTopology(self.getOutputValue(self.NETWORK),
+                            networkTopology(params))
+        stats.count('features', len(fids))
+        stats.count('fidLookups', lookups)
+        stats.count('attrWrites', len(fids))
+
+        stats.stage(self.tr('Writing upstream arcs table...'))
+        writeUpstreamArcs(self.getOutputFromName(self.UPSTREAM_ARCS),
+                          params, fids)
 
         # Calculate order frequency
-        progress.setInfo(self.tr('Calculating order frequency...'))
-
-        maxOrder = int(network.maximumValue(idxStrahler))
-        ordersFrequency = dict()
-        bifRatios = dict()
-
-        # Initialize dictionaries
-        for i in xrange(1, maxOrder + 1):
-            ordersFrequency[i] = dict(N=0.0, Ndu=0.0, Na=0.0)
-            bifRatios[i] = dict(Rbu=0.0, Rbdu=0.0, Ru=0.0)
-
-        for i in xrange(1, maxOrder + 1):
-            req.setFilterExpression('"StrahOrder" = %s' % i)
-            for f in network.getFeatures(req):
-                order = int(f['StrahOrder'])
-                upstreamArcs = f['UpArcId'].split(',') if f['UpArcId'] else []
-                if len(upstreamArcs) == 0:
-                    ordersFrequency[i]['N'] += 1.0
-                elif len(upstreamArcs) > 1:
-                    ordersFrequency[order]['N'] += 1.0
-                    for j in upstreamArcs:
-                        f = network.getFeatures(QgsFeatureRequest().setFilterFid(int(j))).next()
-                        upOrder = int(f['StrahOrder'])
-                        diff = upOrder - order
-                        if diff == 1:
-                            ordersFrequency[upOrder]['Ndu'] += 1.0
-                        if diff > 1:
-                            ordersFrequency[upOrder]['Na'] += 1.0
+        stats.stage(self.tr('Calculating order frequency...'))
+        ordersFrequency = orderFrequency(params.upArcOffsets, params.upArcs,
+                                         params.strahler)
+
+        # Calculate bifurcation parameters
+        stats.stage(self.tr('Calculating bifurcation parameters...'))
+        bifRatios = bifurcationRatios(ordersFrequency)
+        horton = hortonRatios(params.upArcOffsets, params.upArcs,
+                              params.downArc, params.strahler, params.length)
 
         writerOrders = self.getOutputFromName(
             self.ORDER_FREQUENCY).getTableWriter(['order', 'N', 'NDU', 'NA'])
@@ -261,38 +232,13 @@ class Geomorf(GeoAlgorithm):
         writerBifrat = self.getOutputFromName(
             self.BIFURCATION_PARAMS).getTableWriter(['order', 'RBD', 'RB', 'RU'])
 
-        # Calculate bifurcation parameters
-        progress.setInfo(self.tr('Calculating bifurcation parameters...'))
-        for k, v in ordersFrequency.iteritems():
-            if k != maxOrder:
-                bifRatios[k]['Rbu'] = ordersFrequency[k]['N'] / ordersFrequency[k + 1]['N']
-                bifRatios[k]['Rbdu'] = ordersFrequency[k]['Ndu'] / ordersFrequency[k + 1]['N']
-            else:
-                bifRatios[k]['Rbu'] = 0.0
-                bifRatios[k]['Rbdu'] = 0.0
-
-            bifRatios[k]['Ru'] = bifRatios[k]['Rbu'] - bifRatios[k]['Rbdu']
-
-            writerOrders.addRecord([k, v['N'], v['Ndu'], v['Na']])
-            writerBifrat.addRecord([k, bifRatios[k]['Rbdu'], bifRatios[k]['Rbu'], bifRatios[k]['Ru']])
+        for k in sorted(ordersFrequency.keys()):
+            writerOrders.addRecord([k] + ordersFrequency[k])
+            writerBifrat.addRecord([k] + bifRatios[k])
 
         del writerOrders
         del writerBifrat
 
-    def nodeIndexing(self, arc, upNode):
-        if len(self.arcsPerNode[upNode]) != 1:
-            # iterate over arcs connected to given node
-            for f in self.arcsPerNode[upNode]:
-                if f.id() != arc.id():
-                    polyline = f.geometry().asPolyline()
-                    fNode = polyline[0]
-                    tNode = polyline[-1]
-
-                    self.nodeId += 1
-
-                    self.dwUpNodesId[f.id()] = [self.dwUpNodesId[arc.id()][1], self.nodeId]
+        writeHortonRatios(self.getOutputFromName(self.HORTON_RATIOS), horton)
 
-                    if upNode != fNode:
-                        self.nodeIndexing(f, fNode)
-                    else:
-                        self.nodeIndexing(f, tNode)
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from PyQt4.QtGui import QIcon
+
+from qgis.core import QGis
+
+from processing.core.GeoAlgorithm import GeoAlgorithm
+from processing.core.GeoAlgorithmExecutionException import \
+    GeoAlgorithmExecutionException
+
+from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterNumber
+from processing.core.outputs import OutputVector
+from processing.core.outputs import OutputTable
+
+from processing.tools import dataobjects
+
+from QGeomorf.tools import *
+from QGeomorf.core import indexNetwork
+
+
+pluginPath = os.path.dirname(__file__)
+
+
+class NetworkNodes(GeoAlgorithm):
+    NETWORK_LAYER = 'NETWORK_LAYER'
+    SNAP_TOLERANCE = 'SNAP_TOLERANCE'
+
+    NODES = 'NODES'
+    RUN_STATISTICS = 'RUN_STATISTICS'
+
+    def getIcon(self):
+        return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
+
+    def defineCharacteristics(self):
+        self.name = 'Extract network nodes'
+        self.group = 'Geomorf'
+
+        self.addParameter(ParameterVector(self.NETWORK_LAYER,
+            self.tr('Stream network (outlet arc should be selected)'),
+            [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterNumber(self.SNAP_TOLERANCE,
+            self.tr('Snap tolerance for arc endpoints'), 0.0, None, 0.0))
+
+        self.addOutput(OutputVector(self.NODES,
+            self.tr('Network nodes')))
+        self.addOutput(OutputTable(self.RUN_STATISTICS,
+            self.tr('Run statistics')))
+
+    def processAlgorithm(self, progress):
+        network = dataobjects.getObjectFromUri(
+            self.getParameterValue(self.NETWORK_LAYER))
+        tolerance = self.getParameterValue(self.SNAP_TOLERANCE)
+
+        # Ensure that outlet arc is selected
+        if network.selectedFeatureCount() != 1:
+            raise GeoAlgorithmExecutionException(
+                self.tr('Seems outlet arc is not selected. Select outlet '
+                        'arc in the stream network layer and try again.'))
+
+        stats = RunStatistics(progress, 3)
+        stats.stage(self.tr('Reading network...'))
+        fids, startX, startY, endX, endY, length = readEndpoints(network)
+        stats.count('features', len(fids))
+        outletArc = fids.index(network.selectedFeatures()[0].id())
+
+        stats.stage(self.tr('Indexing nodes...'))
+        graph, downNodeId, upNodeId = indexNetwork(startX, startY, endX,
+            endY, outletArc, tolerance)
+
+        # Stream nodes to the output file
+        stats.stage(self.tr('Writing output...'))
+        fields = nodeFields()
+        writer = self.getOutputFromName(self.NODES).getVectorWriter(
+            fields.toList(), QGis.WKBPoint, network.crs())
+
+        for ft in nodeFeatures(graph, downNodeId, upNodeId, fields):
+            writer.addFeature(ft)
+        del writer
+        stats.count('features', graph.nodeCount)
+
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
@@ -4,19 +4,22 @@ import os
 
 from PyQt4.QtGui import QIcon
 
-from qgis.core import NULL, QgsFeatureRequest
-
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.GeoAlgorithmExecutionException import \
     GeoAlgorithmExecutionException
 
 from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterSelection
+from processing.core.parameters import ParameterTableField
 from processing.core.outputs import OutputVector
+from processing.core.outputs import OutputTable
 
 from processing.tools import dataobjects
-from processing.tools import vector
 
 from QGeomorf.tools import *
+from QGeomorf.validation import NetworkError
+from QGeomorf.core import indexNetworkTopology
 
 
 pluginPath = os.path.dirname(__file__)
@@ -24,8 +27,12 @@ pluginPath = os.path.dirname(__file__)
 
 class NodeIndexing(GeoAlgorithm):
     NETWORK_LAYER = 'NETWORK_LAYER'
+    SNAP_TOLERANCE = 'SNAP_TOLERANCE'
+    OUTLETS = 'OUTLETS'
+    OUTLET_FIELD = 'OUTLET_FIELD'
 
     INDEXED = 'INDEXED'
+    RUN_STATISTICS = 'RUN_STATISTICS'
 
     def getIcon(self):
         return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
@@ -37,19 +44,28 @@ class NodeIndexing(GeoAlgorithm):
         self.addParameter(ParameterVector(self.NETWORK_LAYER,
             self.tr('Stream network (outlet arc should be selected)'),
             [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterNumber(self.SNAP_TOLERANCE,
+            self.tr('Snap tolerance for arc endpoints'), 0.0, None, 0.0))
+        self.addParameter(ParameterSelection(self.OUTLETS,
+            self.tr('Outlets'), OUTLET_MODES, 0))
+        self.addParameter(ParameterTableField(self.OUTLET_FIELD,
+            self.tr('Outlet flag field'), self.NETWORK_LAYER,
+            ParameterTableField.DATA_TYPE_ANY, True))
 
         self.addOutput(OutputVector(self.INDEXED,
             self.tr('Network with indexed nodes')))
+        self.addOutput(OutputTable(self.RUN_STATISTICS,
+            self.tr('Run statistics')))
 
     def processAlgorithm(self, progress):
         network = dataobjects.getObjectFromUri(
             self.getParameterValue(self.NETWORK_LAYER))
+        tolerance = self.getParameterValue(self.SNAP_TOLERANCE)
+        outletMode = self.getParameterValue(self.OUTLETS)
+        outletField = self.getParameterValue(self.OUTLET_FIELD)
 
-        # Ensure that outlet arc is selected
-        if network.selectedFeatureCount() != 1:
-            raise GeoAlgorithmExecutionException(
-                self.tr('Seems oulet arc is not selected. Select outlet'
-                        'arc in the stream network layer and try again.'))
+        # Ensure that outlet arcs can be found
+        checkOutlets(network, outletMode, outletField)
 
         # First add new fields to the network layer
         networkProvider = network.dataProvider()
@@ -58,62 +74,64 @@ class NodeIndexing(GeoAlgorithm):
                 network.pendingFields(), 'DownNodeId', QVariant.Int, 10, 0)
         (idxUpNodeId, fieldList) = findOrCreateField(network, fieldList,
                 'UpNodeId', QVariant.Int, 10, 0)
+        (idxBasinId, fieldList) = findOrCreateField(network, fieldList,
+                'BasinId', QVariant.Int, 10, 0)
 
         writer = self.getOutputFromName(self.INDEXED).getVectorWriter(
             fieldList.toList(), networkProvider.geometryType(),
             networkProvider.crs())
 
-        # Generate arc adjacency dictionary
-        # Algorithm at pages 79-80 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Generating arc adjacency dictionary...'))
-        self.arcsPerNode = arcsAadjacencyDictionary(network)
-
-        # Node indexing
-        # Algorithm at pages 80-81 "Automated AGQ4Vector Watershed.pdf"
-        progress.setInfo(self.tr('Indexing nodes...'))
-        self.dwUpNodesId = dict()
-
-        # Outlet arc and its upstream node
-        outletArc = network.selectedFeatures()[0]
-        upNode = outletArc.geometry().asPolyline()[-1]
-
-        # Dictionary for storing node indexes per arc.
-        # For outlet arc we assign -1 for downstream and 0 for upstream nodes
-        self.dwUpNodesId[outletArc.id()] = [-1, 0]
-        # Current node id
-        self.nodeId = 0
-
-        # Start recursive node indexing procedure
-        self.nodeIndexing(outletArc, upNode)
-
-        # Write output file
-        progress.setInfo(self.tr('Writing output...'))
-
-        for f in network.getFeatures():
-            writer.addFeature(f)
+        stats = RunStatistics(progress, 3)
+
+        # Read arc endpoints
+        stats.stage(self.tr('Reading network...'))
+        fids, startX, startY, endX, endY, length, parts = readEndpoints(
+            network, withParts=True)
+        stats.count('features', len(fids))
+        outlets = outletArcs(network, outletMode, outletField, fids)
+
+        # Node indexing, basins are indexed independently
+        # Algorithms at pages 79-81 "Automated AGQ4Vector Watershed.pdf"
+        # Topology of unchanged network is loaded from the cache
+        stats.stage(self.tr('Indexing nodes...'))
+        cacheFile, cacheKey = topologyCache(network, startX, startY, endX,
+            endY, outlets, tolerance)
+        # Defects making the results wrong are found before indexing
+        try:
+            topology, cached = indexNetworkTopology(startX, startY, endX,
+                endY, outlets, tolerance, workerProcesses(), cacheFile,
+                cacheKey, True, parts)
+        except NetworkError as e:
+            raise GeoAlgorithmExecutionException(
+                self.tr('{}. Run Validate network to locate the '
+                        'defects.').format(e))
+        merges = int(topology['merges'])
+        ambiguous = int(topology['ambiguous'])
+        if cached:
+            progress.setInfo(self.tr('Network topology loaded from cache'))
+        if tolerance > 0:
+            progress.setInfo(self.tr('{} endpoint locations snapped to '
+                'neighbouring nodes').format(merges))
+        if ambiguous > 0:
+            progress.setInfo(self.tr('{} parts of the network with more '
+                'than one outlet skipped').format(ambiguous))
+
+        # Write output file with indices set, arcs not connected to the
+        # outlet are left without them, basin is identified by feature id
+        # of its outlet arc
+        stats.stage(self.tr('Writing output...'))
+        connected = topology['upNodeId'] != -1
+        columns = {
+            idxDownNodeId: maskedValues(topology['downNodeId'], connected),
+            idxUpNodeId: maskedValues(topology['upNodeId'], connected),
+            idxBasinId: [fids[b] if b != -1 else None
+                         for b in topology['basin'].tolist()]}
+        lookups = writeNetwork(network, writer, fids, fieldList.count(),
+                               columns)
         del writer
+        cacheOutputTopology(self.getOutputValue(self.INDEXED), topology)
+        stats.count('features', len(fids))
+        stats.count('fidLookups', lookups)
+        stats.count('attrWrites', len(fids))
 
-        vl = QgsVectorLayer(self.getOutputValue(self.INDEXED), 'tmp', 'ogr')
-        provider = vl.dataProvider()
-        for i in self.dwUpNodesId.keys():
-            nodeIds = self.dwUpNodesId[i]
-            attrs = {idxDownNodeId:nodeIds[0], idxUpNodeId:nodeIds[1]}
-            provider.changeAttributeValues({i: attrs})
-
-    def nodeIndexing(self, arc, upNode):
-        if len(self.arcsPerNode[upNode]) != 1:
-            # iterate over arcs connected to given node
-            for f in self.arcsPerNode[upNode]:
-                if f.id() != arc.id():
-                    polyline = f.geometry().asPolyline()
-                    fNode = polyline[0]
-                    tNode = polyline[-1]
-
-                    self.nodeId += 1
-
-                    self.dwUpNodesId[f.id()] = [self.dwUpNodesId[arc.id()][1], self.nodeId]
-
-                    if upNode != fNode:
-                        self.nodeIndexing(f, fNode)
-                    else:
-                        self.nodeIndexing(f, tNode)
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
@@ -11,6 +11,11 @@ from QGeomorf.NodeIndexing import NodeIndexing
 from QGeomorf.ArcUpstreamDownstream import ArcUpstreamDownstream
 from QGeomorf.StrahlerOrder import StrahlerOrder
 from QGeomorf.BifurcationRatios import BifurcationRatios
+from QGeomorf.NetworkNodes import NetworkNodes
+from QGeomorf.Geomorf import Geomorf
+from QGeomorf.ValidateNetwork import ValidateNetwork
+from QGeomorf.ExtractSubnetwork import ExtractSubnetwork
+from QGeomorf.tools import WORKER_PROCESSES, TOPOLOGY_CACHE
 
 
 pluginPath = os.path.dirname(__file__)
@@ -23,15 +28,28 @@ class QGeomorfProvider(AlgorithmProvider):
 
         self.activate = True
 
-        self.alglist = [NodeIndexing(), ArcUpstreamDownstream(), StrahlerOrder(), BifurcationRatios()]
+        self.alglist = [NodeIndexing(), ArcUpstreamDownstream(), StrahlerOrder(), BifurcationRatios(),
+                        NetworkNodes(), Geomorf(), ValidateNetwork(),
+                        ExtractSubnetwork()]
         for alg in self.alglist:
             alg.provider = self
 
     def initializeSettings(self):
         AlgorithmProvider.initializeSettings(self)
+        # Worker count sets the processes building the graph and analysing
+        # basins, the threads measuring geometries and how many features
+        # are read before they are measured
+        ProcessingConfig.addSetting(Setting(self.getDescription(),
+            WORKER_PROCESSES, 'Number of parallel workers (graph building, '
+            'basin analysis, geometry measuring)', 1))
+        ProcessingConfig.addSetting(Setting(self.getDescription(),
+            TOPOLOGY_CACHE, 'Cache network topology next to the layer',
+            True))
 
     def unload(self):
         AlgorithmProvider.unload(self)
+        ProcessingConfig.removeSetting(WORKER_PROCESSES)
+        ProcessingConfig.removeSetting(TOPOLOGY_CACHE)
 
     def getName(self):
         return 'QGeomorf'
@@ -4,19 +4,19 @@ import os
 
 from PyQt4.QtGui import QIcon
 
-from qgis.core import NULL, QgsFeatureRequest
-
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.GeoAlgorithmExecutionException import \
     GeoAlgorithmExecutionException
 
 from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterBoolean
 from processing.core.outputs import OutputVector
+from processing.core.outputs import OutputTable
 
 from processing.tools import dataobjects
-from processing.tools import vector
 
 from QGeomorf.tools import *
+from QGeomorf.core import indexedTopology, topologyOrders
 
 
 pluginPath = os.path.dirname(__file__)
@@ -24,8 +24,12 @@ pluginPath = os.path.dirname(__file__)
 
 class StrahlerOrder(GeoAlgorithm):
     NETWORK_LAYER = 'NETWORK_LAYER'
+    SHREVE = 'SHREVE'
+    HORTON = 'HORTON'
+    HACK = 'HACK'
 
     STRAHLER_ORDER = 'STRAHLER_ORDER'
+    RUN_STATISTICS = 'RUN_STATISTICS'
 
     def getIcon(self):
         return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
@@ -36,67 +40,86 @@ class StrahlerOrder(GeoAlgorithm):
 
         self.addParameter(ParameterVector(self.NETWORK_LAYER,
             self.tr('Stream network'), [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterBoolean(self.SHREVE,
+            self.tr('Calculate Shreve magnitudes'), False))
+        self.addParameter(ParameterBoolean(self.HORTON,
+            self.tr('Calculate Horton orders'), False))
+        self.addParameter(ParameterBoolean(self.HACK,
+            self.tr('Calculate Hack orders'), False))
 
         self.addOutput(OutputVector(
             self.STRAHLER_ORDER, self.tr('Strahler orders')))
+        self.addOutput(OutputTable(
+            self.RUN_STATISTICS, self.tr('Run statistics')))
 
     def processAlgorithm(self, progress):
         network = dataobjects.getObjectFromUri(
             self.getParameterValue(self.NETWORK_LAYER))
-
-        # Ensure that upstream and downstream arc detected
-        idxUpArcId= findField(network, 'UpArcId')
-        if idxUpArcId == -1:
+        shreve = self.getParameterValue(self.SHREVE)
+        horton = self.getParameterValue(self.HORTON)
+        hack = self.getParameterValue(self.HACK)
+
+        # Ensure that nodes already indexed
+        idxDownNodeId = findField(network, 'DownNodeId')
+        idxUpNodeId = findField(network, 'UpNodeId')
+        if idxDownNodeId == -1 or idxUpNodeId == -1:
             raise GeoAlgorithmExecutionException(
-                self.tr('Seems upstream and downstream arcs is not set. '
-                        'Please run corresponding tool and try again.'))
+                self.tr('Seems nodes are not indexed. Please run node '
+                        'indexing tool first and try again.'))
 
         # First add new fields to the network layer
         networkProvider = network.dataProvider()
 
-        (idxStrahler, fieldList) = findOrCreateField(network,
-            network.pendingFields(), 'StrahOrder', QVariant.Int, 10, 0)
+        fieldList = network.pendingFields()
+        fieldNames = [('strahler', 'StrahOrder')]
+        if shreve:
+            fieldNames.append(('shreve', 'ShreveMag'))
+        if horton:
+            fieldNames.append(('horton', 'HortOrder'))
+        if hack:
+            fieldNames.append(('hack', 'HackOrder'))
+
+        fieldIdx = dict()
+        for scheme, name in fieldNames:
+            (fieldIdx[scheme], fieldList) = findOrCreateField(network,
+                fieldList, name, QVariant.Int, 10, 0)
 
         writer = self.getOutputFromName(self.STRAHLER_ORDER).getVectorWriter(
             fieldList.toList(), networkProvider.geometryType(),
             networkProvider.crs())
 
-        # Generate helper dictionaries
-        myNetwork, arcsPerNodeId = makeHelperDictionaries(network)
-
-        # Write output file
-        for f in network.getFeatures():
-            writer.addFeature(f)
+        # Read node indexes
+        stats = RunStatistics(progress, 3)
+        stats.stage(self.tr('Reading network...'))
+        # Main streams of Horton and Hack orders are chosen by length,
+        # geodesic for layers with geographic CRS
+        fids, downNodeId, upNodeId, length = readNodeIds(network,
+            horton or hack, True, layerEllipsoid(network))
+        stats.count('features', len(fids))
+
+        # Calculate all orders in memory in one sweep over the network
+        stats.stage(self.tr('Calculating stream orders...'))
+        cacheFile, cacheKey = nodeIdCache(network.source(), downNodeId,
+                                          upNodeId)
+        topology, cached = indexedTopology(downNodeId, upNodeId, cacheFile,
+                                           cacheKey)
+        if cached:
+            progress.setInfo(self.tr('Network topology loaded from cache'))
+        orders = topologyOrders(topology, length, shreve, horton, hack)
+
+        # Write output file with orders set, arcs not connected to the
+        # outlet get NULL
+        stats.stage(self.tr('Writing output...'))
+        columns = dict((fieldIdx[s], [v if v != -1 else None
+                                      for v in orders[s].tolist()])
+                       for s in fieldIdx)
+        lookups = writeNetwork(network, writer, fids, fieldList.count(),
+                               columns)
         del writer
+        cacheOutputTopology(self.getOutputValue(self.STRAHLER_ORDER),
+                            topology)
+        stats.count('features', len(fids))
+        stats.count('fidLookups', lookups)
+        stats.count('attrWrites', len(fids))
 
-        vl = QgsVectorLayer(self.getOutputValue(self.STRAHLER_ORDER), 'tmp', 'ogr')
-        provider = vl.dataProvider()
-
-        # calculate Strahler orders
-        # Algorithm at pages 65-66 "Automated AGQ4Vector Watershed.pdf"
-        req = QgsFeatureRequest()
-        progress.setInfo(self.tr('Calculating Strahler orders...'))
-        # Iterate over upsteram node ids starting from the last ones
-        # which represents source arcs
-        for nodeId in sorted(myNetwork.keys(), reverse=True):
-            f = vl.getFeatures(req.setFilterFid(myNetwork[nodeId])).next()
-            fid = f.id()
-            upstreamArcs = f['UpArcId']
-            if upstreamArcs == NULL:
-                provider.changeAttributeValues({fid:{idxStrahler: 1}})
-            else:
-                orders = []
-                for i in upstreamArcs.split(','):
-                    f = vl.getFeatures(req.setFilterFid(int(i))).next()
-                    if f['StrahOrder']:
-                        orders.append(f['StrahOrder'])
-                orders.sort(reverse=True)
-                if len(orders) == 1:
-                    order = orders[0]
-                elif len(orders) >= 2:
-                    diff = orders[0] - orders[1]
-                    if diff == 0:
-                        order = orders[0] + 1
-                    else:
-                        order = max([orders[0], orders[1]])
-                provider.changeAttributeValues({fid:{idxStrahler: order}})
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
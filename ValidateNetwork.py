@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from PyQt4.QtGui import QIcon
+
+from qgis.core import QGis
+
+from processing.core.GeoAlgorithm import GeoAlgorithm
+
+from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterSelection
+from processing.core.parameters import ParameterTableField
+from processing.core.outputs import OutputVector
+from processing.core.outputs import OutputTable
+
+from processing.tools import dataobjects
+
+from QGeomorf.tools import *
+from QGeomorf.graph import NetworkGraph
+from QGeomorf.validation import (ARC_PROBLEMS, NODE_PROBLEMS,
+    FATAL_PROBLEMS, validateNetwork)
+
+
+pluginPath = os.path.dirname(__file__)
+
+
+class ValidateNetwork(GeoAlgorithm):
+    NETWORK_LAYER = 'NETWORK_LAYER'
+    SNAP_TOLERANCE = 'SNAP_TOLERANCE'
+    OUTLETS = 'OUTLETS'
+    OUTLET_FIELD = 'OUTLET_FIELD'
+
+    PROBLEM_ARCS = 'PROBLEM_ARCS'
+    PROBLEM_NODES = 'PROBLEM_NODES'
+    RUN_STATISTICS = 'RUN_STATISTICS'
+
+    def getIcon(self):
+        return QIcon(os.path.join(pluginPath, 'icons', 'enea.png'))
+
+    def defineCharacteristics(self):
+        self.name = 'Validate network'
+        self.group = 'Geomorf'
+
+        self.addParameter(ParameterVector(self.NETWORK_LAYER,
+            self.tr('Stream network'), [ParameterVector.VECTOR_TYPE_LINE]))
+        self.addParameter(ParameterNumber(self.SNAP_TOLERANCE,
+            self.tr('Snap tolerance for arc endpoints'), 0.0, None, 0.0))
+        self.addParameter(ParameterSelection(self.OUTLETS,
+            self.tr('Outlets'), OUTLET_MODES, 1))
+        self.addParameter(ParameterTableField(self.OUTLET_FIELD,
+            self.tr('Outlet flag field'), self.NETWORK_LAYER,
+            ParameterTableField.DATA_TYPE_ANY, True))
+
+        self.addOutput(OutputVector(self.PROBLEM_ARCS,
+            self.tr('Arcs with problems')))
+        self.addOutput(OutputVector(self.PROBLEM_NODES,
+            self.tr('Nodes with problems')))
+        self.addOutput(OutputTable(self.RUN_STATISTICS,
+            self.tr('Run statistics')))
+
+    def processAlgorithm(self, progress):
+        network = dataobjects.getObjectFromUri(
+            self.getParameterValue(self.NETWORK_LAYER))
+        tolerance = self.getParameterValue(self.SNAP_TOLERANCE)
+        outletMode = self.getParameterValue(self.OUTLETS)
+        outletField = self.getParameterValue(self.OUTLET_FIELD)
+
+        # Ensure that outlet arcs can be found
+        checkOutlets(network, outletMode, outletField)
+
+        stats = RunStatistics(progress, 3)
+
+        stats.stage(self.tr('Reading network...'))
+        fids, startX, startY, endX, endY, length, parts = readEndpoints(
+            network, withParts=True)
+        stats.count('features', len(fids))
+        outlets = outletArcs(network, outletMode, outletField, fids)
+
+        # Union-find and degree counts, linear in the number of arcs
+        stats.stage(self.tr('Validating network...'))
+        graph = NetworkGraph.fromEndpoints(startX, startY, endX, endY,
+            length, None, tolerance, workerProcesses())
+        problems = validateNetwork(graph, outlets, parts)
+        for problem in ARC_PROBLEMS + NODE_PROBLEMS:
+            if problem in problems:
+                progress.setInfo('{}: {}'.format(problem,
+                                                 len(problems[problem])))
+        if not any(p in problems for p in FATAL_PROBLEMS):
+            progress.setInfo(self.tr('Network can be analysed'))
+
+        # Arcs with several problems are written once for each of them
+        stats.stage(self.tr('Writing output...'))
+        arcProblems = dict()
+        for problem in ARC_PROBLEMS:
+            if problem not in problems:
+                continue
+            for arc in problems[problem].tolist():
+                arcProblems.setdefault(fids[arc], []).append(problem)
+
+        fields = QgsFields()
+        fields.append(QgsField('fid', QVariant.Int, '', 10))
+        fields.append(QgsField('problem', QVariant.String, '', 30))
+        networkProvider = network.dataProvider()
+        writer = self.getOutputFromName(self.PROBLEM_ARCS).getVectorWriter(
+            fields.toList(), networkProvider.geometryType(),
+            networkProvider.crs())
+        req = QgsFeatureRequest()
+        req.setSubsetOfAttributes([])
+        for f in network.getFeatures(req):
+            for problem in arcProblems.get(f.id(), []):
+                ft = QgsFeature(fields)
+                ft.setGeometry(f.geometry())
+                ft['fid'] = f.id()
+                ft['problem'] = problem
+                writer.addFeature(ft)
+                stats.count('features', 1)
+        del writer
+
+        fields = QgsFields()
+        fields.append(QgsField('id', QVariant.Int, '', 10))
+        fields.append(QgsField('problem', QVariant.String, '', 30))
+        writer = self.getOutputFromName(self.PROBLEM_NODES).getVectorWriter(
+            fields.toList(), QGis.WKBPoint, networkProvider.crs())
+        for problem in NODE_PROBLEMS:
+            if problem not in problems:
+                continue
+            for node in problems[problem].tolist():
+                ft = QgsFeature(fields)
+                ft.setGeometry(QgsGeometry.fromPoint(QgsPoint(
+                    float(graph.x[node]), float(graph.y[node]))))
+                ft['id'] = node
+                ft['problem'] = problem
+                writer.addFeature(ft)
+                stats.count('features', 1)
+        del writer
+
+        stats.write(self.getOutputFromName(self.RUN_STATISTICS))
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from QGeomorf.QGeomorfProviderPlugin import QGeomorfProviderPlugin
-
 
 def classFactory(iface):
+    # Imported here, so QGeomorf.core can be used without QGIS
+    from QGeomorf.QGeomorfProviderPlugin import QGeomorfProviderPlugin
     return QGeomorfProviderPlugin()
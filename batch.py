@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+'''Run geomorphic analysis over many stream networks without QGIS.
+
+Each network file is processed by a separate worker: nodes are indexed,
+upstream and downstream arcs and Strahler orders are computed, then order
+frequency, bifurcation and Horton ratio tables of the basin are written to
+the output directory. A summary of all basins is written when all workers
+finish.
+
+Usage:
+    python -m QGeomorf.batch -o OUTPUT [-j JOBS] [--outlet-field NAME |
+        --outlet-fid FID] NETWORK_OR_DIRECTORY...
+
+Networks are read with OGR, so any line format supported by GDAL can be
+used. Outlet arc of each network is the feature with non-zero value in the
+outlet field (the feature with the given id when --outlet-fid is used).
+
+With --scratch networks larger than memory are analysed out of core, their
+arrays are kept in memory-mapped files in the given directory.
+'''
+
+import os
+import csv
+import sys
+import glob
+import argparse
+import traceback
+import multiprocessing
+from array import array
+
+import numpy
+from osgeo import ogr
+
+from QGeomorf.core import analyseNetwork
+from QGeomorf.lengths import measureLines
+from QGeomorf.graph import (orderFrequency, bifurcationRatios, hortonRatios,
+    fitHortonRatios)
+from QGeomorf import outofcore
+
+
+READ_CHUNK_SIZE = 65536
+
+SUMMARY_FIELDS = ['basin', 'path', 'arcs', 'connected', 'maxOrder',
+                  'length', 'Rb', 'Rl', 'error']
+
+
+def openLayer(path):
+    '''Open the first layer of the data source with OGR.
+
+    Data source is returned as well, layer is valid only while the data
+    source exists.
+    '''
+    dataSource = ogr.Open(path)
+    if dataSource is None:
+        raise IOError('Can not open {}'.format(path))
+    return dataSource, dataSource.GetLayer(0)
+
+
+def layerEllipsoid(layer):
+    '''Return ellipsoid of the layer with geographic spatial reference
+    as (semi-major axis, flattening), None for projected layers.
+    '''
+    srs = layer.GetSpatialRef()
+    if srs is None or not srs.IsGeographic():
+        return None
+    inverse = srs.GetInvFlattening()
+    return srs.GetSemiMajor(), 1.0 / inverse if inverse else 0.0
+
+
+def _measuredArcs(wkbs, rows, ellipsoid):
+    startX, startY, endX, endY, length, _ = [values.tolist() for values in
+                                             measureLines(wkbs, ellipsoid)]
+    for i, (fid, outlet) in enumerate(rows):
+        yield (fid, startX[i], startY[i], endX[i], endY[i], length[i],
+               outlet)
+
+
+def readArcs(layer, outletField=None, outletFid=None):
+    '''Iterate over the network arcs.
+
+    Yields feature id, coordinates of the first and last vertices, length
+    and outlet flag of each arc. Geometries are measured in chunks from
+    their WKB as by tools.readEndpoints, lengths of geographic layers are
+    geodesic in meters.
+    '''
+    ellipsoid = layerEllipsoid(layer)
+    wkbs = []
+    rows = []
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        geom = feature.GetGeometryRef()
+        wkbs.append(geom.ExportToWkb(ogr.wkbNDR) if geom is not None
+                    else None)
+
+        if outletFid is not None:
+            outlet = feature.GetFID() == outletFid
+        else:
+            outlet = bool(feature.GetField(outletField))
+        rows.append((feature.GetFID(), outlet))
+
+        if len(wkbs) == READ_CHUNK_SIZE:
+            for record in _measuredArcs(wkbs, rows, ellipsoid):
+                yield record
+            wkbs = []
+            rows = []
+        feature = layer.GetNextFeature()
+
+    for record in _measuredArcs(wkbs, rows, ellipsoid):
+        yield record
+
+
+def readEndpoints(path, outletField=None, outletFid=None):
+    '''Read feature ids, coordinates of the first and last vertices and
+    lengths of the network arcs with OGR.
+
+    Returns the same arrays as tools.readEndpoints and position of the
+    outlet arc, or -1 when it is not found.
+    '''
+    dataSource, layer = openLayer(path)
+
+    fids = array('l')
+    startX = array('d')
+    startY = array('d')
+    endX = array('d')
+    endY = array('d')
+    length = array('d')
+    outletArc = -1
+
+    for fid, sx, sy, ex, ey, arcLength, outlet in readArcs(layer,
+            outletField, outletFid):
+        if outlet:
+            outletArc = len(fids)
+        fids.append(fid)
+        startX.append(sx)
+        startY.append(sy)
+        endX.append(ex)
+        endY.append(ey)
+        length.append(arcLength)
+
+    return fids, startX, startY, endX, endY, length, outletArc
+
+
+def writeTable(path, header, table):
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for k in sorted(table.keys()):
+            writer.writerow([k] + table[k])
+
+
+def analyseInMemory(path, outletField, outletFid, tolerance):
+    '''Analyse the network in memory.
+
+    Returns order frequency, Horton ratios and summary of the network.
+    '''
+    fids, startX, startY, endX, endY, length, outletArc = \
+        readEndpoints(path, outletField, outletFid)
+    if outletArc == -1:
+        raise ValueError('Outlet arc not found')
+
+    params = analyseNetwork(startX, startY, endX, endY, length,
+                            outletArc, tolerance)
+    frequency = orderFrequency(params.upArcOffsets, params.upArcs,
+                               params.strahler)
+    horton = hortonRatios(params.upArcOffsets, params.upArcs,
+                          params.downArc, params.strahler, params.length)
+
+    connected = params.connected()
+    summary = dict(arcs=params.arcCount, connected=len(connected),
+                   maxOrder=int(params.strahler.max()),
+                   length=float(params.length[connected].sum()))
+    return frequency, horton, summary
+
+
+def analyseOutOfCore(path, outletField, outletFid, scratchDir):
+    '''Analyse the network out of core, arcs are streamed from the layer
+    to memory-mapped arrays in the scratch directory.
+
+    Returns order frequency, Horton ratios and summary of the network.
+    '''
+    dataSource, layer = openLayer(path)
+    outlets = []
+
+    def records():
+        for i, record in enumerate(readArcs(layer, outletField, outletFid)):
+            if record[-1]:
+                outlets.append(i)
+            yield record[:-1]
+
+    with outofcore.ScratchArrays(scratchDir) as scratch:
+        fids, startX, startY, endX, endY, length = outofcore.streamArcs(
+            scratch, records(), layer.GetFeatureCount())
+        if len(outlets) == 0:
+            raise ValueError('Outlet arc not found')
+
+        results, frequency, statistics, ambiguous = \
+            outofcore.analyseNetwork(scratch, startX, startY, endX, endY,
+                                     length, outlets)
+
+        summary = dict(arcs=len(fids), connected=0, maxOrder=0, length=0.0)
+        for s in outofcore.chunkSlices(len(fids)):
+            connected = results['upNodeId'][s] != -1
+            summary['connected'] += int(numpy.count_nonzero(connected))
+            summary['length'] += float(length[s][connected].sum())
+        summary['maxOrder'] = max(frequency.keys()) if frequency else 0
+
+    return frequency, fitHortonRatios(statistics), summary
+
+
+def processBasin(task):
+    '''Analyse one network file, return its summary row.
+
+    Errors are reported in the summary so one broken basin does not stop
+    the whole batch.
+    '''
+    path, outputDir, outletField, outletFid, tolerance, scratchDir = task
+    basin = os.path.splitext(os.path.basename(path))[0]
+    summary = dict(basin=basin, path=path)
+
+    try:
+        if scratchDir is None:
+            frequency, horton, values = analyseInMemory(path, outletField,
+                outletFid, tolerance)
+        else:
+            if tolerance > 0:
+                raise ValueError('Snap tolerance is not supported out of '
+                                 'core')
+            frequency, horton, values = analyseOutOfCore(path, outletField,
+                outletFid, scratchDir)
+        ratios = bifurcationRatios(frequency)
+
+        writeTable(os.path.join(outputDir, basin + '_order_frequency.csv'),
+                   ['order', 'N', 'NDU', 'NA'], frequency)
+        writeTable(os.path.join(outputDir, basin + '_bifurcation.csv'),
+                   ['order', 'RBD', 'RB', 'RU'], ratios)
+        writeTable(os.path.join(outputDir, basin + '_horton.csv'),
+                   ['ratio', 'value', 'R2'], horton)
+
+        summary.update(values)
+        summary['Rb'] = horton['Rb'][0]
+        summary['Rl'] = horton['Rl'][0]
+    except Exception as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+        traceback.print_exc()
+
+    return summary
+
+
+def networkFiles(paths, pattern):
+    '''Expand directories to the network files they contain.'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Geomorphic analysis of stream networks')
+    parser.add_argument('networks', nargs='+',
+        help='network files or directories containing them')
+    parser.add_argument('-o', '--output', required=True,
+        help='directory for the output tables')
+    parser.add_argument('-j', '--jobs', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of worker processes')
+    parser.add_argument('-p', '--pattern', default='*.shp',
+        help='pattern of network files in directories')
+    outlet = parser.add_mutually_exclusive_group()
+    outlet.add_argument('--outlet-field', default='Outlet',
+        help='field with non-zero value for the outlet arc')
+    outlet.add_argument('--outlet-fid', type=int,
+        help='feature id of the outlet arc in all networks')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.0,
+        help='snap tolerance for arc endpoints')
+    parser.add_argument('--scratch',
+        help='analyse networks out of core, keeping arrays in this '
+             'directory')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    tasks = [(path, args.output, args.outlet_field, args.outlet_fid,
+              args.tolerance, args.scratch)
+             for path in networkFiles(args.networks, args.pattern)]
+
+    pool = multiprocessing.Pool(max(1, args.jobs))
+    try:
+        summaries = []
+        for summary in pool.imap_unordered(processBasin, tasks):
+            print('{}: {}'.format(summary['basin'],
+                                  summary.get('error', 'done')))
+            summaries.append(summary)
+    finally:
+        pool.close()
+        pool.join()
+
+    summaries.sort(key=lambda s: s['path'])
+    with open(os.path.join(args.output, 'summary.csv'), 'w') as f:
+        writer = csv.DictWriter(f, SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(summaries)
+
+    failed = len([s for s in summaries if 'error' in s])
+    print('{} basins processed, {} failed'.format(len(summaries), failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+'''Benchmark of the network analysis on synthetic drainage networks.
+
+Three kinds of networks are generated:
+
+* binary: balanced binary tree, all sources at the same depth
+* random: uniform random binary tree (Remy's algorithm), all
+  topologically distinct networks with the same number of sources are
+  equally likely, as in Shreve's random topology model
+* comb: long main stem with one source tributary at every confluence
+
+Every stage of the analysis is timed and its peak memory recorded, results
+are written as JSON so they can be compared between revisions.
+
+Usage:
+    python -m QGeomorf.benchmark [-s 1000 10000 ...] [-o results.json]
+'''
+
+import sys
+import json
+import time
+import platform
+import argparse
+
+import numpy
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+from QGeomorf.graph import (NetworkGraph, indexNodes, downstreamArcs,
+    upstreamArcs, lengthUpstream, lengthDownstream, strahlerOrders,
+    orderFrequency)
+
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def binaryParents(count):
+    '''Parent arc of each arc of a balanced binary tree, -1 for outlet.'''
+    parents = (numpy.arange(count, dtype=numpy.int64) - 1) // 2
+    parents[0] = -1
+    return parents
+
+
+def randomParents(count, seed=0):
+    '''Parent arc of each arc of a random binary tree.
+
+    Tree is grown by Remy's algorithm: arc chosen uniformly among all arcs
+    is moved upstream of a new confluence, joined there by a new source.
+    Arcs are numbered breadth-first from the outlet.
+    '''
+    rnd = numpy.random.RandomState(seed)
+    picks = rnd.random_sample(max((count + 1) // 2 - 1, 0))
+
+    parent = [-1]
+    for p in picks.tolist():
+        arc = int(p * len(parent))
+        joint = len(parent)
+        parent.append(parent[arc])
+        parent.append(joint)
+        parent[arc] = joint
+
+    # Outlet may change while growing, arcs are renumbered from it
+    children = [[] for _ in parent]
+    order = []
+    for arc, p in enumerate(parent):
+        if p == -1:
+            order.append(arc)
+        else:
+            children[p].append(arc)
+    i = 0
+    while i < len(order):
+        order.extend(children[order[i]])
+        i += 1
+    newId = [0] * len(parent)
+    for i, arc in enumerate(order):
+        newId[arc] = i
+
+    parents = numpy.empty(count, dtype=numpy.int64)
+    parents[:len(order)] = [newId[parent[arc]] if parent[arc] != -1 else -1
+                            for arc in order]
+
+    # Last arc of even-sized network continues the first source
+    if len(order) < count:
+        parents[len(order)] = next(i for i, arc in enumerate(order)
+                                   if not children[arc])
+    return parents
+
+
+def combParents(count):
+    '''Parent arc of each arc of a comb network.
+
+    Even arcs form the main stem, odd arcs are tributaries joining it.
+    '''
+    arcs = numpy.arange(count, dtype=numpy.int64)
+    parents = arcs - 2 + arcs % 2
+    parents[0] = -1
+    return parents
+
+
+def networkEndpoints(parents, seed=0):
+    '''Endpoints and lengths of the arcs of a network given as parents.
+
+    Upstream node of arc i is node i + 1, outlet node is node 0. Nodes are
+    placed on a jittered grid, arcs are shuffled and some of them are
+    digitized upstream to downstream, as in real layers. Returns endpoint
+    arrays, lengths and position of the outlet arc.
+    '''
+    count = len(parents)
+    rnd = numpy.random.RandomState(seed)
+
+    width = int(numpy.ceil(numpy.sqrt(count + 1)))
+    nodes = numpy.arange(count + 1)
+    x = (nodes % width) * 100.0 + rnd.random_sample(count + 1) * 50.0
+    y = (nodes // width) * 100.0 + rnd.random_sample(count + 1) * 50.0
+
+    downNode = parents + 1
+    upNode = numpy.arange(1, count + 1)
+    flip = rnd.random_sample(count) < 0.3
+    startNode = numpy.where(flip, upNode, downNode)
+    endNode = numpy.where(flip, downNode, upNode)
+
+    # Outlet arc must end at its upstream node
+    startNode[0] = downNode[0]
+    endNode[0] = upNode[0]
+
+    order = rnd.permutation(count)
+    startNode = startNode[order]
+    endNode = endNode[order]
+    length = numpy.hypot(x[endNode] - x[startNode],
+                         y[endNode] - y[startNode])
+    outletArc = int(numpy.flatnonzero(order == 0)[0])
+    return (x[startNode], y[startNode], x[endNode], y[endNode], length,
+            outletArc)
+
+
+GENERATORS = {
+    'binary': binaryParents,
+    'random': randomParents,
+    'comb': combParents,
+}
+
+
+class StageTimer(object):
+    '''Collect wall time of the benchmark stages.'''
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.stages.append((name, time.time() - start))
+        return result
+
+
+class MemoryTracer(StageTimer):
+    '''Collect peak memory allocated by the benchmark stages.
+
+    Tracing slows down allocations, so it is done in a separate run.
+    '''
+
+    def run(self, name, func, *args):
+        if tracemalloc is not None:
+            tracemalloc.start()
+            result = func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            # Peak resident size of the whole process, kilobytes on Linux
+            result = func(*args)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.stages.append((name, peak))
+        return result
+
+
+def analyse(timer, startX, startY, endX, endY, length, outletArc):
+    '''Run all stages of the analysis, return Strahler orders.'''
+    graph = timer.run('adjacency', NetworkGraph.fromEndpoints,
+                      startX, startY, endX, endY, length)
+    downNodeId, upNodeId = timer.run('nodeIndexing', indexNodes,
+                                     graph, outletArc)
+
+    indexed = NetworkGraph.fromNodeIds(downNodeId, upNodeId, length)
+    downArc = timer.run('downstreamArcs', downstreamArcs, indexed)
+    offsets, upArcs = timer.run('upstreamArcs', upstreamArcs, downArc)
+    timer.run('lengthUp', lengthUpstream, indexed)
+    timer.run('lengthDown', lengthDownstream, indexed)
+    strahler = timer.run('strahler', strahlerOrders, indexed)
+    timer.run('orderFrequency', orderFrequency, offsets, upArcs, strahler)
+    return strahler
+
+
+def runBenchmark(kind, count, seed=0):
+    '''Time all stages of the analysis on one synthetic network.'''
+    network = networkEndpoints(GENERATORS[kind](count), seed)
+
+    timer = StageTimer()
+    strahler = analyse(timer, *network)
+    tracer = MemoryTracer()
+    analyse(tracer, *network)
+
+    stages = [dict(stage=name, seconds=seconds, peakBytes=peak)
+              for (name, seconds), (_, peak) in zip(timer.stages,
+                                                    tracer.stages)]
+    return dict(network=kind, arcs=count, maxOrder=int(strahler.max()),
+                stages=stages,
+                totalSeconds=sum(s['seconds'] for s in stages))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the network analysis stages')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+        default=DEFAULT_SIZES, help='number of arcs of the networks')
+    parser.add_argument('-n', '--networks', nargs='+',
+        choices=sorted(GENERATORS.keys()), default=sorted(GENERATORS.keys()),
+        help='kinds of networks to generate')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+        help='JSON file for the results')
+    args = parser.parse_args(argv)
+
+    results = []
+    for kind in args.networks:
+        for count in args.sizes:
+            result = runBenchmark(kind, count)
+            print('{:>8} {:>9} arcs {:>9.3f} s'.format(
+                kind, count, result['totalSeconds']))
+            results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(python=platform.python_version(),
+                       numpy=numpy.__version__,
+                       platform=platform.platform(),
+                       results=results), f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
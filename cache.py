@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+'''Persistent cache of the network topology.
+
+Node ids, basins, downstream arcs and topological order of the arcs
+computed for a network are stored in a sidecar file next to the network
+source, so later runs on the unchanged network load them instead of
+rebuilding the graph. Lengths are not stored, they depend on how the arcs
+are measured and are calculated from the topology by every run.
+
+Topology of a network read from geometries is keyed by the source URI,
+feature count and a hash of the arc endpoints, any edit moving the
+endpoints makes the cache stale and it is rebuilt. Topology of a network
+with indexed nodes is keyed by a hash of its node ids, so it is found
+again in the outputs of the tools writing the same ids.
+'''
+
+import os
+import hashlib
+
+import numpy
+
+
+CACHE_SUFFIX = '.qgeomorf.npz'
+CACHE_VERSION = 2
+
+
+def cachePath(source):
+    '''Return path of the cache file of the layer source, None when the
+    source is not a local file.
+    '''
+    path = source.split('|')[0]
+    if not os.path.isfile(path):
+        return None
+    return path + CACHE_SUFFIX
+
+
+def networkKey(source, startX, startY, endX, endY, outletArcs=None,
+               tolerance=0.0):
+    '''Return key of the network for its cache file.
+
+    Topology depends only on the arc endpoints, so they are hashed instead
+    of the whole geometries. Outlets and snap tolerance change the
+    topology too and are part of the key.
+    '''
+    digest = hashlib.sha1()
+    digest.update(repr((CACHE_VERSION, source, len(startX),
+                        float(tolerance))).encode('utf-8'))
+    for values in (startX, startY, endX, endY):
+        digest.update(numpy.ascontiguousarray(values, dtype=numpy.float64))
+    if outletArcs is None:
+        digest.update(b'free ends')
+    else:
+        digest.update(numpy.ascontiguousarray(outletArcs, dtype=numpy.int64))
+    return digest.hexdigest()
+
+
+def nodeIdKey(downNodeId, upNodeId):
+    '''Return key of the network with indexed nodes for its cache file.
+
+    Downstream arcs and topological order follow from the node ids alone,
+    the key does not depend on the source.
+    '''
+    digest = hashlib.sha1()
+    digest.update(repr((CACHE_VERSION, len(upNodeId))).encode('utf-8'))
+    for values in (downNodeId, upNodeId):
+        digest.update(numpy.ascontiguousarray(values, dtype=numpy.int64))
+    return digest.hexdigest()
+
+
+def loadTopology(path, key):
+    '''Load arrays stored in the cache file.
+
+    Returns dictionary of arrays, None when cache file does not exist, is
+    not readable or was written for another network.
+    '''
+    if path is None or not os.path.isfile(path):
+        return None
+
+    try:
+        data = numpy.load(path)
+        try:
+            if str(data['key']) != key:
+                return None
+            return dict((name, data[name]) for name in data.files
+                        if name != 'key')
+        finally:
+            data.close()
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def saveTopology(path, key, **arrays):
+    '''Store arrays in the cache file.
+
+    Cache is written to a temporary file first, so an interrupted run does
+    not leave broken cache behind. Returns False when the file can not be
+    written, the cache is optional and the analysis goes on without it.
+    '''
+    if path is None:
+        return False
+
+    temp = path + '.tmp'
+    try:
+        with open(temp, 'wb') as f:
+            numpy.savez(f, key=numpy.array(key), **arrays)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        if os.path.exists(temp):
+            os.remove(temp)
+        return False
+    return True
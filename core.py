@@ -0,0 +1,723 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+
+import numpy
+
+from QGeomorf.graph import (NetworkGraph, indexNodes, componentLabels,
+    outletCandidates, downstreamArcs, upstreamArcs, arcLengthUpstream,
+    arcLengthDownstream, arcStreamOrders, nodeIndexes, FlowIndex)
+from QGeomorf.cache import loadTopology, saveTopology
+from QGeomorf.validation import checkNetwork
+
+
+class NetworkParameters(object):
+    '''Geomorphic parameters of the stream network arcs.
+
+    All arrays are aligned with the arcs passed to the analysis. Arcs not
+    connected to the outlet have -1 node ids, downstream arc and Strahler
+    order and NaN lengths upstream and downstream. Arcs located directly
+    upstream of arc i are upArcs[upArcOffsets[i]:upArcOffsets[i + 1]].
+    '''
+
+    def __init__(self, downNodeId, upNodeId, length):
+        count = len(upNodeId)
+        self.downNodeId = downNodeId
+        self.upNodeId = upNodeId
+        self.length = length
+
+        self.downArc = numpy.empty(count, dtype=numpy.int64)
+        self.downArc.fill(-1)
+        self.upArcOffsets = numpy.zeros(count + 1, dtype=numpy.int64)
+        self.upArcs = numpy.zeros(0, dtype=numpy.int64)
+        self.lengthUp = numpy.empty(count, dtype=numpy.float64)
+        self.lengthUp.fill(numpy.nan)
+        self.lengthDown = self.lengthUp.copy()
+        self.strahler = numpy.empty(count, dtype=numpy.int64)
+        self.strahler.fill(-1)
+
+    @property
+    def arcCount(self):
+        return len(self.upNodeId)
+
+    def connected(self):
+        '''Return indexes of the arcs connected to the outlet.'''
+        return numpy.flatnonzero(self.upNodeId != -1)
+
+    def upstreamOf(self, arc):
+        return self.upArcs[self.upArcOffsets[arc]:self.upArcOffsets[arc + 1]]
+
+
+def indexNetwork(startX, startY, endX, endY, outletArc, tolerance=0.0,
+                 length=None):
+    '''Build network graph from arc endpoints and index its nodes.
+
+    Arc i starts at (startX[i], startY[i]) and ends at (endX[i], endY[i]),
+    end of the outlet arc is its upstream node. Returns network graph and
+    downstream and upstream node ids of each arc.
+    '''
+    graph = NetworkGraph.fromEndpoints(startX, startY, endX, endY, length,
+                                       None, tolerance)
+    downNodeId, upNodeId = indexNodes(graph, outletArc)
+    return graph, downNodeId, upNodeId
+
+
+def _indexBasin(task):
+    fromNode, toNode, outletArc = task
+    return indexNodes(NetworkGraph(fromNode, toNode), outletArc)
+
+
+def _analyseBasin(task):
+    fromNode, toNode, outletArc, length = task
+    downNodeId, upNodeId = indexNodes(NetworkGraph(fromNode, toNode),
+                                      outletArc)
+    params = analyseIndexed(downNodeId, upNodeId, length)
+    return (downNodeId, upNodeId, params.downArc, params.lengthUp,
+            params.lengthDown, params.strahler)
+
+
+def _basinTasks(graph, outletArcs):
+    '''Split the network graph into basins.
+
+    Returns outlet arcs of the basins, arcs of each basin, task with local
+    fromNode, toNode and outlet arc of each basin and number of connected
+    parts skipped because they contain more than one outlet.
+    '''
+    arcLabel = componentLabels(graph)[graph.fromNode]
+
+    # Arcs of each connected part are contiguous in parts array
+    parts = numpy.argsort(arcLabel, kind='mergesort')
+    partSize = numpy.bincount(arcLabel, minlength=graph.nodeCount)
+    partStart = numpy.concatenate(([0], numpy.cumsum(partSize)))
+
+    outletCount = numpy.bincount(arcLabel[outletArcs],
+                                 minlength=graph.nodeCount)
+    ambiguous = int(numpy.count_nonzero(outletCount > 1))
+    outletArcs = outletArcs[outletCount[arcLabel[outletArcs]] == 1]
+
+    tasks = []
+    basinArcs = []
+    for outlet in outletArcs.tolist():
+        label = arcLabel[outlet]
+        arcs = parts[partStart[label]:partStart[label + 1]]
+        ids, nodes = numpy.unique(numpy.concatenate(
+            (graph.fromNode[arcs], graph.toNode[arcs])), return_inverse=True)
+        tasks.append((nodes[:len(arcs)], nodes[len(arcs):],
+                      int(numpy.searchsorted(arcs, outlet))))
+        basinArcs.append(arcs)
+    return outletArcs, basinArcs, tasks, ambiguous
+
+
+def _mapBasins(func, tasks, processes):
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(func, tasks,
+                            max(1, len(tasks) // (4 * processes)))
+        finally:
+            pool.close()
+            pool.join()
+    return [func(t) for t in tasks]
+
+
+def indexBasins(graph, outletArcs, processes=1):
+    '''Index nodes of all basins of the network graph.
+
+    Every connected part of the network containing exactly one of the
+    outlet arcs is a basin, basins are indexed independently, by a pool
+    of worker processes when processes is greater than one. Node ids are
+    unique in the whole network: first basin is numbered as by
+    indexNodes, outlet nodes of the other basins get the ids following
+    the last id of the previous basin.
+
+    Returns downstream and upstream node ids and outlet of each arc (-1
+    for arcs not in any basin) and number of connected parts skipped
+    because they contain more than one outlet.
+    '''
+    outletArcs = numpy.unique(numpy.asarray(outletArcs, dtype=numpy.int64))
+    if len(outletArcs) == 1:
+        outlet = int(outletArcs[0])
+        downNodeId, upNodeId = indexNodes(graph, outlet)
+        basin = numpy.where(upNodeId != -1, outlet, -1)
+        return downNodeId, upNodeId, basin, 0
+
+    outletArcs, basinArcs, tasks, ambiguous = _basinTasks(graph, outletArcs)
+    results = _mapBasins(_indexBasin, tasks, processes)
+
+    downNodeId = numpy.empty(graph.arcCount, dtype=numpy.int64)
+    downNodeId.fill(-1)
+    upNodeId = downNodeId.copy()
+    basin = downNodeId.copy()
+
+    shift = 0
+    for outlet, arcs, (down, up) in zip(outletArcs.tolist(), basinArcs,
+                                        results):
+        downNodeId[arcs] = down + shift
+        upNodeId[arcs] = up + shift
+        basin[arcs] = outlet
+        shift = int(upNodeId[arcs].max()) + 2
+
+    return downNodeId, upNodeId, basin, ambiguous
+
+
+def analyseBasins(graph, outletArcs, processes=1):
+    '''Index nodes of all basins of the network graph and calculate
+    their parameters.
+
+    Basins and node ids are as for indexBasins, each worker process
+    indexes a basin and calculates downstream arcs, lengths and Strahler
+    orders of it, so the whole analysis of a basin runs in one worker.
+    Returns network parameters, outlet of each arc and number of
+    connected parts skipped because they contain more than one outlet.
+    '''
+    outletArcs = numpy.unique(numpy.asarray(outletArcs, dtype=numpy.int64))
+    if len(outletArcs) == 1:
+        outlet = int(outletArcs[0])
+        downNodeId, upNodeId = indexNodes(graph, outlet)
+        basin = numpy.where(upNodeId != -1, outlet, -1)
+        return analyseIndexed(downNodeId, upNodeId, graph.length), basin, 0
+
+    outletArcs, basinArcs, tasks, ambiguous = _basinTasks(graph, outletArcs)
+    tasks = [task + (graph.length[arcs],)
+             for task, arcs in zip(tasks, basinArcs)]
+    results = _mapBasins(_analyseBasin, tasks, processes)
+
+    downNodeId = numpy.empty(graph.arcCount, dtype=numpy.int64)
+    downNodeId.fill(-1)
+    params = NetworkParameters(downNodeId, downNodeId.copy(), graph.length)
+    basin = downNodeId.copy()
+
+    shift = 0
+    for outlet, arcs, result in zip(outletArcs.tolist(), basinArcs,
+                                    results):
+        down, up, downArc, lengthUp, lengthDown, strahler = result
+        params.downNodeId[arcs] = down + shift
+        params.upNodeId[arcs] = up + shift
+        params.downArc[arcs] = numpy.where(downArc != -1, arcs[downArc], -1)
+        params.lengthUp[arcs] = lengthUp
+        params.lengthDown[arcs] = lengthDown
+        params.strahler[arcs] = strahler
+        basin[arcs] = outlet
+        shift = int(params.upNodeId[arcs].max()) + 2
+
+    params.upArcOffsets, params.upArcs = upstreamArcs(params.downArc)
+    return params, basin, ambiguous
+
+
+def indexNetworkBasins(startX, startY, endX, endY, outletArcs=None,
+                       tolerance=0.0, length=None, processes=1, check=False,
+                       parts=None):
+    '''Build network graph from arc endpoints and index nodes of all its
+    basins.
+
+    When outletArcs is None, arcs starting at endpoints not shared with
+    other arcs are used as outlets. Graph building and basin indexing use
+    the same number of worker processes. When check is True the graph is
+    validated before indexing and validation.NetworkError raised for
+    defects making the results wrong, parts is number of parts of the arc
+    geometries (see validation.validateNetwork). Returns network graph and
+    results of indexBasins.
+    '''
+    graph = NetworkGraph.fromEndpoints(startX, startY, endX, endY, length,
+                                       None, tolerance, processes)
+    if check:
+        checkNetwork(graph, outletArcs, parts)
+    if outletArcs is None:
+        outletArcs = outletCandidates(graph)
+    downNodeId, upNodeId, basin, ambiguous = indexBasins(graph, outletArcs,
+                                                         processes)
+    return graph, downNodeId, upNodeId, basin, ambiguous
+
+
+def _connectArcs(params):
+    '''Find downstream and upstream arcs from the node ids.
+
+    Returns indexes of the connected arcs and graph built from them, arc
+    ids of the graph are positions of the arcs in the parameter arrays.
+    '''
+    arcs = params.connected()
+    indexed = NetworkGraph.fromNodeIds(params.downNodeId[arcs],
+        params.upNodeId[arcs], params.length[arcs], arcs)
+
+    downArc = downstreamArcs(indexed)
+    params.downArc[arcs] = numpy.where(downArc != -1, arcs[downArc], -1)
+    params.upArcOffsets, params.upArcs = upstreamArcs(params.downArc)
+    return arcs, indexed
+
+
+def networkTopology(params, basin=None, ambiguous=0, merges=0):
+    '''Return topology of the network with found downstream arcs.
+
+    Topology is a dictionary with node ids, downstream arcs and connected
+    arcs ordered from outlet to sources, as stored in the topology cache.
+    Basins, number of skipped parts and number of snapped endpoints are
+    added when the network was indexed from its endpoints.
+    '''
+    arcs = params.connected()
+    order = arcs[numpy.argsort(params.upNodeId[arcs], kind='mergesort')]
+    topology = dict(downNodeId=params.downNodeId, upNodeId=params.upNodeId,
+                    downArc=params.downArc, order=order)
+    if basin is not None:
+        topology.update(basin=basin, ambiguous=ambiguous, merges=merges)
+    return topology
+
+
+def _cachedTopology(cacheFile, cacheKey, count):
+    if cacheFile is None:
+        return None
+    topology = loadTopology(cacheFile, cacheKey)
+    if topology is None or len(topology['upNodeId']) != count:
+        return None
+    return topology
+
+
+def indexedTopology(downNodeId, upNodeId, cacheFile=None, cacheKey=None):
+    '''Find downstream arcs and topological order of the network with
+    indexed nodes, using topology cache when it is given.
+
+    cacheKey is key of the node ids (see cache.nodeIdKey). Returns
+    topology (see networkTopology) and whether it was loaded from the
+    cache.
+    '''
+    downNodeId = numpy.asarray(downNodeId, dtype=numpy.int64)
+    upNodeId = numpy.asarray(upNodeId, dtype=numpy.int64)
+    topology = _cachedTopology(cacheFile, cacheKey, len(upNodeId))
+    if topology is not None:
+        return topology, True
+
+    params = NetworkParameters(downNodeId, upNodeId,
+                               numpy.zeros(len(upNodeId), numpy.float64))
+    _connectArcs(params)
+    topology = networkTopology(params)
+    if cacheFile is not None:
+        saveTopology(cacheFile, cacheKey, **topology)
+    return topology, False
+
+
+def _topologyLength(topology, length):
+    if length is None:
+        return numpy.zeros(len(topology['upNodeId']), dtype=numpy.float64)
+    return numpy.asarray(length, dtype=numpy.float64)
+
+
+def topologyParameters(topology, length=None):
+    '''Calculate parameters of the network from its topology (see
+    networkTopology) and lengths of the arcs.
+
+    Only lengths depend on how the arcs were measured, so they are always
+    calculated here and never cached.
+    '''
+    length = _topologyLength(topology, length)
+    params = NetworkParameters(topology['downNodeId'], topology['upNodeId'],
+                               length)
+    params.downArc = topology['downArc']
+    params.upArcOffsets, params.upArcs = upstreamArcs(params.downArc)
+
+    arcs = params.connected()
+    params.lengthUp[arcs] = arcLengthUpstream(params.downArc, length)[arcs]
+    params.lengthDown[arcs] = arcLengthDownstream(params.downArc,
+                                                  length)[arcs]
+    params.strahler[arcs] = arcStreamOrders(params.downArc,
+        topology['order'], length)['strahler'][arcs]
+    return params
+
+
+def topologyOrders(topology, length=None, shreve=False, horton=False,
+                   hack=False):
+    '''Calculate stream orders of the network from its topology (see
+    networkTopology).
+
+    See graph.arcStreamOrders for the ordering schemes. Returns dictionary
+    with scheme name as key and array of orders aligned with the node ids
+    as value, arcs not connected to the outlet get -1.
+    '''
+    length = _topologyLength(topology, length)
+    connected = topology['upNodeId'] != -1
+    orders = arcStreamOrders(topology['downArc'], topology['order'], length,
+                             shreve, horton, hack)
+    for values in orders.values():
+        values[~connected] = -1
+    return orders
+
+
+def analyseIndexed(downNodeId, upNodeId, length=None):
+    '''Calculate parameters of the network with indexed nodes.
+
+    Arcs with -1 upstream node id are treated as not connected to the
+    outlet and skipped.
+    '''
+    topology, _ = indexedTopology(downNodeId, upNodeId)
+    return topologyParameters(topology, length)
+
+
+def orderIndexed(downNodeId, upNodeId, length=None, shreve=False,
+                 horton=False, hack=False):
+    '''Calculate stream orders of the network with indexed nodes.
+
+    See topologyOrders for the result.
+    '''
+    topology, _ = indexedTopology(downNodeId, upNodeId)
+    return topologyOrders(topology, length, shreve, horton, hack)
+
+
+def flowIndex(downNodeId, upNodeId, length=None):
+    '''Build graph.FlowIndex of the network with indexed nodes.
+
+    Index is aligned with the input arrays, arcs not connected to the
+    outlet are indexed as basins of their own.
+    '''
+    downNodeId = numpy.asarray(downNodeId, dtype=numpy.int64)
+    upNodeId = numpy.asarray(upNodeId, dtype=numpy.int64)
+    if length is None:
+        length = numpy.zeros(len(upNodeId), dtype=numpy.float64)
+    else:
+        length = numpy.asarray(length, dtype=numpy.float64)
+
+    params = NetworkParameters(downNodeId, upNodeId, length)
+    _connectArcs(params)
+    return FlowIndex(params.downArc, length)
+
+
+def analyseNetwork(startX, startY, endX, endY, length, outletArc,
+                   tolerance=0.0):
+    '''Calculate node ids, upstream and downstream arcs, lengths upstream
+    and downstream and Strahler orders of the network arcs.
+
+    See indexNetwork for description of the arguments.
+    '''
+    graph, downNodeId, upNodeId = indexNetwork(startX, startY, endX, endY,
+        outletArc, tolerance, length)
+    return analyseIndexed(downNodeId, upNodeId, graph.length)
+
+
+def indexNetworkTopology(startX, startY, endX, endY, outletArcs=None,
+                         tolerance=0.0, processes=1, cacheFile=None,
+                         cacheKey=None, check=False, parts=None):
+    '''Index nodes of all basins and find downstream arcs, using topology
+    cache when it is given.
+
+    Arguments are as for analyseNetworkBasins, lengths of the arcs are not
+    needed. Returns topology (see networkTopology) and whether it was
+    loaded from the cache.
+    '''
+    topology = _cachedTopology(cacheFile, cacheKey, len(startX))
+    if topology is not None:
+        return topology, True
+
+    graph, downNodeId, upNodeId, basin, ambiguous = indexNetworkBasins(
+        startX, startY, endX, endY, outletArcs, tolerance, None, processes,
+        check, parts)
+    params = NetworkParameters(downNodeId, upNodeId, graph.length)
+    _connectArcs(params)
+    topology = networkTopology(params, basin, ambiguous, graph.merges)
+    if cacheFile is not None:
+        saveTopology(cacheFile, cacheKey, **topology)
+    return topology, False
+
+
+def analyseNetworkBasins(startX, startY, endX, endY, length,
+                         outletArcs=None, tolerance=0.0, processes=1,
+                         cacheFile=None, cacheKey=None, check=False,
+                         parts=None):
+    '''Index nodes of all basins and calculate parameters of the network,
+    using topology cache when it is given.
+
+    Arguments are as for indexNetworkBasins, cacheFile and cacheKey are
+    path of the cache file and key of the network (see cache.networkKey).
+    Topology found in the cache under the same key is used with the given
+    lengths, otherwise the network is checked when check is True,
+    analysed and its topology cached. Returns network parameters, basin of
+    each arc, number of skipped parts with more than one outlet, number of
+    snapped endpoints and whether topology was loaded from the cache.
+    '''
+    topology = _cachedTopology(cacheFile, cacheKey, len(length))
+    if topology is not None:
+        return (topologyParameters(topology, length), topology['basin'],
+                int(topology['ambiguous']), int(topology['merges']), True)
+
+    # Basins are indexed and analysed by the same worker processes
+    graph = NetworkGraph.fromEndpoints(startX, startY, endX, endY, length,
+                                       None, tolerance, processes)
+    if check:
+        checkNetwork(graph, outletArcs, parts)
+    if outletArcs is None:
+        outletArcs = outletCandidates(graph)
+    params, basin, ambiguous = analyseBasins(graph, outletArcs, processes)
+    if cacheFile is not None:
+        saveTopology(cacheFile, cacheKey, **networkTopology(params, basin,
+                     ambiguous, graph.merges))
+    return params, basin, ambiguous, graph.merges, False
+
+
+def topologyChanged(graph, downNodeId, upNodeId, basin):
+    '''Check whether node ids stored by the previous run still describe
+    the network graph.
+
+    basin holds index of the outlet arc of each arc (-1 for arcs not
+    connected). Topology is considered changed when ids of connected arcs
+    do not match their endpoints, when arcs without ids touch connected
+    nodes or when an arc without downstream arc is not an outlet, as
+    happens when an arc with upstream arcs is deleted.
+    '''
+    connected = upNodeId != -1
+    if not numpy.array_equal(connected, basin != -1):
+        return True
+
+    ids = upNodeId[connected]
+    if len(ids) == 0:
+        return False
+    if len(numpy.unique(ids)) != len(ids) or ids.min() < 0 or \
+            downNodeId[connected].min() < -1 or \
+            downNodeId[connected].max() > ids.max():
+        return True
+
+    nodeId, nextNodeId, known, outlet = nodeIndexes(graph, downNodeId,
+                                                    upNodeId)
+    fromId = nodeId[graph.fromNode]
+    toId = nodeId[graph.toNode]
+    matched = ((fromId == downNodeId) & (toId == upNodeId)) | \
+        ((fromId == upNodeId) & (toId == downNodeId))
+    if not matched[connected].all():
+        return True
+
+    touching = known[graph.fromNode] | known[graph.toNode]
+    if touching[~connected].any():
+        return True
+
+    params = NetworkParameters(downNodeId, upNodeId, graph.length)
+    _connectArcs(params)
+    outlets = numpy.flatnonzero(connected & (params.downArc == -1))
+    return not numpy.array_equal(basin[outlets], outlets)
+
+
+def _storedTopology(startX, startY, endX, endY, downNodeId, upNodeId,
+                    basin):
+    '''Confirm that node ids stored by the previous run still describe
+    the arc endpoints, without building the network graph.
+
+    Downstream arcs are found from the ids, direction of every arc from
+    the endpoint it shares with its downstream arc. Node
+    coordinates are then scattered from the arc endpoints and compared
+    back, so only the node coordinates are sorted, to find nodes sharing
+    a location. Returns downstream arc of each arc when the topology is
+    unchanged, None when it can not be confirmed.
+    '''
+    count = len(upNodeId)
+    connected = upNodeId != -1
+    if not connected.any() or \
+            not numpy.array_equal(connected, basin != -1):
+        return None
+    arcs = numpy.flatnonzero(connected)
+    down = downNodeId[arcs]
+    up = upNodeId[arcs]
+    if up.min() < 0 or down.min() < -1:
+        return None
+    maxId = int(max(up.max(), down.max()))
+    if maxId > 4 * count + 16 or \
+            numpy.bincount(up, minlength=maxId + 1).max() > 1:
+        return None
+
+    # Node id -1 is the outlet node of the first basin, ids are shifted
+    arcByUpId = numpy.empty(maxId + 2, dtype=numpy.int64)
+    arcByUpId.fill(-1)
+    arcByUpId[up + 1] = arcs
+    downArc = numpy.empty(count, dtype=numpy.int64)
+    downArc.fill(-1)
+    downArc[arcs] = arcByUpId[down + 1]
+    outlets = arcs[downArc[arcs] == -1]
+    if not numpy.array_equal(basin[outlets], outlets):
+        return None
+
+    # Arc is reversed when its start is not shared with the downstream
+    # arc, outlet arcs start at the outlet as for node indexing. Wrong
+    # guesses are caught by the comparison below.
+    start = startX + 1j * startY
+    end = endX + 1j * endY
+    children = arcs[downArc[arcs] != -1]
+    parents = downArc[children]
+    flipped = numpy.zeros(count, dtype=bool)
+    flipped[children] = (start[children] != start[parents]) & \
+        (start[children] != end[parents])
+    downAt = numpy.where(flipped, end, start)[arcs]
+    upAt = numpy.where(flipped, start, end)[arcs]
+
+    nodes = numpy.empty(maxId + 2, dtype=numpy.complex128)
+    nodes.fill(numpy.nan)
+    nodes[down + 1] = downAt
+    nodes[up + 1] = upAt
+    if not ((nodes[down + 1] == downAt) & (nodes[up + 1] == upAt)).all():
+        return None
+
+    # Distinct nodes must not share a location and unindexed arcs must
+    # not touch the indexed network
+    nodes = numpy.sort(nodes[~numpy.isnan(nodes)])
+    if (nodes[1:] == nodes[:-1]).any():
+        return None
+    free = numpy.flatnonzero(~connected)
+    if len(free) > 0:
+        ends = numpy.concatenate((start[free], end[free]))
+        pos = numpy.minimum(numpy.searchsorted(nodes, ends), len(nodes) - 1)
+        if (nodes[pos] == ends).any():
+            return None
+    return downArc
+
+
+def _expectedValues(params):
+    '''Calculate Strahler order, length upstream and length downstream
+    of every arc from the stored values of its neighbours.
+    '''
+    count = params.arcCount
+    children = numpy.flatnonzero(params.downArc != -1)
+    parents = params.downArc[children]
+
+    maxUp = numpy.zeros(count, dtype=numpy.float64)
+    numpy.maximum.at(maxUp, parents, params.lengthUp[children])
+    lengthUp = params.length + maxUp
+
+    lengthDown = numpy.zeros(count, dtype=numpy.float64)
+    lengthDown[children] = params.length[children] + \
+        params.lengthDown[parents]
+
+    maxOrder = numpy.zeros(count, dtype=numpy.int64)
+    numpy.maximum.at(maxOrder, parents, params.strahler[children])
+    isMax = params.strahler[children] == maxOrder[parents]
+    maxCount = numpy.bincount(parents[isMax], minlength=count)
+    strahler = numpy.where(maxCount > 1, maxOrder + 1, maxOrder)
+    strahler[maxOrder == 0] = 1
+
+    return strahler, lengthUp, lengthDown
+
+
+def _differs(a, b):
+    # Values stored in the layer are rounded to 6 decimal places, missing
+    # values are NaN and always differ
+    return ~(numpy.abs(a - b) <= 1e-5 + 1e-9 * numpy.abs(b))
+
+
+def updateParameters(params):
+    '''Repair parameters stored by the previous run after the network
+    edits which did not change its topology.
+
+    Only arcs whose stored values disagree with the values of their
+    neighbours are recalculated: Strahler orders and lengths upstream
+    along the paths downstream of them, until recalculated values match
+    stored ones, and lengths downstream in the subtrees upstream of them.
+    Returns number of arcs recalculated.
+    '''
+    arcs = params.connected()
+    strahler, lengthUp, lengthDown = _expectedValues(params)
+
+    downArc = params.downArc.tolist()
+    offsets = params.upArcOffsets.tolist()
+    upArcs = params.upArcs.tolist()
+    length = params.length.tolist()
+    orders = params.strahler.tolist()
+    lenUp = params.lengthUp.tolist()
+    lenDown = params.lengthDown.tolist()
+    updated = set()
+
+    # Downstream paths
+    seeds = arcs[(strahler[arcs] != params.strahler[arcs]) |
+                 _differs(lengthUp[arcs], params.lengthUp[arcs])]
+    for i in seeds.tolist():
+        while i != -1:
+            upstream = upArcs[offsets[i]:offsets[i + 1]]
+            order = 1
+            maxUp = 0.0
+            if len(upstream) > 0:
+                upOrders = sorted([orders[j] for j in upstream],
+                                  reverse=True)
+                order = upOrders[0]
+                if len(upOrders) > 1 and upOrders[0] == upOrders[1]:
+                    order += 1
+                maxUp = max([lenUp[j] for j in upstream])
+
+            newLenUp = length[i] + maxUp
+            if order == orders[i] and \
+                    abs(newLenUp - lenUp[i]) <= 1e-5 + 1e-9 * abs(newLenUp):
+                break
+            orders[i] = order
+            lenUp[i] = newLenUp
+            updated.add(i)
+            i = downArc[i]
+
+    # Upstream subtrees, processed from the outlet so the subtree of
+    # every arc is visited once its downstream arc is up to date
+    seeds = arcs[_differs(lengthDown[arcs], params.lengthDown[arcs])]
+    seeds = seeds[numpy.argsort(params.upNodeId[seeds], kind='mergesort')]
+    for seed in seeds.tolist():
+        stack = [seed]
+        while stack:
+            i = stack.pop()
+            d = downArc[i]
+            newLenDown = length[i] + lenDown[d] if d != -1 else 0.0
+            if i != seed and abs(newLenDown - lenDown[i]) <= \
+                    1e-5 + 1e-9 * abs(newLenDown):
+                continue
+            lenDown[i] = newLenDown
+            updated.add(i)
+            stack.extend(upArcs[offsets[i]:offsets[i + 1]])
+
+    params.strahler = numpy.array(orders, dtype=numpy.int64)
+    params.lengthUp = numpy.array(lenUp, dtype=numpy.float64)
+    params.lengthDown = numpy.array(lenDown, dtype=numpy.float64)
+    return len(updated)
+
+
+def storedParameters(downNodeId, upNodeId, length, strahler, lengthUp=None,
+                     lengthDown=None, downArc=None):
+    '''Create network parameters from the values stored by the previous
+    run, arcs with -1 upstream node id are not connected. Lengths upstream
+    and downstream are NaN when not given, downstream arcs are found from
+    the node ids when not given.
+    '''
+    params = NetworkParameters(numpy.asarray(downNodeId, dtype=numpy.int64),
+                               numpy.asarray(upNodeId, dtype=numpy.int64),
+                               numpy.asarray(length, dtype=numpy.float64))
+    if downArc is None:
+        _connectArcs(params)
+    else:
+        params.downArc = downArc
+        params.upArcOffsets, params.upArcs = upstreamArcs(downArc)
+    params.strahler = numpy.asarray(strahler, dtype=numpy.int64)
+    if lengthUp is not None:
+        params.lengthUp = numpy.asarray(lengthUp, dtype=numpy.float64)
+    if lengthDown is not None:
+        params.lengthDown = numpy.asarray(lengthDown, dtype=numpy.float64)
+    return params
+
+
+def updateNetwork(startX, startY, endX, endY, length, downNodeId, upNodeId,
+                  basin, strahler, lengthUp, lengthDown, tolerance=0.0):
+    '''Update parameters stored by the previous run after network edits.
+
+    basin holds index of the outlet arc of each arc, other arguments are
+    as for indexNetwork and storedParameters. Stored node ids are checked
+    against the endpoints first (see _storedTopology), the network graph
+    is built only when that check fails or endpoints are snapped. Returns
+    updated parameters, number of arcs recalculated and number of snapped
+    endpoints. When topology of the network changed parameters are None
+    and full analysis is needed.
+    '''
+    startX, startY, endX, endY, length = [
+        numpy.asarray(values, dtype=numpy.float64)
+        for values in (startX, startY, endX, endY, length)]
+    downNodeId = numpy.asarray(downNodeId, dtype=numpy.int64)
+    upNodeId = numpy.asarray(upNodeId, dtype=numpy.int64)
+    basin = numpy.asarray(basin, dtype=numpy.int64)
+    downArc = None
+    merges = 0
+    if tolerance == 0:
+        downArc = _storedTopology(startX, startY, endX, endY, downNodeId,
+                                  upNodeId, basin)
+    if downArc is None:
+        graph = NetworkGraph.fromEndpoints(startX, startY, endX, endY,
+                                           length, None, tolerance)
+        merges = graph.merges
+        if topologyChanged(graph, downNodeId, upNodeId, basin):
+            return None, 0, merges
+
+    params = storedParameters(downNodeId, upNodeId, length, strahler,
+                              lengthUp, lengthDown, downArc)
+    updated = updateParameters(params)
+    return params, updated, merges
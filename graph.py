@@ -0,0 +1,1006 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+
+import numpy
+
+
+class NetworkGraph(object):
+    '''Compact topology of the stream network.
+
+    Nodes and arcs are identified by consecutive integers starting from
+    zero. Arc i connects nodes fromNode[i] and toNode[i]. Arcs incident to
+    node n are stored in CSR layout as arcs[offsets[n]:offsets[n + 1]],
+    in the same order they were read from the layer.
+    '''
+
+    def __init__(self, fromNode, toNode, length=None, fids=None):
+        self.fromNode = numpy.asarray(fromNode, dtype=numpy.int64)
+        self.toNode = numpy.asarray(toNode, dtype=numpy.int64)
+        self.arcCount = len(self.fromNode)
+
+        if self.arcCount > 0:
+            self.nodeCount = int(max(self.fromNode.max(),
+                                     self.toNode.max())) + 1
+        else:
+            self.nodeCount = 0
+
+        if length is None:
+            self.length = numpy.zeros(self.arcCount, dtype=numpy.float64)
+        else:
+            self.length = numpy.asarray(length, dtype=numpy.float64)
+
+        if fids is None:
+            self.fids = numpy.arange(self.arcCount, dtype=numpy.int64)
+        else:
+            self.fids = numpy.asarray(fids, dtype=numpy.int64)
+
+        # Node coordinates, available only when graph built from geometries
+        self.x = None
+        self.y = None
+        self.merges = 0
+
+        # Interleave arc endpoints so that stable sort keeps arcs connected
+        # to the same node in reading order
+        ends = numpy.empty(2 * self.arcCount, dtype=numpy.int64)
+        ends[0::2] = self.fromNode
+        ends[1::2] = self.toNode
+        self.arcs = numpy.argsort(ends, kind='mergesort') // 2
+
+        self.offsets = numpy.zeros(self.nodeCount + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(ends, minlength=self.nodeCount),
+                     out=self.offsets[1:])
+
+        self._fidSorter = None
+
+    @classmethod
+    def fromEndpoints(cls, startX, startY, endX, endY, length=None,
+                      fids=None, tolerance=0.0, processes=1):
+        '''Build graph joining arcs by their endpoint coordinates.
+
+        Endpoints closer than tolerance are joined into the same node,
+        with zero tolerance only identical endpoints are joined. Nodes
+        are numbered in order of their first appearance, number of
+        distinct endpoint locations merged into other nodes is stored in
+        the merges attribute.
+
+        When processes is greater than one endpoints are split into
+        spatial tiles processed by a pool of worker processes, the graph
+        is identical to the one built by a single process.
+        '''
+        count = len(startX)
+        x = numpy.empty(2 * count, dtype=numpy.float64)
+        y = numpy.empty(2 * count, dtype=numpy.float64)
+        x[0::2] = startX
+        x[1::2] = endX
+        y[0::2] = startY
+        y[1::2] = endY
+
+        if processes > 1:
+            nodes, first = _groupEndpointsTiled(x, y, processes)
+        else:
+            nodes, first = _groupEndpoints(x, y)
+        merges = 0
+        if tolerance > 0 and len(first) > 0:
+            if processes > 1:
+                labels, roots = _snapPointsTiled(x[first], y[first],
+                                                 tolerance, processes)
+            else:
+                labels, roots = _snapPoints(x[first], y[first], tolerance)
+            merges = len(first) - len(roots)
+            nodes = labels[nodes]
+            first = first[roots]
+
+        graph = cls(nodes[0::2], nodes[1::2], length, fids)
+        graph.x = x[first]
+        graph.y = y[first]
+        graph.merges = merges
+        return graph
+
+    @classmethod
+    def fromNodeIds(cls, downNodeId, upNodeId, length=None, fids=None):
+        '''Build graph for the network with already indexed nodes.
+
+        For such graph fromNode is a downstream node and toNode is an
+        upstream node of the arc.
+        '''
+        downNodeId = numpy.asarray(downNodeId, dtype=numpy.int64)
+        upNodeId = numpy.asarray(upNodeId, dtype=numpy.int64)
+        count = len(downNodeId)
+
+        ids, nodes = numpy.unique(numpy.concatenate((downNodeId, upNodeId)),
+                                  return_inverse=True)
+
+        graph = cls(nodes[:count], nodes[count:], length, fids)
+        graph.downNodeId = downNodeId
+        graph.upNodeId = upNodeId
+        return graph
+
+    def arcsAtNode(self, node):
+        return self.arcs[self.offsets[node]:self.offsets[node + 1]]
+
+    def otherNode(self, arc, node):
+        if self.fromNode[arc] != node:
+            return self.fromNode[arc]
+        return self.toNode[arc]
+
+    def degree(self):
+        return numpy.diff(self.offsets)
+
+    def arcIndex(self, fid):
+        '''Return index of the arc with given feature id or -1.'''
+        if self._fidSorter is None:
+            self._fidSorter = numpy.argsort(self.fids, kind='mergesort')
+
+        pos = numpy.searchsorted(self.fids, fid, sorter=self._fidSorter)
+        if pos < self.arcCount and self.fids[self._fidSorter[pos]] == fid:
+            return int(self._fidSorter[pos])
+        return -1
+
+
+def _groupEndpoints(x, y):
+    '''Assign node ids to the endpoints with identical coordinates.
+
+    Returns node id for each endpoint and index of the first endpoint of
+    each node.
+    '''
+    if len(x) == 0:
+        return (numpy.zeros(0, dtype=numpy.int64),
+                numpy.zeros(0, dtype=numpy.int64))
+
+    # lexsort is stable, so first element of each group is the endpoint
+    # which appears first in the input
+    order = numpy.lexsort((y, x))
+    xs = x[order]
+    ys = y[order]
+
+    isFirst = numpy.ones(len(order), dtype=bool)
+    isFirst[1:] = (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])
+    group = numpy.cumsum(isFirst) - 1
+
+    first = order[isFirst]
+    byAppearance = numpy.argsort(first)
+    rank = numpy.empty(len(first), dtype=numpy.int64)
+    rank[byAppearance] = numpy.arange(len(first), dtype=numpy.int64)
+
+    nodes = numpy.empty(len(order), dtype=numpy.int64)
+    nodes[order] = rank[group]
+    return nodes, first[byAppearance]
+
+
+def _snapPoints(x, y, tolerance):
+    '''Cluster points located closer than tolerance to each other.
+
+    Points are hashed into square cells with side equal to tolerance, so
+    only points from the neighbouring cells are compared and clustering
+    runs in expected linear time. Clusters are transitive and do not
+    depend on the order of points.
+
+    Returns cluster id for each point and index of the first point of
+    each cluster.
+    '''
+    count = len(x)
+    xs = x.tolist()
+    ys = y.tolist()
+    cellX = numpy.floor(x / tolerance).astype(numpy.int64).tolist()
+    cellY = numpy.floor(y / tolerance).astype(numpy.int64).tolist()
+    tolerance2 = tolerance * tolerance
+
+    # Union-find forest, root of every cluster is its first point
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    cells = dict()
+    for i in range(count):
+        cx = cellX[i]
+        cy = cellY[i]
+        for key in ((cx - 1, cy - 1), (cx, cy - 1), (cx + 1, cy - 1),
+                    (cx - 1, cy), (cx, cy), (cx + 1, cy),
+                    (cx - 1, cy + 1), (cx, cy + 1), (cx + 1, cy + 1)):
+            for j in cells.get(key, ()):
+                dx = xs[i] - xs[j]
+                dy = ys[i] - ys[j]
+                if dx * dx + dy * dy <= tolerance2:
+                    a = find(i)
+                    b = find(j)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+
+        cells.setdefault((cx, cy), []).append(i)
+
+    roots = numpy.array([find(i) for i in range(count)], dtype=numpy.int64)
+    first = numpy.flatnonzero(roots == numpy.arange(count))
+    labels = numpy.empty(count, dtype=numpy.int64)
+    labels[first] = numpy.arange(len(first), dtype=numpy.int64)
+    return labels[roots], first
+
+
+def _mapTiles(func, tasks, processes):
+    '''Process tiles by a pool of worker processes.'''
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _tileBounds(keys, tiles):
+    '''Split range of the keys into tiles with similar number of points.
+
+    Returns inner bounds of the tiles, key k belongs to tile
+    searchsorted(bounds, k, 'right').
+    '''
+    quantiles = numpy.linspace(0, 100, tiles + 1)[1:-1]
+    return numpy.unique(numpy.percentile(keys, quantiles))
+
+
+def _groupTile(task):
+    points, x, y = task
+    nodes, first = _groupEndpoints(x, y)
+    return nodes, points[first]
+
+
+def _groupEndpointsTiled(x, y, processes):
+    '''Assign node ids to the endpoints tile by tile.
+
+    Endpoints are split into vertical strips by x, identical endpoints
+    always fall into the same strip, so strips are grouped independently
+    and only node numbering is merged. Returns the same arrays as
+    _groupEndpoints.
+    '''
+    if len(x) == 0:
+        return _groupEndpoints(x, y)
+
+    tile = numpy.searchsorted(_tileBounds(x, processes), x, 'right')
+    tasks = []
+    for k in range(int(tile.max()) + 1):
+        points = numpy.flatnonzero(tile == k)
+        if len(points) > 0:
+            tasks.append((points, x[points], y[points]))
+    results = _mapTiles(_groupTile, tasks, processes)
+
+    # Nodes of all tiles are numbered in order of their first appearance
+    offset = 0
+    groups = numpy.empty(len(x), dtype=numpy.int64)
+    firsts = []
+    for (points, _, _), (nodes, first) in zip(tasks, results):
+        groups[points] = nodes + offset
+        firsts.append(first)
+        offset += len(first)
+    first = numpy.concatenate(firsts)
+
+    byAppearance = numpy.argsort(first)
+    rank = numpy.empty(len(first), dtype=numpy.int64)
+    rank[byAppearance] = numpy.arange(len(first), dtype=numpy.int64)
+    return rank[groups], first[byAppearance]
+
+
+def _snapTile(task):
+    points, x, y, tolerance = task
+    labels, first = _snapPoints(x, y, tolerance)
+    # Root of every cluster is its first point
+    return points[first[labels]]
+
+
+def _snapPointsTiled(x, y, tolerance, processes):
+    '''Cluster points located closer than tolerance tile by tile.
+
+    Points are split into vertical strips along the cells of _snapPoints
+    and strips are clustered independently. Points closer than
+    tolerance lie in the same or neighbouring cells, so clusters joined
+    across the strip bounds are found by clustering points of the cells
+    on both sides of each bound. Returns the same arrays as _snapPoints.
+    '''
+    count = len(x)
+    cellX = numpy.floor(x / tolerance).astype(numpy.int64)
+    bounds = _tileBounds(cellX, processes).astype(numpy.int64)
+    tile = numpy.searchsorted(bounds, cellX, 'right')
+
+    tasks = []
+    for k in range(int(tile.max()) + 1):
+        points = numpy.flatnonzero(tile == k)
+        if len(points) > 0:
+            tasks.append((points, x[points], y[points], tolerance))
+    strips = len(tasks)
+
+    # Cells next to a bound belong to other tile than their neighbour
+    border = numpy.flatnonzero(
+        (tile != numpy.searchsorted(bounds, cellX + 1, 'right')) |
+        (tile != numpy.searchsorted(bounds, cellX - 1, 'right')))
+    if len(border) > 0:
+        tasks.append((border, x[border], y[border], tolerance))
+    results = _mapTiles(_snapTile, tasks, processes)
+
+    roots = numpy.empty(count, dtype=numpy.int64)
+    for (points, _, _, _), tileRoots in zip(tasks[:strips],
+                                            results[:strips]):
+        roots[points] = tileRoots
+
+    # Clusters of the border points join clusters of the strips, roots
+    # are merged by union-find keeping the smallest point as root
+    parent = dict()
+
+    def find(i):
+        while parent.get(i, i) != i:
+            i = parent[i]
+        return i
+
+    if len(border) > 0:
+        for a, b in zip(roots[border].tolist(),
+                        roots[results[strips]].tolist()):
+            a = find(a)
+            b = find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+    if parent:
+        merged = numpy.array(sorted(parent.keys()), dtype=numpy.int64)
+        target = numpy.array([find(i) for i in merged.tolist()],
+                             dtype=numpy.int64)
+        pos = numpy.searchsorted(merged, roots)
+        pos[pos == len(merged)] = 0
+        found = merged[pos] == roots
+        roots[found] = target[pos[found]]
+
+    first = numpy.flatnonzero(roots == numpy.arange(count))
+    labels = numpy.empty(count, dtype=numpy.int64)
+    labels[first] = numpy.arange(len(first), dtype=numpy.int64)
+    return labels[roots], first
+
+
+def indexNodes(graph, outletArc):
+    '''Assign downstream and upstream node ids to the network arcs.
+
+    Arcs are visited in depth-first order starting from the outlet arc,
+    whose upstream node is toNode. Outlet arc gets -1 as downstream node
+    id, arcs not connected to the outlet get -1 for both ids.
+
+    Explicit stack is used instead of recursion, so depth of the network
+    is not limited by the Python recursion limit.
+    '''
+    fromNode = graph.fromNode.tolist()
+    toNode = graph.toNode.tolist()
+    offsets = graph.offsets.tolist()
+    arcs = graph.arcs.tolist()
+
+    downNodeId = [-1] * graph.arcCount
+    upNodeId = [-1] * graph.arcCount
+
+    # For outlet arc we assign -1 for downstream and 0 for upstream nodes
+    upNodeId[outletArc] = 0
+    nodeId = 0
+
+    # Each stack item holds arc, its upstream node and position of the
+    # next arc to visit in the adjacency list of that node
+    node = toNode[outletArc]
+    stack = [[outletArc, node, offsets[node]]]
+    while stack:
+        item = stack[-1]
+        arc, node, pos = item
+        end = offsets[node + 1]
+        while pos < end and (arcs[pos] == arc or upNodeId[arcs[pos]] != -1):
+            pos += 1
+
+        if pos == end:
+            stack.pop()
+            continue
+
+        item[2] = pos + 1
+        f = arcs[pos]
+
+        nodeId += 1
+        downNodeId[f] = upNodeId[arc]
+        upNodeId[f] = nodeId
+
+        node = fromNode[f] if fromNode[f] != node else toNode[f]
+        stack.append([f, node, offsets[node]])
+
+    return (numpy.array(downNodeId, dtype=numpy.int64),
+            numpy.array(upNodeId, dtype=numpy.int64))
+
+
+def componentLabels(graph):
+    '''Label connected parts of the network.
+
+    Returns label of each node, nodes connected by arcs get the same
+    label, which is the smallest node number in the part.
+    '''
+    # Union-find forest, root of every part is its smallest node
+    parent = list(range(graph.nodeCount))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in zip(graph.fromNode.tolist(), graph.toNode.tolist()):
+        a = find(a)
+        b = find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    return numpy.array([find(i) for i in range(graph.nodeCount)],
+                       dtype=numpy.int64)
+
+
+def outletCandidates(graph):
+    '''Return arcs which may be network outlets.
+
+    Outlet arc starts at its downstream node, so arcs starting at a node
+    not shared with other arcs are candidates.
+    '''
+    return numpy.flatnonzero(graph.degree()[graph.fromNode] == 1)
+
+
+def topologicalOrder(graph):
+    '''Return arcs of the indexed graph ordered from outlet to sources.
+
+    Node indexing visits arcs depth-first, so every arc has greater
+    upstream node id than its downstream arc.
+    '''
+    return numpy.argsort(graph.upNodeId, kind='mergesort')
+
+
+def downstreamArcs(graph):
+    '''Return index of the downstream arc for each arc of indexed graph.
+
+    Outlet arcs get -1.
+    '''
+    arcByUpNode = numpy.empty(graph.nodeCount, dtype=numpy.int64)
+    arcByUpNode.fill(-1)
+    arcByUpNode[graph.toNode] = numpy.arange(graph.arcCount,
+                                             dtype=numpy.int64)
+    return arcByUpNode[graph.fromNode]
+
+
+def upstreamArcs(downArc):
+    '''Invert downstream arcs array into CSR layout.
+
+    Arcs located directly upstream of arc i are
+    arcs[offsets[i]:offsets[i + 1]].
+    '''
+    count = len(downArc)
+    children = numpy.flatnonzero(downArc != -1)
+    parents = downArc[children]
+
+    arcs = children[numpy.argsort(parents, kind='mergesort')]
+    offsets = numpy.zeros(count + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(parents, minlength=count),
+                 out=offsets[1:])
+    return offsets, arcs
+
+
+def strahlerOrders(graph):
+    '''Calculate Strahler order of each arc of indexed graph.'''
+    return streamOrders(graph)['strahler']
+
+
+def streamOrders(graph, shreve=False, horton=False, hack=False):
+    '''Calculate Strahler order and, optionally, Shreve magnitude, Horton
+    order and Hack order of each arc of indexed graph.
+
+    See arcStreamOrders for the ordering schemes.
+    '''
+    return arcStreamOrders(downstreamArcs(graph), topologicalOrder(graph),
+                           graph.length, shreve, horton, hack)
+
+
+def arcStreamOrders(downArc, order, length, shreve=False, horton=False,
+                    hack=False):
+    '''Calculate Strahler order and, optionally, Shreve magnitude, Horton
+    order and Hack order of the arcs listed in order.
+
+    downArc is index of the downstream arc of each arc and order lists
+    arcs from outlet to sources (see topologicalOrder), arcs not listed
+    get zero orders.
+
+    Arcs are processed from sources to outlet, so orders of the upstream
+    arcs are always known when arc is processed. In the same sweep main
+    upstream arc is found at every confluence: the one with the highest
+    Strahler order for Horton ordering and the one with the longest path
+    upstream for Hack ordering, ties are broken by the longest path
+    upstream and by arc index. Horton and Hack orders are then passed
+    from the outlet upstream along the main arcs.
+
+    Returns dictionary with scheme name as key and array of orders as
+    value.
+    '''
+    # Algorithm at pages 65-66 "Automated AGQ4Vector Watershed.pdf"
+    count = len(downArc)
+    offsets, arcs = upstreamArcs(downArc)
+    offsets = offsets.tolist()
+    arcs = arcs.tolist()
+    downArc = downArc.tolist()
+    length = numpy.asarray(length, dtype=numpy.float64).tolist()
+    needMain = horton or hack
+    topological = numpy.asarray(order).tolist()
+
+    strahler = [0] * count
+    magnitude = [0] * count
+    lengthUp = [0.0] * count
+    hortonMain = [-1] * count
+    hackMain = [-1] * count
+    for i in reversed(topological):
+        upstream = arcs[offsets[i]:offsets[i + 1]]
+        orders = [strahler[j] for j in upstream]
+        if len(orders) == 0:
+            order = 1
+        elif len(orders) == 1:
+            order = orders[0]
+        else:
+            orders.sort(reverse=True)
+            if orders[0] == orders[1]:
+                order = orders[0] + 1
+            else:
+                order = orders[0]
+        strahler[i] = order
+
+        if shreve:
+            magnitude[i] = sum([magnitude[j] for j in upstream]) \
+                if len(upstream) > 0 else 1
+
+        if needMain:
+            maxUp = 0.0
+            if len(upstream) > 0:
+                hortonMain[i] = max(upstream, key=lambda j:
+                                    (strahler[j], lengthUp[j], -j))
+                hackMain[i] = max(upstream, key=lambda j:
+                                  (lengthUp[j], -j))
+                maxUp = lengthUp[hackMain[i]]
+            lengthUp[i] = length[i] + maxUp
+
+    orders = dict(strahler=numpy.array(strahler, dtype=numpy.int64))
+    if shreve:
+        orders['shreve'] = numpy.array(magnitude, dtype=numpy.int64)
+
+    if needMain:
+        hortonOrder = [0] * count
+        hackOrder = [0] * count
+        for i in topological:
+            d = downArc[i]
+            if d == -1:
+                hortonOrder[i] = strahler[i]
+                hackOrder[i] = 1
+            else:
+                hortonOrder[i] = hortonOrder[d] if hortonMain[d] == i \
+                    else strahler[i]
+                hackOrder[i] = hackOrder[d] if hackMain[d] == i \
+                    else hackOrder[d] + 1
+
+        if horton:
+            orders['horton'] = numpy.array(hortonOrder, dtype=numpy.int64)
+        if hack:
+            orders['hack'] = numpy.array(hackOrder, dtype=numpy.int64)
+
+    return orders
+
+
+def _pathSums(downArc, weight):
+    '''Sum weights along the path from each arc to the outlet.
+
+    Uses pointer jumping: after each round every arc refers to the arc
+    twice as far downstream, so the number of rounds is logarithmic in
+    the network depth and each round is a single array operation.
+    '''
+    sums = numpy.array(weight, dtype=numpy.float64)
+    ancestor = downArc.copy()
+    active = numpy.flatnonzero(ancestor != -1)
+    while len(active) > 0:
+        down = ancestor[active]
+        sums[active] += sums[down]
+        ancestor[active] = ancestor[down]
+        active = active[ancestor[active] != -1]
+
+    return sums
+
+
+def lengthUpstream(graph):
+    '''Calculate length of the longest path upstream of each arc.
+
+    Length of the arc itself is included.
+    '''
+    return arcLengthUpstream(downstreamArcs(graph), graph.length)
+
+
+def arcLengthUpstream(downArc, length):
+    '''Calculate length of the longest path upstream of each arc from
+    the index of its downstream arc, as lengthUpstream.
+    '''
+    # Algorithm at pages 61-62 "Automated AGQ4Vector Watershed.pdf"
+    # Longest path upstream of the arc ends at its descendant most distant
+    # from the outlet, so it is computed from the maximum of the path
+    # sums over descendants. Maximum is pushed to the ancestors with
+    # pointer jumping, as in _pathSums.
+    length = numpy.asarray(length, dtype=numpy.float64)
+    pathSum = _pathSums(downArc, length)
+
+    maxSum = pathSum.copy()
+    ancestor = downArc.copy()
+    active = numpy.flatnonzero(ancestor != -1)
+    while len(active) > 0:
+        down = ancestor[active]
+        numpy.maximum.at(maxSum, down, maxSum[active])
+        ancestor[active] = ancestor[down]
+        active = active[ancestor[active] != -1]
+
+    return maxSum - pathSum + length
+
+
+def lengthDownstream(graph):
+    '''Calculate length of the path from each arc to the outlet.
+
+    Length of the arc itself is included, for outlet arc length
+    downstream is zero.
+    '''
+    return arcLengthDownstream(downstreamArcs(graph), graph.length)
+
+
+def arcLengthDownstream(downArc, length):
+    '''Calculate length of the path from each arc to the outlet from
+    the index of its downstream arc, as lengthDownstream.
+    '''
+    # Algorithm at pages 62-63 "Automated AGQ4Vector Watershed.pdf"
+    return _pathSums(downArc, numpy.where(downArc != -1, length, 0.0))
+
+
+class FlowIndex(object):
+    '''Index of the arcs of indexed network for upstream and flow distance
+    queries.
+
+    Arcs form trees rooted at outlets, downArc[i] is the arc downstream
+    of arc i or -1 for roots. Arcs are numbered in depth-first preorder,
+    so arcs upstream of arc i have preorder numbers pre[i] to last[i] and
+    membership in the upstream set is a single comparison. Lowest common
+    downstream arc of two arcs is found by binary lifting: ancestors[k]
+    holds the arc 2 ** k arcs downstream, so it takes logarithmic time.
+    '''
+
+    def __init__(self, downArc, length=None):
+        self.downArc = numpy.asarray(downArc, dtype=numpy.int64)
+        count = len(self.downArc)
+        if length is None:
+            self.length = numpy.zeros(count, dtype=numpy.float64)
+        else:
+            self.length = numpy.asarray(length, dtype=numpy.float64)
+
+        isRoot = self.downArc == -1
+        self.depth = _pathSums(self.downArc,
+                               numpy.ones(count)).astype(numpy.int64) - 1
+
+        # Distance of the downstream node of each arc from its outlet
+        self.distance = _pathSums(self.downArc, self.length) - self.length
+
+        # Number of arcs upstream, accumulated from sources to outlets
+        size = [1] * count
+        down = self.downArc.tolist()
+        for a in numpy.argsort(-self.depth, kind='mergesort').tolist():
+            if down[a] != -1:
+                size[down[a]] += size[a]
+        size = numpy.array(size, dtype=numpy.int64)
+
+        # Preorder number of an arc is that of its downstream arc plus one
+        # plus sizes of its siblings visited before it, roots follow each
+        # other, so preorder numbers are path sums of these offsets
+        offsets, upArcs = upstreamArcs(self.downArc)
+        before = numpy.zeros(count + 1, dtype=numpy.int64)
+        numpy.cumsum(size[upArcs], out=before[1:len(upArcs) + 1])
+        siblings = numpy.repeat(offsets[:-1], numpy.diff(offsets))
+        offset = numpy.zeros(count, dtype=numpy.int64)
+        offset[upArcs] = 1 + before[:len(upArcs)] - before[siblings]
+        roots = numpy.flatnonzero(isRoot)
+        offset[roots] = numpy.cumsum(size[roots]) - size[roots]
+        self.pre = _pathSums(self.downArc, offset).astype(numpy.int64)
+        self.last = self.pre + size - 1
+
+        self.arcByPre = numpy.empty(count, dtype=numpy.int64)
+        self.arcByPre[self.pre] = numpy.arange(count, dtype=numpy.int64)
+
+        self.ancestors = [self.downArc]
+        while True:
+            previous = self.ancestors[-1]
+            up = numpy.where(previous != -1, previous[previous], -1)
+            if not (up != -1).any():
+                break
+            self.ancestors.append(up)
+
+    def isUpstream(self, arc, of):
+        '''Return True when arc is the arc of or is located upstream of
+        it.'''
+        return bool(self.pre[of] <= self.pre[arc] <= self.last[of])
+
+    def upstreamArcs(self, arc):
+        '''Return the arc and all arcs upstream of it, in preorder.'''
+        return self.arcByPre[self.pre[arc]:self.last[arc] + 1]
+
+    def downstreamArcs(self, arc):
+        '''Return the arc and all arcs on its path to the outlet.'''
+        path = []
+        while arc != -1:
+            path.append(arc)
+            arc = int(self.downArc[arc])
+        return numpy.array(path, dtype=numpy.int64)
+
+    def subnetwork(self, starts, upstream=True, downstream=False):
+        '''Return flow distance of each arc from the nearest of the start
+        arcs, NaN for arcs neither upstream nor downstream of any of them.
+
+        Distances are measured between downstream nodes of the arcs.
+        '''
+        distance = numpy.empty(len(self.downArc), dtype=numpy.float64)
+        distance.fill(numpy.inf)
+        for s in starts:
+            sets = []
+            if upstream:
+                sets.append(self.upstreamArcs(s))
+            if downstream:
+                sets.append(self.downstreamArcs(s))
+            for arcs in sets:
+                distance[arcs] = numpy.minimum(distance[arcs], numpy.abs(
+                    self.distance[arcs] - self.distance[s]))
+        distance[numpy.isinf(distance)] = numpy.nan
+        return distance
+
+    def commonDownstream(self, a, b):
+        '''Return the first arc located downstream of both arcs or -1
+        when they are in different basins.
+
+        An arc counts as located downstream of itself.
+        '''
+        if self.depth[a] < self.depth[b]:
+            a, b = b, a
+        lift = int(self.depth[a] - self.depth[b])
+        k = 0
+        while lift > 0:
+            if lift & 1:
+                a = int(self.ancestors[k][a])
+            lift >>= 1
+            k += 1
+        if a == b:
+            return a
+
+        for k in range(len(self.ancestors) - 1, -1, -1):
+            up = self.ancestors[k]
+            if up[a] != up[b]:
+                a = int(up[a])
+                b = int(up[b])
+        return int(self.downArc[a])
+
+    def flowDistance(self, a, b):
+        '''Return length of the flow path between downstream nodes of the
+        arcs, NaN when they are in different basins.'''
+        c = self.commonDownstream(a, b)
+        if c == -1:
+            return numpy.nan
+        if c == a or c == b:
+            return float(abs(self.distance[a] - self.distance[b]))
+
+        # Paths from both arcs join at the upstream node of c
+        junction = self.distance[c] + self.length[c]
+        return float(self.distance[a] + self.distance[b] - 2 * junction)
+
+
+def nodeIndexes(graph, downNodeId, upNodeId):
+    '''Transfer node ids assigned by node indexing to the graph nodes.
+
+    Returns id of each graph node, id of the next node downstream, mask
+    of the nodes reached by indexing and mask of the outlet nodes. Outlet
+    node gets downstream node id of the outlet arc as its id and -1 as id
+    of the downstream node.
+    '''
+    reached = numpy.flatnonzero(upNodeId != -1)
+    maxId = int(upNodeId.max()) if len(reached) > 0 else 0
+
+    arcByUpNodeId = numpy.empty(maxId + 1, dtype=numpy.int64)
+    arcByUpNodeId.fill(-1)
+    arcByUpNodeId[upNodeId[reached]] = reached
+
+    # Downstream end of the arc is the node it shares with its downstream
+    # arc, for the outlet arc it is fromNode
+    parent = arcByUpNodeId[downNodeId[reached]]
+    parent[downNodeId[reached] == -1] = -1
+    fromNode = graph.fromNode[reached]
+    toNode = graph.toNode[reached]
+    parentFrom = numpy.where(parent != -1, graph.fromNode[parent], -1)
+    parentTo = numpy.where(parent != -1, graph.toNode[parent], -1)
+    fromIsDown = (fromNode == parentFrom) | (fromNode == parentTo)
+    fromIsDown |= parent == -1
+    upNode = numpy.where(fromIsDown, toNode, fromNode)
+    downNode = numpy.where(fromIsDown, fromNode, toNode)
+
+    nodeId = numpy.empty(graph.nodeCount, dtype=numpy.int64)
+    nodeId.fill(-1)
+    nextNodeId = nodeId.copy()
+    known = numpy.zeros(graph.nodeCount, dtype=bool)
+    outlet = known.copy()
+
+    outlets = parent == -1
+    known[downNode[outlets]] = True
+    outlet[downNode[outlets]] = True
+    nodeId[downNode[outlets]] = downNodeId[reached][outlets]
+    known[upNode] = True
+    nodeId[upNode] = upNodeId[reached]
+    nextNodeId[upNode] = downNodeId[reached]
+
+    return nodeId, nextNodeId, known, outlet
+
+
+def orderFrequency(offsets, upArcs, strahler):
+    '''Count streams of each Strahler order.
+
+    Arcs located directly upstream of arc i are
+    upArcs[offsets[i]:offsets[i + 1]], arcs with Strahler order below 1
+    are skipped. Returns dictionary with order as key and [N, Ndu, Na]
+    list as value.
+
+    N counts arcs starting at sources and confluences. At confluences
+    upstream arcs one order lower than the arc are counted in Ndu and
+    arcs more than one order lower in Na, at the order of the upstream
+    arc.
+    '''
+    strahler = numpy.asarray(strahler, dtype=numpy.int64)
+    maxOrder = int(strahler.max()) if len(strahler) > 0 else 0
+    bins = max(maxOrder, 0) + 1
+
+    upCount = numpy.diff(offsets)
+    valid = strahler >= 1
+    starts = valid & (upCount != 1)
+    n = numpy.bincount(strahler[starts], minlength=bins)
+
+    # Downstream arc of each entry of upArcs
+    down = numpy.repeat(numpy.arange(len(strahler)), upCount)
+    atConfluence = valid[down] & (upCount[down] > 1) & \
+        (strahler[upArcs] >= 1)
+    upOrder = strahler[upArcs[atConfluence]]
+    diff = strahler[down[atConfluence]] - upOrder
+    ndu = numpy.bincount(upOrder[diff == 1], minlength=bins)
+    na = numpy.bincount(upOrder[diff > 1], minlength=bins)
+
+    frequency = dict()
+    for i in range(1, maxOrder + 1):
+        frequency[i] = [float(n[i]), float(ndu[i]), float(na[i])]
+
+    return frequency
+
+
+def _logFit(orders, values):
+    '''Fit log10(values) linearly to orders.
+
+    Returns ratio of the values of consecutive orders and coefficient of
+    determination of the fit, both NaN if less than two orders have
+    positive values.
+    '''
+    mask = values > 0
+    if numpy.count_nonzero(mask) < 2:
+        return float('nan'), float('nan')
+
+    x = orders[mask].astype(numpy.float64)
+    y = numpy.log10(values[mask])
+    slope, intercept = numpy.polyfit(x, y, 1)
+    residual = y - (slope * x + intercept)
+    total = ((y - y.mean()) ** 2).sum()
+    r2 = 1.0 - (residual ** 2).sum() / total if total > 0 else 1.0
+    return float(10 ** slope), float(r2)
+
+
+def streamStatistics(offsets, upArcs, downArc, strahler, length,
+                     area=None):
+    '''Count streams of each order and sum their lengths and areas.
+
+    Stream of order u is a chain of arcs of order u, it starts at arc
+    with no upstream arc of the same order and ends at arc whose
+    downstream arc has different order. Area of the basin is taken at
+    the end of the stream.
+
+    Returns dictionary of arrays indexed by order: number of streams
+    ('streams'), their total length ('length') and, when area is given,
+    number of stream ends with known area ('ends') and their total area
+    ('area'). Statistics of separate networks can be added together.
+    '''
+    strahler = numpy.asarray(strahler, dtype=numpy.int64)
+    length = numpy.asarray(length, dtype=numpy.float64)
+    maxOrder = int(strahler.max()) if len(strahler) > 0 else 0
+    bins = max(maxOrder, 0) + 1
+    valid = strahler >= 1
+    arcs = numpy.flatnonzero(valid)
+
+    # Streams start at arcs without upstream arc of the same order
+    upCount = numpy.diff(offsets)
+    down = numpy.repeat(numpy.arange(len(strahler)), upCount)
+    sameOrder = strahler[upArcs] == strahler[down]
+    continued = numpy.zeros(len(strahler), dtype=bool)
+    continued[down[sameOrder]] = True
+    heads = valid & ~continued
+
+    statistics = dict(
+        streams=numpy.bincount(strahler[heads], minlength=bins),
+        length=numpy.bincount(strahler[arcs], weights=length[arcs],
+                              minlength=bins))
+
+    if area is not None:
+        area = numpy.asarray(area, dtype=numpy.float64)
+        downOrder = numpy.where(downArc != -1, strahler[downArc], -1)
+        ends = valid & (downOrder != strahler) & ~numpy.isnan(area)
+        statistics['ends'] = numpy.bincount(strahler[ends], minlength=bins)
+        statistics['area'] = numpy.bincount(strahler[ends],
+                                            weights=area[ends],
+                                            minlength=bins)
+
+    return statistics
+
+
+def addStatistics(total, statistics):
+    '''Add stream statistics of another network to the total.'''
+    if total is None:
+        return dict((k, v.copy()) for k, v in statistics.items())
+
+    for key, values in statistics.items():
+        bins = max(len(total[key]), len(values))
+        summed = numpy.zeros(bins, dtype=values.dtype)
+        summed[:len(total[key])] += total[key]
+        summed[:len(values)] += values
+        total[key] = summed
+    return total
+
+
+def fitHortonRatios(statistics):
+    '''Fit Horton's laws to the stream statistics.
+
+    Number of streams, their mean length and mean area at the end of the
+    streams are fitted against order by log-linear regression. Returns
+    dictionary with Rb, Rl and Ra as keys and [ratio, R2] list as value.
+    Rb is reported as ratio of number of streams of order u to number of
+    streams of order u + 1. Ra is included only for statistics with area.
+    '''
+    bins = len(statistics['streams'])
+    orders = numpy.arange(1, bins)
+    counts = statistics['streams'][1:].astype(numpy.float64)
+    meanLength = numpy.where(counts > 0, statistics['length'][1:] /
+                             numpy.maximum(counts, 1), 0.0)
+
+    rb, r2b = _logFit(orders, counts)
+    ratios = dict(Rb=[1.0 / rb if rb == rb else rb, r2b],
+                  Rl=list(_logFit(orders, meanLength)))
+
+    if 'area' in statistics:
+        endCount = statistics['ends'][1:]
+        meanArea = numpy.where(endCount > 0, statistics['area'][1:] /
+                               numpy.maximum(endCount, 1), 0.0)
+        ratios['Ra'] = list(_logFit(orders, meanArea))
+
+    return ratios
+
+
+def hortonRatios(offsets, upArcs, downArc, strahler, length, area=None):
+    '''Fit Horton's laws of stream numbers, lengths and areas.
+
+    See streamStatistics for definition of streams and fitHortonRatios
+    for the results. Ra is not included without area.
+    '''
+    return fitHortonRatios(streamStatistics(offsets, upArcs, downArc,
+                                            strahler, length, area))
+
+
+def bifurcationRatios(frequency):
+    '''Calculate bifurcation parameters from the order frequency.
+
+    Returns dictionary with order as key and [Rbd, Rb, Ru] list as value.
+    '''
+    maxOrder = max(frequency.keys()) if len(frequency) > 0 else 0
+    ratios = dict()
+    for k, v in frequency.items():
+        if k != maxOrder:
+            rb = v[0] / frequency[k + 1][0]
+            rbd = v[1] / frequency[k + 1][0]
+        else:
+            rb = 0.0
+            rbd = 0.0
+        ratios[k] = [rbd, rb, rb - rbd]
+
+    return ratios
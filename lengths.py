@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+'''Bulk measurement of network arcs from their WKB geometries.
+
+Vertices of all arcs are extracted from WKB into flat coordinate arrays,
+endpoints and lengths are then computed with array operations over all
+segments at once. Lengths are planar in layer units, or geodesic in
+meters on the ellipsoid for geographic coordinates.
+'''
+
+import struct
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+
+# Semi-major axis in meters and flattening
+ELLIPSOIDS = {
+    'WGS84': (6378137.0, 1 / 298.257223563),
+    'GRS80': (6378137.0, 1 / 298.257222101),
+    'WGS72': (6378135.0, 1 / 298.26),
+    'intl': (6378388.0, 1 / 297.0),
+    'clrk66': (6378206.4, 1 / 294.9786982),
+    'bessel': (6377397.155, 1 / 299.1528128),
+    'krass': (6378245.0, 1 / 298.3),
+}
+
+WKB_LINESTRING = 2
+WKB_MULTILINESTRING = 5
+
+VINCENTY_ITERATIONS = 100
+
+
+def _geometryType(code):
+    '''Return base type and number of coordinates per vertex of the ISO,
+    EWKB or QGIS 2.5D WKB type code.
+    '''
+    hasZ = bool(code & 0x80000000)
+    hasM = bool(code & 0x40000000)
+    code &= 0x0fffffff
+    hasZ |= code // 1000 in (1, 3)
+    hasM |= code // 1000 in (2, 3)
+    return code % 1000, 2 + hasZ + hasM
+
+
+def _parseSimpleLines(wkbs):
+    '''Extract vertices when all geometries are little endian 2D line
+    strings, the usual case, with array operations over the joined WKB.
+
+    Returns the same arrays as parseLines or None for other geometries.
+    '''
+    sizes = numpy.array([len(wkb) if wkb else 0 for wkb in wkbs],
+                        dtype=numpy.int64)
+    if len(sizes) == 0 or (sizes < 9).any():
+        return None
+
+    data = numpy.frombuffer(b''.join(bytes(wkb) for wkb in wkbs),
+                            dtype=numpy.uint8)
+    starts = numpy.zeros(len(sizes), dtype=numpy.int64)
+    numpy.cumsum(sizes[:-1], out=starts[1:])
+
+    def uint32(pos):
+        return data[pos].astype(numpy.int64) | \
+            (data[pos + 1].astype(numpy.int64) << 8) | \
+            (data[pos + 2].astype(numpy.int64) << 16) | \
+            (data[pos + 3].astype(numpy.int64) << 24)
+
+    counts = uint32(starts + 5)
+    if (data[starts] != 1).any() or (uint32(starts + 1) != WKB_LINESTRING) \
+            .any() or (sizes != 9 + 16 * counts).any():
+        return None
+
+    # Drop headers, coordinates of all lines are left
+    keep = numpy.ones(len(data), dtype=bool)
+    keep[(starts[:, None] + numpy.arange(9)).ravel()] = False
+    vertices = data[keep].view('<f8').reshape(-1, 2)
+
+    vertexOffsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=vertexOffsets[1:])
+    partOffsets = numpy.arange(len(counts) + 1, dtype=numpy.int64)
+    return (numpy.ascontiguousarray(vertices[:, 0], dtype=numpy.float64),
+            numpy.ascontiguousarray(vertices[:, 1], dtype=numpy.float64),
+            vertexOffsets, partOffsets)
+
+
+def parseLines(wkbs):
+    '''Extract vertices of line and multiline geometries.
+
+    Returns x and y of all vertices, offsets of the parts in the vertex
+    arrays and offsets of the geometries in the parts, so vertices of
+    part p are x[vertexOffsets[p]:vertexOffsets[p + 1]] and parts of
+    geometry i are partOffsets[i]:partOffsets[i + 1]. Empty geometries
+    and geometries of other types have no parts.
+    '''
+    lines = _parseSimpleLines(wkbs)
+    if lines is not None:
+        return lines
+
+    coords = []
+    vertexCounts = []
+    partCounts = []
+
+    def linePart(wkb, pos):
+        order = '<' if wkb[pos:pos + 1] == b'\x01' else '>'
+        code, = struct.unpack_from(order + 'I', wkb, pos + 1)
+        base, dims = _geometryType(code)
+        count, = struct.unpack_from(order + 'I', wkb, pos + 5)
+        values = numpy.frombuffer(wkb, dtype=order + 'f8',
+                                  count=count * dims, offset=pos + 9)
+        return base, values.reshape(count, dims)[:, :2], \
+            pos + 9 + 8 * count * dims
+
+    for wkb in wkbs:
+        parts = 0
+        if wkb:
+            wkb = bytes(wkb)
+            order = '<' if wkb[0:1] == b'\x01' else '>'
+            code, = struct.unpack_from(order + 'I', wkb, 1)
+            base, dims = _geometryType(code)
+            if base == WKB_LINESTRING:
+                _, vertices, _ = linePart(wkb, 0)
+                coords.append(vertices)
+                vertexCounts.append(len(vertices))
+                parts = 1
+            elif base == WKB_MULTILINESTRING:
+                count, = struct.unpack_from(order + 'I', wkb, 5)
+                pos = 9
+                for _ in range(count):
+                    _, vertices, pos = linePart(wkb, pos)
+                    coords.append(vertices)
+                    vertexCounts.append(len(vertices))
+                parts = count
+        partCounts.append(parts)
+
+    if coords:
+        vertices = numpy.concatenate(coords).astype(numpy.float64)
+    else:
+        vertices = numpy.zeros((0, 2), dtype=numpy.float64)
+    vertexOffsets = numpy.zeros(len(vertexCounts) + 1, dtype=numpy.int64)
+    numpy.cumsum(vertexCounts, out=vertexOffsets[1:])
+    partOffsets = numpy.zeros(len(partCounts) + 1, dtype=numpy.int64)
+    numpy.cumsum(partCounts, out=partOffsets[1:])
+    return (numpy.ascontiguousarray(vertices[:, 0]),
+            numpy.ascontiguousarray(vertices[:, 1]), vertexOffsets,
+            partOffsets)
+
+
+def geodesicDistances(lon1, lat1, lon2, lat2, ellipsoid):
+    '''Calculate geodesic distances between points given in degrees.
+
+    Inverse Vincenty formula is iterated for all point pairs at once
+    until all of them converge. Returns distances in meters.
+    '''
+    a, f = ellipsoid
+    b = a * (1 - f)
+
+    L = numpy.radians(lon2 - lon1)
+    U1 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat1)))
+    U2 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat2)))
+    sinU1, cosU1 = numpy.sin(U1), numpy.cos(U1)
+    sinU2, cosU2 = numpy.sin(U2), numpy.cos(U2)
+
+    lam = L.copy()
+    active = numpy.arange(len(L))
+    sinSigma = numpy.zeros(len(L))
+    cosSigma = numpy.ones(len(L))
+    sigma = numpy.zeros(len(L))
+    cos2Alpha = numpy.ones(len(L))
+    cos2SigmaM = numpy.zeros(len(L))
+    for _ in range(VINCENTY_ITERATIONS):
+        if len(active) == 0:
+            break
+        sinLam = numpy.sin(lam[active])
+        cosLam = numpy.cos(lam[active])
+        s1, c1, s2, c2 = sinU1[active], cosU1[active], sinU2[active], \
+            cosU2[active]
+        sinS = numpy.sqrt((c2 * sinLam) ** 2 +
+                          (c1 * s2 - s1 * c2 * cosLam) ** 2)
+        cosS = s1 * s2 + c1 * c2 * cosLam
+        sig = numpy.arctan2(sinS, cosS)
+        sinAlpha = numpy.where(sinS > 0, c1 * c2 * sinLam /
+                               numpy.where(sinS > 0, sinS, 1.0), 0.0)
+        cos2A = 1 - sinAlpha ** 2
+        # Lines along the equator have cos2A == 0
+        cos2SM = numpy.where(cos2A > 0, cosS - 2 * s1 * s2 /
+                             numpy.where(cos2A > 0, cos2A, 1.0), 0.0)
+        C = f / 16 * cos2A * (4 + f * (4 - 3 * cos2A))
+        previous = lam[active]
+        lam[active] = L[active] + (1 - C) * f * sinAlpha * (
+            sig + C * sinS * (cos2SM + C * cosS * (-1 + 2 * cos2SM ** 2)))
+
+        sinSigma[active] = sinS
+        cosSigma[active] = cosS
+        sigma[active] = sig
+        cos2Alpha[active] = cos2A
+        cos2SigmaM[active] = cos2SM
+        active = active[numpy.abs(lam[active] - previous) > 1e-12]
+
+    u2 = cos2Alpha * (a * a - b * b) / (b * b)
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (
+        cosSigma * (-1 + 2 * cos2SigmaM ** 2) - B / 6 * cos2SigmaM *
+        (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+    return b * A * (sigma - deltaSigma)
+
+
+def lineLengths(x, y, vertexOffsets, partOffsets, ellipsoid=None):
+    '''Calculate length of each geometry returned by parseLines.
+
+    Lengths are planar unless ellipsoid given as (semi-major axis,
+    flattening) tuple, then x and y are longitudes and latitudes and
+    lengths are geodesic in meters.
+    '''
+    if len(x) > 1:
+        if ellipsoid is None:
+            segment = numpy.hypot(x[1:] - x[:-1], y[1:] - y[:-1])
+        else:
+            segment = geodesicDistances(x[:-1], y[:-1], x[1:], y[1:],
+                                        ellipsoid)
+    else:
+        segment = numpy.zeros(0, dtype=numpy.float64)
+
+    # Segments joining last vertex of a part with the next part are not
+    # counted, parts without vertices at the start have no such segment
+    partEnds = vertexOffsets[1:-1] - 1
+    segment[partEnds[(partEnds >= 0) & (partEnds < len(segment))]] = 0.0
+    vertexSum = numpy.zeros(len(x), dtype=numpy.float64)
+    numpy.cumsum(segment, out=vertexSum[1:])
+
+    first = vertexOffsets[:-1]
+    last = numpy.maximum(vertexOffsets[1:] - 1, first)
+    partLength = numpy.zeros(len(first), dtype=numpy.float64)
+    nonEmpty = vertexOffsets[1:] > first
+    partLength[nonEmpty] = vertexSum[last[nonEmpty]] - \
+        vertexSum[first[nonEmpty]]
+
+    partSum = numpy.zeros(len(partLength) + 1, dtype=numpy.float64)
+    numpy.cumsum(partLength, out=partSum[1:])
+    return partSum[partOffsets[1:]] - partSum[partOffsets[:-1]]
+
+
+def lineEndpoints(x, y, vertexOffsets, partOffsets):
+    '''Return first vertex of the first part and last vertex of the last
+    part of each geometry returned by parseLines, NaN for geometries
+    without vertices.
+    '''
+    count = len(partOffsets) - 1
+    endpoints = [numpy.empty(count, dtype=numpy.float64) for _ in range(4)]
+    for values in endpoints:
+        values.fill(numpy.nan)
+
+    hasParts = partOffsets[1:] > partOffsets[:-1]
+    first = vertexOffsets[partOffsets[:-1][hasParts]]
+    last = vertexOffsets[partOffsets[1:][hasParts]] - 1
+    valid = last >= first
+    arcs = numpy.flatnonzero(hasParts)[valid]
+    startX, startY, endX, endY = endpoints
+    startX[arcs] = x[first[valid]]
+    startY[arcs] = y[first[valid]]
+    endX[arcs] = x[last[valid]]
+    endY[arcs] = y[last[valid]]
+    return startX, startY, endX, endY
+
+
+def lineParts(vertexOffsets, partOffsets):
+    '''Return number of parts with vertices of each geometry returned by
+    parseLines, zero for empty geometries.
+    '''
+    nonEmpty = numpy.zeros(len(vertexOffsets), dtype=numpy.int64)
+    numpy.cumsum(vertexOffsets[1:] > vertexOffsets[:-1], out=nonEmpty[1:])
+    return nonEmpty[partOffsets[1:]] - nonEmpty[partOffsets[:-1]]
+
+
+def _measureChunk(task):
+    wkbs, ellipsoid = task
+    x, y, vertexOffsets, partOffsets = parseLines(wkbs)
+    return lineEndpoints(x, y, vertexOffsets, partOffsets) + \
+        (lineLengths(x, y, vertexOffsets, partOffsets, ellipsoid),
+         lineParts(vertexOffsets, partOffsets))
+
+
+def measureLines(wkbs, ellipsoid=None, threads=1, chunkSize=65536):
+    '''Calculate endpoints and lengths of the line geometries.
+
+    Geometries are split into chunks measured by a pool of threads,
+    array operations release the interpreter lock, so chunks are
+    measured in parallel. Returns startX, startY, endX, endY, length and
+    number of parts arrays.
+    '''
+    tasks = [(wkbs[i:i + chunkSize], ellipsoid)
+             for i in range(0, len(wkbs), chunkSize)]
+    if len(tasks) == 0:
+        tasks = [([], ellipsoid)]
+
+    if threads > 1 and len(tasks) > 1:
+        pool = ThreadPool(min(threads, len(tasks)))
+        try:
+            results = pool.map(_measureChunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_measureChunk(task) for task in tasks]
+
+    return tuple(numpy.concatenate(values) for values in zip(*results))
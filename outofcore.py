@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+'''Out-of-core analysis of stream networks larger than memory.
+
+Arc endpoints, node ids, downstream arcs, lengths and orders are kept in
+memory-mapped arrays in a scratch directory and every stage processes
+them in chunks:
+
+* arcs are streamed to the scratch arrays as features are read
+* endpoints are hash-partitioned into buckets by their coordinates and
+  endpoints with identical coordinates are joined into nodes bucket by
+  bucket
+* connected parts of the network are labelled by union-find, with roots
+  hooked over chunks of arcs and paths shortened by pointer jumping
+* arcs are hash-partitioned by their part and every bucket of parts is
+  indexed and analysed in memory by the same functions as the whole
+  network, node ids of the buckets are shifted so they stay unique
+
+Memory used is bounded by the chunk size and the size of the largest
+bucket, which can not be smaller than the largest basin. Endpoints are
+joined only when identical, snap tolerance is not supported.
+'''
+
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from QGeomorf.graph import (NetworkGraph, outletCandidates, orderFrequency,
+    streamStatistics, addStatistics)
+from QGeomorf.core import indexBasins, analyseIndexed
+
+
+CHUNK_SIZE = 1 << 20
+BUCKET_ARCS = 1 << 21
+
+ENDPOINT = numpy.dtype([('x', numpy.float64), ('y', numpy.float64),
+                        ('end', numpy.int64)])
+
+ARC_COLUMNS = [('fids', numpy.int64), ('startX', numpy.float64),
+               ('startY', numpy.float64), ('endX', numpy.float64),
+               ('endY', numpy.float64), ('length', numpy.float64)]
+
+
+class ScratchArrays(object):
+    '''Memory-mapped arrays stored in a temporary directory.
+
+    Directory and all arrays are removed by close.
+    '''
+
+    def __init__(self, directory=None):
+        self.path = tempfile.mkdtemp(prefix='qgeomorf-', dir=directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fileName(self, name):
+        return os.path.join(self.path, name)
+
+    def create(self, name, dtype, count, fill=None):
+        # Memory map can not be empty
+        values = numpy.memmap(self.fileName(name + '.dat'), dtype=dtype,
+                              mode='w+', shape=(max(count, 1),))[:count]
+        if fill is not None:
+            for s in chunkSlices(count):
+                values[s] = fill
+        return values
+
+    def close(self):
+        shutil.rmtree(self.path, True)
+
+
+def chunkSlices(count, chunkSize=CHUNK_SIZE):
+    for start in range(0, count, chunkSize):
+        yield slice(start, min(start + chunkSize, count))
+
+
+def bucketCount(arcCount):
+    return max(1, -(-arcCount // BUCKET_ARCS))
+
+
+def _hashBuckets(keys, buckets):
+    '''Spread 64 bit keys uniformly over the buckets.'''
+    keys = keys.view(numpy.uint64) * numpy.uint64(0x9E3779B97F4A7C15)
+    return ((keys >> numpy.uint64(32)) % numpy.uint64(buckets)).astype(
+        numpy.int64)
+
+
+def _partition(values, buckets, files):
+    '''Append values to the bucket files.'''
+    order = numpy.argsort(buckets, kind='mergesort')
+    bounds = numpy.searchsorted(buckets[order],
+                                numpy.arange(len(files) + 1))
+    for k, f in enumerate(files):
+        if bounds[k] < bounds[k + 1]:
+            values[order[bounds[k]:bounds[k + 1]]].tofile(f)
+
+
+def streamArcs(scratch, records, count, chunkSize=CHUNK_SIZE):
+    '''Store arcs in the scratch arrays as they are read.
+
+    records yields (fid, startX, startY, endX, endY, length) tuple for
+    each of count arcs. Returns list of fids, startX, startY, endX, endY
+    and length arrays.
+    '''
+    arrays = [scratch.create(name, dtype, count)
+              for name, dtype in ARC_COLUMNS]
+
+    def store(chunk, pos):
+        for values, column in zip(arrays, zip(*chunk)):
+            values[pos:pos + len(chunk)] = column
+        return pos + len(chunk)
+
+    pos = 0
+    chunk = []
+    for record in records:
+        if pos + len(chunk) == count:
+            raise ValueError('More than {} arcs read'.format(count))
+        chunk.append(record)
+        if len(chunk) == chunkSize:
+            pos = store(chunk, pos)
+            chunk = []
+    if len(chunk) > 0:
+        pos = store(chunk, pos)
+
+    if pos != count:
+        raise ValueError('{} arcs read, {} expected'.format(pos, count))
+    return arrays
+
+
+def matchEndpoints(scratch, startX, startY, endX, endY, buckets,
+                   chunkSize=CHUNK_SIZE):
+    '''Join endpoints with identical coordinates into nodes.
+
+    Identical endpoints always fall into the same bucket, so each bucket
+    is matched independently. Node ids are consecutive within buckets.
+    Returns fromNode and toNode arrays and number of nodes.
+    '''
+    count = len(startX)
+    names = [scratch.fileName('ends{}'.format(k)) for k in range(buckets)]
+    files = [open(name, 'wb') for name in names]
+    try:
+        for s in chunkSlices(count, chunkSize):
+            ends = numpy.empty(2 * (s.stop - s.start), dtype=ENDPOINT)
+            # Adding zero turns -0.0 into 0.0, so equal coordinates have
+            # equal bits
+            ends['x'][0::2] = startX[s] + 0.0
+            ends['x'][1::2] = endX[s] + 0.0
+            ends['y'][0::2] = startY[s] + 0.0
+            ends['y'][1::2] = endY[s] + 0.0
+            ends['end'] = numpy.arange(2 * s.start, 2 * s.stop)
+            keys = ends['x'].view(numpy.uint64) ^ \
+                (ends['y'].view(numpy.uint64) * numpy.uint64(1000003))
+            _partition(ends, _hashBuckets(keys, buckets), files)
+    finally:
+        for f in files:
+            f.close()
+
+    nodes = scratch.create('endNode', numpy.int64, 2 * count)
+    nodeCount = 0
+    for name in names:
+        ends = numpy.fromfile(name, dtype=ENDPOINT)
+        os.remove(name)
+        if len(ends) == 0:
+            continue
+
+        order = numpy.lexsort((ends['y'], ends['x']))
+        xs = ends['x'][order]
+        ys = ends['y'][order]
+        isFirst = numpy.ones(len(order), dtype=bool)
+        isFirst[1:] = (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])
+        group = numpy.cumsum(isFirst) - 1
+        nodes[ends['end'][order]] = nodeCount + group
+        nodeCount += int(group[-1]) + 1
+
+    return nodes[0::2], nodes[1::2], nodeCount
+
+
+def componentLabels(scratch, fromNode, toNode, nodeCount,
+                    chunkSize=CHUNK_SIZE):
+    '''Label connected parts of the network.
+
+    Every round hooks root of the greater label to the smaller one for
+    all arcs joining different trees, then trees are flattened by pointer
+    jumping. Returns label of each node, which is the smallest node of
+    its part.
+    '''
+    parent = scratch.create('parent', numpy.int64, nodeCount)
+    for s in chunkSlices(nodeCount, chunkSize):
+        parent[s] = numpy.arange(s.start, s.stop)
+
+    while True:
+        hooked = 0
+        for s in chunkSlices(len(fromNode), chunkSize):
+            a = parent[fromNode[s]]
+            b = parent[toNode[s]]
+            differ = a != b
+            if differ.any():
+                numpy.minimum.at(parent, numpy.maximum(a, b)[differ],
+                                 numpy.minimum(a, b)[differ])
+                hooked += int(numpy.count_nonzero(differ))
+        if hooked == 0:
+            return parent
+
+        jumped = True
+        while jumped:
+            jumped = False
+            for s in chunkSlices(nodeCount, chunkSize):
+                up = parent[s]
+                upUp = parent[up]
+                if (up != upUp).any():
+                    parent[s] = upUp
+                    jumped = True
+
+
+def partitionArcs(scratch, fromNode, labels, buckets, chunkSize=CHUNK_SIZE):
+    '''Split arcs into buckets by the label of their part.
+
+    Returns names of the bucket files, each holding increasing indexes of
+    the arcs of whole parts of the network.
+    '''
+    names = [scratch.fileName('arcs{}'.format(k)) for k in range(buckets)]
+    files = [open(name, 'wb') for name in names]
+    try:
+        for s in chunkSlices(len(fromNode), chunkSize):
+            arcs = numpy.arange(s.start, s.stop, dtype=numpy.int64)
+            _partition(arcs, _hashBuckets(labels[fromNode[s]], buckets),
+                       files)
+    finally:
+        for f in files:
+            f.close()
+    return names
+
+
+def analyseNetwork(scratch, startX, startY, endX, endY, length,
+                   outletArcs=None, buckets=None, chunkSize=CHUNK_SIZE):
+    '''Index nodes of all basins and calculate parameters of the network
+    out of core.
+
+    Arguments are as for core.indexNetworkBasins, all arrays may be
+    memory-mapped. Returns dictionary with downNodeId, upNodeId, basin,
+    downArc, strahler, lengthUp and lengthDown scratch arrays, order
+    frequency, stream statistics (see graph.streamStatistics) and number
+    of parts with more than one outlet skipped.
+    '''
+    count = len(startX)
+    if buckets is None:
+        buckets = bucketCount(count)
+
+    fromNode, toNode, nodeCount = matchEndpoints(scratch, startX, startY,
+        endX, endY, buckets, chunkSize)
+    labels = componentLabels(scratch, fromNode, toNode, nodeCount,
+                             chunkSize)
+    names = partitionArcs(scratch, fromNode, labels, buckets, chunkSize)
+
+    results = dict(
+        downNodeId=scratch.create('downNodeId', numpy.int64, count, -1),
+        upNodeId=scratch.create('upNodeId', numpy.int64, count, -1),
+        basin=scratch.create('basin', numpy.int64, count, -1),
+        downArc=scratch.create('downArc', numpy.int64, count, -1),
+        strahler=scratch.create('strahler', numpy.int64, count, -1),
+        lengthUp=scratch.create('lengthUp', numpy.float64, count,
+                                numpy.nan),
+        lengthDown=scratch.create('lengthDown', numpy.float64, count,
+                                  numpy.nan))
+    if outletArcs is not None:
+        outletArcs = numpy.unique(numpy.asarray(outletArcs,
+                                                dtype=numpy.int64))
+
+    frequency = dict()
+    statistics = None
+    ambiguous = 0
+    shift = 0
+    for name in names:
+        arcs = numpy.fromfile(name, dtype=numpy.int64)
+        os.remove(name)
+        if len(arcs) == 0:
+            continue
+
+        # Parts are complete within the bucket, so degrees of the local
+        # graph are degrees in the whole network
+        arcLength = numpy.asarray(length[arcs], dtype=numpy.float64)
+        ids, nodes = numpy.unique(numpy.concatenate((fromNode[arcs],
+            toNode[arcs])), return_inverse=True)
+        graph = NetworkGraph(nodes[:len(arcs)], nodes[len(arcs):],
+                             arcLength)
+        if outletArcs is None:
+            outlets = outletCandidates(graph)
+        else:
+            pos = numpy.searchsorted(outletArcs, arcs)
+            pos[pos == len(outletArcs)] = 0
+            outlets = numpy.flatnonzero(outletArcs[pos] == arcs)
+
+        downNodeId, upNodeId, basin, skipped = indexBasins(graph, outlets)
+        ambiguous += skipped
+
+        # Node ids of the bucket follow the ids of the previous buckets,
+        # as ids of later basins within indexBasins
+        connected = upNodeId != -1
+        if not connected.any():
+            continue
+        downNodeId[connected] += shift
+        upNodeId[connected] += shift
+        shift = int(upNodeId.max()) + 2
+
+        params = analyseIndexed(downNodeId, upNodeId, arcLength)
+        results['downNodeId'][arcs] = downNodeId
+        results['upNodeId'][arcs] = upNodeId
+        results['basin'][arcs] = numpy.where(basin != -1, arcs[basin], -1)
+        results['downArc'][arcs] = numpy.where(params.downArc != -1,
+                                               arcs[params.downArc], -1)
+        results['strahler'][arcs] = params.strahler
+        results['lengthUp'][arcs] = params.lengthUp
+        results['lengthDown'][arcs] = params.lengthDown
+
+        for order, values in orderFrequency(params.upArcOffsets,
+                params.upArcs, params.strahler).items():
+            total = frequency.setdefault(order, [0.0, 0.0, 0.0])
+            for i in range(3):
+                total[i] += values[i]
+        statistics = addStatistics(statistics, streamStatistics(
+            params.upArcOffsets, params.upArcs, params.downArc,
+            params.strahler, arcLength))
+
+    if statistics is None:
+        statistics = dict(streams=numpy.zeros(1, dtype=numpy.int64),
+                          length=numpy.zeros(1, dtype=numpy.float64))
+    return results, frequency, statistics, ambiguous
@@ -1,103 +1,546 @@
+import time
+from array import array
+
+import numpy
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 from PyQt4.QtCore import QVariant
 
-from qgis.core import (QgsGeometry, QgsVectorLayer, QgsFeature, QgsFields,
-    QgsField)
+from qgis.core import (NULL, QgsGeometry, QgsFeature, QgsFields,
+    QgsField, QgsPoint, QgsFeatureRequest)
 
+from processing.core.ProcessingConfig import ProcessingConfig
+from processing.core.GeoAlgorithmExecutionException import \
+    GeoAlgorithmExecutionException
 from processing.tools import vector
 
+from QGeomorf.graph import nodeIndexes
+from QGeomorf.cache import cachePath, networkKey, nodeIdKey, saveTopology
+from QGeomorf.lengths import ELLIPSOIDS, measureLines
+
+
+WORKER_PROCESSES = 'QGEOMORF_WORKER_PROCESSES'
+TOPOLOGY_CACHE = 'QGEOMORF_TOPOLOGY_CACHE'
+
+READ_CHUNK_SIZE = 65536
+# Value of missing node ids while reading, -1 is a valid downstream id
+MISSING_ID = numpy.iinfo(numpy.int64).min
+
+OUTLET_SELECTED = 0
+OUTLET_FREE_END = 1
+OUTLET_FLAGGED = 2
 
-def makePoints(layer):
-    authId = layer.crs().authid()
-    nodes = QgsVectorLayer(
-        'Point?crs={}'.format(authId), 'network_nodes', 'memory')
+OUTLET_MODES = ['Selected arc',
+                'Arcs starting at free endpoints',
+                'Arcs flagged in the outlet field']
 
+
+def nodeFields():
     fields = QgsFields()
     fields.append(QgsField('id', QVariant.Int, '', 10))
     fields.append(QgsField('downNodeId', QVariant.Int, '', 10))
     fields.append(QgsField('upNodeId', QVariant.Int, '', 10))
+    fields.append(QgsField('nodeType', QVariant.String, '', 10))
+    return fields
 
-    provider = nodes.dataProvider()
-    provider.addAttributes(fields.toList())
-    nodes.updateFields()
 
-    idx = 0
-    points = []
-    ft = QgsFeature()
-    ft.setFields(fields)
+def nodeFeatures(graph, downNodeId, upNodeId, fields):
+    '''Generate point features for the nodes of the network graph.
 
-    for f in layer.getFeatures():
-        arc = f.geometry().asPolyline()
-        if arc[0] not in points:
-            ft.setGeometry(QgsGeometry.fromPoint(arc[0]))
-            ft['id'] = idx
-            provider.addFeatures([ft])
-            points.append(arc[0])
-            idx += 1
+    upNodeId of the point is id of the node assigned by node indexing,
+    downNodeId is id of the next node downstream (NULL for outlets). Both
+    are NULL for nodes not connected to an outlet.
+    '''
+    nodeId, nextNodeId, known, outlet = nodeIndexes(graph, downNodeId,
+                                                    upNodeId)
+    nodeId = nodeId.tolist()
+    nextNodeId = nextNodeId.tolist()
+    known = known.tolist()
+    outlet = outlet.tolist()
+    degree = graph.degree().tolist()
+    x = graph.x.tolist()
+    y = graph.y.tolist()
+
+    for i in xrange(graph.nodeCount):
+        ft = QgsFeature(fields)
+        ft.setGeometry(QgsGeometry.fromPoint(QgsPoint(x[i], y[i])))
+        ft['id'] = i
+        if known[i]:
+            ft['upNodeId'] = nodeId[i]
+            if not outlet[i]:
+                ft['downNodeId'] = nextNodeId[i]
+
+        if outlet[i]:
+            ft['nodeType'] = 'outlet'
+        elif degree[i] == 1:
+            ft['nodeType'] = 'source'
+        elif degree[i] == 2:
+            ft['nodeType'] = 'pseudo'
+        else:
+            ft['nodeType'] = 'confluence'
+        yield ft
 
-        if arc[-1] not in points:
-            ft.setGeometry(QgsGeometry.fromPoint(arc[-1]))
-            ft['id'] = idx
-            provider.addFeatures([ft])
-            points.append(arc[-1])
-            idx += 1
 
-    return nodes
+def layerEllipsoid(layer):
+    '''Return ellipsoid for geodesic lengths of the layer with geographic
+    CRS, None for projected layers.
+    '''
+    crs = layer.crs()
+    if not crs.geographicFlag():
+        return None
+    return ELLIPSOIDS.get(crs.ellipsoidAcronym(), ELLIPSOIDS['WGS84'])
+
+
+def _wkb(f):
+    geom = f.geometry()
+    return geom.asWkb() if geom is not None else None
+
 
+def _measureChunk(wkbs, ellipsoid):
+    return measureLines(wkbs, ellipsoid, workerProcesses(), READ_CHUNK_SIZE)
 
-def arcsAadjacencyDictionary(layer):
-    '''Build arc adjacency dictionary for the input stream network layer.
 
-    This dictionary is a set of adjacency lists compiled for each node in
-    th network.
+def readEndpoints(layer, ellipsoid=None, withParts=False, columns=None):
+    '''Read feature ids, coordinates of the first and last vertices and
+    lengths of the network arcs in a single pass.
+
+    Geometries are measured in bulk from their WKB, lengths are geodesic
+    when ellipsoid is given (see layerEllipsoid). When withParts is True
+    number of non-empty parts of each geometry is returned as well. When
+    columns are given (see readColumns) they are read in the same pass and
+    list of their arrays is returned last.
     '''
-    arcsPerNode = dict()
+    if columns is None:
+        indexes = []
+    else:
+        indexes = [layer.fieldNameIndex(name) for name, _, _ in columns]
+    req = QgsFeatureRequest()
+    req.setSubsetOfAttributes([idx for idx in indexes if idx != -1])
 
-    for f in layer.getFeatures():
-        geom = QgsGeometry(f.geometry())
-        polyline = geom.asPolyline()
-        fromNode = polyline[0]
-        toNode = polyline[-1]
+    fids = array('l')
+    chunks = []
+    columnChunks = []
+    wkbs = []
+    rows = []
+    chunkSize = READ_CHUNK_SIZE * workerProcesses()
+    for f in layer.getFeatures(req):
+        fids.append(f.id())
+        wkbs.append(_wkb(f))
+        if indexes:
+            attrs = f.attributes()
+            rows.append([attrs[idx] if idx != -1 else NULL
+                         for idx in indexes])
+        if len(wkbs) == chunkSize:
+            chunks.append(_measureChunk(wkbs, ellipsoid))
+            columnChunks.append(_columnArrays(columns, rows))
+            wkbs = []
+            rows = []
+    chunks.append(_measureChunk(wkbs, ellipsoid))
+    columnChunks.append(_columnArrays(columns, rows))
 
-        if fromNode not in arcsPerNode:
-            arcsPerNode[fromNode] = [f]
-        else:
-            arcsPerNode[fromNode].append(f)
+    startX, startY, endX, endY, length, parts = [numpy.concatenate(values)
+        for values in zip(*chunks)]
+    result = (fids, startX, startY, endX, endY, length)
+    if withParts:
+        result += (parts,)
+    if columns is not None:
+        result += ([numpy.concatenate(values)
+                    for values in zip(*columnChunks)],)
+    return result
 
-        if toNode not in arcsPerNode:
-            arcsPerNode[toNode] = [f]
-        else:
-            arcsPerNode[toNode].append(f)
 
-    return arcsPerNode
+def checkOutlets(layer, mode, fieldName):
+    '''Ensure that outlets of the given mode can be found in the layer.
+
+    Outlet arc must be selected for OUTLET_SELECTED and flag field set for
+    OUTLET_FLAGGED, otherwise GeoAlgorithmExecutionException is raised.
+    '''
+    if mode == OUTLET_SELECTED and layer.selectedFeatureCount() != 1:
+        raise GeoAlgorithmExecutionException(
+            'Seems outlet arc is not selected. Select outlet arc in the '
+            'stream network layer and try again.')
+    if mode == OUTLET_FLAGGED and not fieldName:
+        raise GeoAlgorithmExecutionException(
+            'Outlet flag field is not set. Select field marking outlet arcs '
+            'and try again.')
+
+
+def outletColumn(fieldName):
+    '''Return column of the outlet flag field for readColumns.'''
+    return (fieldName, object, 0)
+
 
+def outletArcs(layer, mode, fieldName, fids, flags=None):
+    '''Return positions of the outlet arcs in fids.
 
-def makeHelperDictionaries(layer):
-    # Mapping between upstream node id from attribute table and  QGIS
-    # feature id. Will be used to sort features from the network table
+    Depending on mode outlet is the selected arc or arcs with non-zero
+    value in the given field. For OUTLET_FREE_END None is returned, so
+    outlets are detected from the network topology. flags are values of
+    the outlet field aligned with fids when they were already read (see
+    outletColumn), otherwise the field is read from the layer.
+    '''
+    if mode == OUTLET_FREE_END:
+        return None
+    elif mode == OUTLET_FLAGGED and flags is not None:
+        return [i for i, flag in enumerate(flags) if flag]
+
+    position = dict((fid, i) for i, fid in enumerate(fids))
+    if mode == OUTLET_SELECTED:
+        return [position[layer.selectedFeatures()[0].id()]]
+
+    idx = layer.fieldNameIndex(fieldName)
+    req = QgsFeatureRequest()
+    req.setFlags(QgsFeatureRequest.NoGeometry)
+    req.setSubsetOfAttributes([idx])
+    return [position[f.id()] for f in layer.getFeatures(req)
+            if f[idx] != NULL and f[idx]]
+
+
+def _columnArrays(columns, rows):
+    '''Convert attribute rows into one typed array per column, NULL
+    values are replaced by the missing value of the column.
+    '''
+    arrays = []
+    for k, (name, dtype, missing) in enumerate(columns or []):
+        values = [v if v != NULL else missing for v in [row[k]
+                                                         for row in rows]]
+        arrays.append(numpy.array(values, dtype=dtype))
+    return arrays
+
+
+def readColumns(layer, columns, withLength=False, ellipsoid=None):
+    '''Read attribute columns of the layer into typed arrays.
+
+    columns is a list of (field name, numpy dtype, value for NULL) tuples.
+    Only the listed attributes are requested and geometries are not
+    fetched unless lengths of the arcs are needed. Values are collected
+    in chunks and converted column by column, geometries are measured in
+    bulk from their WKB. Columns missing in the layer are filled with
+    their NULL value.
+
+    Returns array of feature ids, list of the column arrays and lengths
+    (None when withLength is False).
+    '''
+    indexes = [layer.fieldNameIndex(name) for name, _, _ in columns]
+    req = QgsFeatureRequest()
+    if not withLength:
+        req.setFlags(QgsFeatureRequest.NoGeometry)
+    req.setSubsetOfAttributes([idx for idx in indexes if idx != -1])
+
+    fids = []
+    chunks = []
+    lengthChunks = []
 
-    myNetwork = dict()
+    def convert(rows, wkbs):
+        chunks.append(_columnArrays(columns, rows))
+        if withLength:
+            lengthChunks.append(_measureChunk(wkbs, ellipsoid)[4])
+
+    rows = []
+    wkbs = []
+    for f in layer.getFeatures(req):
+        fids.append(f.id())
+        attrs = f.attributes()
+        rows.append([attrs[idx] if idx != -1 else NULL for idx in indexes])
+        if withLength:
+            wkbs.append(_wkb(f))
+        if len(rows) == READ_CHUNK_SIZE:
+            convert(rows, wkbs)
+            rows = []
+            wkbs = []
+    convert(rows, wkbs)
+
+    values = [numpy.concatenate(c) for c in zip(*chunks)]
+    length = numpy.concatenate(lengthChunks) if withLength else None
+    return numpy.array(fids, dtype=numpy.int64), values, length
+
+
+def _nodeIdColumns(downNodeId, upNodeId):
+    '''Set both node ids to -1 where any of them is missing.'''
+    missing = (downNodeId == MISSING_ID) | (upNodeId == MISSING_ID)
+    downNodeId[missing] = -1
+    upNodeId[missing] = -1
+    return downNodeId, upNodeId
+
+
+def readNodeIds(layer, withLength=False, storedLength=False,
+                ellipsoid=None):
+    '''Read feature ids and node indexes stored in the layer.
+
+    Arcs without node indexes get -1 for both ids. Lengths are measured
+    on geometries (geodesic when ellipsoid is given), with storedLength
+    the Length field is read instead when the layer has it.
+    '''
+    columns = [('DownNodeId', numpy.int64, MISSING_ID),
+               ('UpNodeId', numpy.int64, MISSING_ID)]
+    fromField = withLength and storedLength and \
+        findField(layer, 'Length') != -1
+    if fromField:
+        columns.append(('Length', numpy.float64, numpy.nan))
+
+    fids, values, length = readColumns(layer, columns,
+                                       withLength and not fromField,
+                                       ellipsoid)
+    downNodeId, upNodeId = _nodeIdColumns(values[0], values[1])
+    if fromField:
+        length = values[2]
+    return fids.tolist(), downNodeId, upNodeId, length
+
+
+def readOrders(layer, areaField=None):
+    '''Read feature ids, node indexes, lengths, Strahler orders and,
+    optionally, basin areas of the network arcs in a single pass.
+
+    Arcs without node indexes get -1 for both ids, arcs without order get
+    -1, missing areas are NaN. Lengths are read from the Length field when
+    the layer has it, otherwise they are measured on geometries, geodesic
+    for layers with geographic CRS.
+    '''
+    columns = [('DownNodeId', numpy.int64, MISSING_ID),
+               ('UpNodeId', numpy.int64, MISSING_ID),
+               ('StrahOrder', numpy.int64, -1)]
+    if areaField:
+        columns.append((areaField, numpy.float64, numpy.nan))
+    fromField = findField(layer, 'Length') != -1
+    if fromField:
+        columns.append(('Length', numpy.float64, numpy.nan))
 
-    # Find upstream and downstream arc ids for each arc in the stream
-    # network layer. First we generate helper arcPerNodeId dictionary
-    # with node ids as keys and lists of arc ids connected to this node
-    # as values
-    # Algorithm at pages 55-56 "Automated AGQ4Vector Watershed.pdf"
-    arcsPerNodeId = dict()
+    fids, values, length = readColumns(layer, columns, not fromField,
+                                       layerEllipsoid(layer))
+    downNodeId, upNodeId = _nodeIdColumns(values[0], values[1])
+    if fromField:
+        length = values[-1]
+    return (fids.tolist(), downNodeId, upNodeId, length, values[2],
+            values[3] if areaField else None)
+
+
+RESULT_COLUMNS = [('DownNodeId', numpy.int64, MISSING_ID),
+                  ('UpNodeId', numpy.int64, MISSING_ID),
+                  ('BasinId', numpy.int64, MISSING_ID),
+                  ('StrahOrder', numpy.int64, -1),
+                  ('LengthUp', numpy.float64, numpy.nan),
+                  ('LengthDown', numpy.float64, numpy.nan)]
+
+
+def hasResults(layer):
+    '''Check whether the layer has all fields written by the previous
+    run of the full analysis.'''
+    return -1 not in [findField(layer, name) for name, _, _ in
+                      RESULT_COLUMNS]
+
+
+def storedResults(fids, values):
+    '''Convert RESULT_COLUMNS read together with fids into node ids,
+    basins, Strahler orders and lengths stored by the previous run.
+
+    Basin is given as position of the outlet arc in fids. Missing values
+    are -1 for ids and orders and NaN for lengths.
+    '''
+    downNodeId, upNodeId, outlet, strahler, lengthUp, lengthDown = values
+
+    # Basin outlets are stored as feature ids
+    position = dict((fid, i) for i, fid in enumerate(fids))
+    basin = numpy.array([position.get(fid, -1) for fid in outlet.tolist()],
+                        dtype=numpy.int64)
+    missing = (downNodeId == MISSING_ID) | (upNodeId == MISSING_ID) | \
+        (outlet == MISSING_ID)
+    downNodeId[missing] = -1
+    upNodeId[missing] = -1
+    basin[missing] = -1
+    return downNodeId, upNodeId, basin, strahler, lengthUp, lengthDown
+
+
+def writeNetwork(layer, writer, fids, fieldCount, columns):
+    '''Copy network features to the writer with computed attributes set.
+
+    columns maps field index to the list of values for each arc, arcs
+    are matched with features by fids. None values are written as NULL,
+    features not listed in fids get NULL in all computed fields. Returns
+    number of features matched by fid lookup.
+    '''
+    fids = list(fids)
+    index = None
+    lookups = 0
+    pos = 0
     for f in layer.getFeatures():
-        if f['UpNodeId'] not in arcsPerNodeId:
-            arcsPerNodeId[f['UpNodeId']] = [f.id()]
+        # Features usually come in the same order as they were read
+        # before, so lookup by fid is rarely needed
+        if pos < len(fids) and fids[pos] == f.id():
+            i = pos
         else:
-            arcsPerNodeId[f['UpNodeId']].append(f.id())
+            if index is None:
+                index = dict((fid, j) for j, fid in enumerate(fids))
+            i = index.get(f.id(), -1)
+            lookups += 1
+        if i != -1:
+            pos = i + 1
 
-        if f['DownNodeId'] not in arcsPerNodeId:
-            arcsPerNodeId[f['DownNodeId']] = [f.id()]
+        attrs = f.attributes()
+        attrs.extend([NULL] * (fieldCount - len(attrs)))
+        for idx, values in columns.iteritems():
+            value = values[i] if i != -1 else None
+            attrs[idx] = value if value is not None else NULL
+        f.setAttributes(attrs)
+        writer.addFeature(f)
+
+    return lookups
+
+
+class RunStatistics(object):
+    '''Time the stages of an algorithm and count its I/O operations.
+
+    Starting a stage finishes the previous one, reports stage name and
+    percentage of the completed stages to the progress.
+    '''
+
+    FIELDS = ['stage', 'seconds', 'percent', 'features', 'fidLookups',
+              'attrWrites', 'peakMemKb']
+
+    def __init__(self, progress, stageCount):
+        self.progress = progress
+        self.stageCount = stageCount
+        self.stages = []
+        self.started = None
+
+    def stage(self, name):
+        self.finish()
+        self.progress.setPercentage(
+            int(100 * len(self.stages) / self.stageCount))
+        self.progress.setInfo(name)
+        self.stages.append(dict(stage=name, features=0, fidLookups=0,
+                                attrWrites=0))
+        self.started = time.time()
+
+    def count(self, counter, value):
+        self.stages[-1][counter] += value
+
+    def finish(self):
+        if self.started is None:
+            return
+
+        current = self.stages[-1]
+        current['seconds'] = time.time() - self.started
+        if resource is not None:
+            # Peak resident size of the process so far
+            current['peakMemKb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
         else:
-            arcsPerNodeId[f['DownNodeId']].append(f.id())
+            current['peakMemKb'] = None
+        self.started = None
+
+    def write(self, output):
+        '''Finish current stage and write statistics to the output table.'''
+        self.finish()
+        self.progress.setPercentage(100)
+
+        total = sum(s['seconds'] for s in self.stages)
+        writer = output.getTableWriter(self.FIELDS)
+        for s in self.stages:
+            s['percent'] = 100.0 * s['seconds'] / total if total > 0 else 0.0
+            writer.addRecord([s[f] for f in self.FIELDS])
+        del writer
 
-        # Also populate mapping between upstream node id and feature id
-        myNetwork[f['UpNodeId']] = f.id()
 
-    return myNetwork, arcsPerNodeId
+def maskedValues(values, mask):
+    '''Convert array to list with None where mask is False.'''
+    return [v if m else None for v, m in zip(values.tolist(), mask.tolist())]
+
+
+def downArcIds(params, fids):
+    '''Return feature id of the downstream arc for each arc.'''
+    return [fids[j] if j != -1 else None for j in params.downArc.tolist()]
+
+
+def upArcIds(params, fids):
+    '''Return comma separated feature ids of the upstream arcs for each
+    arc connected to the outlet.
+    '''
+    offsets = params.upArcOffsets.tolist()
+    arcs = params.upArcs.tolist()
+    ids = [None] * params.arcCount
+    for i in params.connected().tolist():
+        ids[i] = ','.join([str(fids[j])
+                           for j in arcs[offsets[i]:offsets[i + 1]]])
+    return ids
+
+
+def writeUpstreamArcs(output, params, fids):
+    '''Write upstream arcs relation to the output table.
+
+    Every row holds feature id of an arc and of one of the arcs located
+    directly upstream of it.
+    '''
+    offsets = params.upArcOffsets.tolist()
+    arcs = params.upArcs.tolist()
+    writer = output.getTableWriter(['ArcId', 'UpArcId'])
+    for i in params.connected().tolist():
+        for j in arcs[offsets[i]:offsets[i + 1]]:
+            writer.addRecord([fids[i], fids[j]])
+    del writer
+
+
+def writeHortonRatios(output, ratios):
+    '''Write Horton ratios to the output table, ratios which could not
+    be fitted are left empty.
+    '''
+    writer = output.getTableWriter(['ratio', 'value', 'R2'])
+    for name in sorted(ratios.keys()):
+        value, r2 = ratios[name]
+        # NaN is the only value not equal to itself
+        writer.addRecord([name, value if value == value else '',
+                          r2 if r2 == r2 else ''])
+    del writer
+
+
+def workerProcesses():
+    value = ProcessingConfig.getSetting(WORKER_PROCESSES)
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _cachePath(source):
+    if not ProcessingConfig.getSetting(TOPOLOGY_CACHE):
+        return None
+    return cachePath(source)
+
+
+def topologyCache(layer, startX, startY, endX, endY, outlets, tolerance):
+    '''Return path of the topology cache file of the layer and key of the
+    network, both None when caching is disabled or layer is not a file.
+    '''
+    source = layer.source()
+    path = _cachePath(source)
+    if path is None:
+        return None, None
+    return path, networkKey(source, startX, startY, endX, endY, outlets,
+                            tolerance)
+
+
+def nodeIdCache(source, downNodeId, upNodeId):
+    '''Return path of the topology cache file of the layer source and key
+    of its node ids, both None when caching is disabled or source is not
+    a file.
+    '''
+    path = _cachePath(source)
+    if path is None:
+        return None, None
+    return path, nodeIdKey(downNodeId, upNodeId)
+
+
+def cacheOutputTopology(source, topology):
+    '''Store topology of the network in the cache of the output layer
+    written with its node ids, so tools run on the output load it.
+    '''
+    path, key = nodeIdCache(source, topology['downNodeId'],
+                            topology['upNodeId'])
+    if path is not None:
+        saveTopology(path, key, **topology)
 
 
 def findOrCreateField(layer, fieldList, fieldName, fieldType=QVariant.Double,
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+'''Validation of the stream network before its analysis.
+
+All checks are linear in the number of arcs: connected parts are labelled
+by union-find and most defects are found by counting arcs, nodes and arc
+ends per node. Only parts containing loops are walked, sources are peeled
+off them until the arcs in loops are left.
+
+Node indexing expects every arc digitized from its downstream to its
+upstream node, as the outlet arc starts at the outlet. In a basin digitized
+this way exactly one arc ends at every node except the outlet node.
+'''
+
+import numpy
+
+from QGeomorf.graph import componentLabels, outletCandidates
+
+
+EMPTY_GEOMETRY = 'empty geometry'
+MULTIPART = 'multipart line'
+LOOP = 'loop'
+NO_OUTLET = 'no outlet'
+SEVERAL_OUTLETS = 'several outlets'
+REVERSED = 'reversed digitization'
+
+# Problems located at arcs, the others are located at nodes
+ARC_PROBLEMS = [EMPTY_GEOMETRY, MULTIPART, LOOP, NO_OUTLET, SEVERAL_OUTLETS]
+NODE_PROBLEMS = [REVERSED]
+
+# Problems making results of the analysis wrong, the others only leave
+# parts of the network without results
+FATAL_PROBLEMS = [EMPTY_GEOMETRY, MULTIPART, LOOP]
+
+
+class NetworkError(ValueError):
+    '''Network has defects which make its analysis impossible.
+
+    problems holds the defects found, as returned by validateNetwork.
+    '''
+
+    def __init__(self, problems):
+        self.problems = problems
+        ValueError.__init__(self, 'Network has arcs with {}'.format(
+            ', '.join('{} ({})'.format(p, len(problems[p]))
+                      for p in FATAL_PROBLEMS if p in problems)))
+
+
+def loopArcs(graph, labels=None):
+    '''Return mask of arcs in loops or joining loops.
+
+    Connected part of the network is a tree when it has one arc less than
+    nodes, arcs of the parts with more arcs are walked. Sources of such
+    parts are removed with their arcs until only nodes joined to at least
+    two remaining arcs are left.
+    '''
+    if labels is None:
+        labels = componentLabels(graph)
+    arcLabel = labels[graph.fromNode]
+    nodes = numpy.bincount(labels, minlength=graph.nodeCount)
+    arcs = numpy.bincount(arcLabel, minlength=graph.nodeCount)
+    cyclic = (arcs >= nodes) & (nodes > 0)
+    inLoop = cyclic[arcLabel]
+    if not inLoop.any():
+        return inLoop
+
+    fromNode = graph.fromNode.tolist()
+    toNode = graph.toNode.tolist()
+    offsets = graph.offsets.tolist()
+    arcsAtNode = graph.arcs.tolist()
+    removed = (~inLoop).tolist()
+
+    # Parts are whole, so degrees count only arcs of parts with loops
+    degree = graph.degree().tolist()
+    sources = numpy.flatnonzero(cyclic[labels] &
+                                (graph.degree() == 1)).tolist()
+    while sources:
+        node = sources.pop()
+        for pos in range(offsets[node], offsets[node + 1]):
+            arc = arcsAtNode[pos]
+            if not removed[arc]:
+                break
+        else:
+            continue
+
+        removed[arc] = True
+        degree[node] -= 1
+        other = fromNode[arc] if fromNode[arc] != node else toNode[arc]
+        degree[other] -= 1
+        if degree[other] == 1:
+            sources.append(other)
+
+    return ~numpy.array(removed, dtype=bool)
+
+
+def validateNetwork(graph, outletArcs=None, parts=None):
+    '''Find defects of the network graph.
+
+    When outletArcs is None, arcs starting at endpoints not shared with
+    other arcs are outlets, as in core.indexNetworkBasins. parts is the
+    number of non-empty parts of each arc geometry, empty and multipart
+    geometries are not checked without it.
+
+    Returns dictionary with arrays of arcs for each problem found in
+    ARC_PROBLEMS and of nodes for each problem in NODE_PROBLEMS, problems
+    not found are left out.
+    '''
+    problems = dict()
+
+    def add(problem, values):
+        if len(values) > 0:
+            problems[problem] = values
+
+    if parts is not None:
+        parts = numpy.asarray(parts)
+        add(EMPTY_GEOMETRY, numpy.flatnonzero(parts == 0))
+        add(MULTIPART, numpy.flatnonzero(parts > 1))
+
+    labels = componentLabels(graph)
+    add(LOOP, numpy.flatnonzero(loopArcs(graph, labels)))
+
+    if outletArcs is None:
+        outlets = outletCandidates(graph)
+    else:
+        outlets = numpy.unique(numpy.asarray(outletArcs, dtype=numpy.int64))
+    arcLabel = labels[graph.fromNode]
+    outletCount = numpy.bincount(arcLabel[outlets],
+                                 minlength=graph.nodeCount)
+    add(NO_OUTLET, numpy.flatnonzero(outletCount[arcLabel] == 0))
+    add(SEVERAL_OUTLETS, outlets[outletCount[arcLabel[outlets]] > 1])
+
+    # Only the outlet node may have no arc ending at it, nodes in parts
+    # without outlets are already reported
+    ending = numpy.bincount(graph.toNode, minlength=graph.nodeCount)
+    outletNode = numpy.zeros(graph.nodeCount, dtype=bool)
+    outletNode[graph.fromNode[outlets]] = True
+    if outletArcs is None:
+        # Every free start is an outlet, other starts at free endpoints
+        # are reported as several outlets
+        outletNode |= graph.degree() == 1
+    add(REVERSED, numpy.flatnonzero((outletCount[labels] > 0) & (
+        (ending > 1) | ((ending == 0) & ~outletNode))))
+
+    return problems
+
+
+def checkNetwork(graph, outletArcs=None, parts=None):
+    '''Validate the network graph before its analysis.
+
+    Arguments are as for validateNetwork. Raises NetworkError when any of
+    FATAL_PROBLEMS is found, otherwise returns the problems found.
+    '''
+    problems = validateNetwork(graph, outletArcs, parts)
+    if any(p in problems for p in FATAL_PROBLEMS):
+        raise NetworkError(problems)
+    return problems